@@ -3,11 +3,22 @@
 # Author: vvlachoudis@gmail.com
 # Date: 24-Aug-2014
 
+import hashlib
 import math
+import multiprocessing
 import os
+import pickle
 import re
+import struct
+import sys
+import tempfile
 import types
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
+import bplanner
+import btour
+import numpy
 import undo
 import Unicode
 from bmath import (
@@ -20,7 +31,7 @@ from bmath import (
     Vector,
 )
 from bpath import Path, Segment
-from bstl import Binary_STL_Writer
+from bstl import BINARY_HEADER
 from dxf import DXF
 from svgcode import SVGcode
 from Helpers import to_zip
@@ -49,6 +60,43 @@ CCW = 3
 
 WCS = ["G54", "G55", "G56", "G57", "G58", "G59"]
 
+# Probe interpolation methods
+BILINEAR = 0
+BICUBIC = 1
+THINPLATE = 2  # thin-plate spline over the probed points
+THINPLATE_POINTS = 400  # most points of a spline fit, the solve is O(n^3)
+
+# Binary probe map: fixed header followed by the float32 Z grid (yn, xn)
+PROBE_MAGIC = b"bCNCPRB"
+PROBE_VERSION = 1
+PROBE_HEADER = numpy.dtype([
+    ("magic", "S8"),
+    ("version", "<u4"),
+    ("xn", "<u4"),
+    ("yn", "<u4"),
+    ("pad", "<u4"),
+    ("xmin", "<f8"),
+    ("xmax", "<f8"),
+    ("ymin", "<f8"),
+    ("ymax", "<f8"),
+    ("zmin", "<f8"),
+    ("zmax", "<f8"),
+    ("feed", "<f8"),
+])
+STL_FACET = numpy.dtype([
+    ("normal", "<f4", 3),
+    ("vertex", "<f4", (3, 3)),
+    ("attr", "<u2"),
+])
+
+# Cache of the parsed blocks and geometry of the loaded files
+CACHE_DIR = os.path.expanduser("~/.bCNC.cache")
+CACHE_FILES = 20  # maximum number of files kept in the cache
+CACHE_VERSION = 2
+
+# Minimum number of segments to pocket in a pool of processes
+POCKET_POOL = 500
+
 DISTANCE_MODE = {"G90": "Absolute", "G91": "Incremental"}
 FEED_MODE = {"G93": "1/Time", "G94": "unit/min", "G95": "unit/rev"}
 UNITS = {"G20": "inch", "G21": "mm"}
@@ -120,6 +168,10 @@ def getValue(name, new, old, default=0.0):
 # =============================================================================
 class Probe:
     def __init__(self):
+        self.interpolation = BILINEAR
+        self.tolerance = 0.01  # maximum error of the adaptive scan
+        self.footprint = None  # mask of the cells to probe, None for all
+        self._footprintGrid = None  # grid of the footprint
         self.init()
 
     # ----------------------------------------------------------------------
@@ -140,7 +192,12 @@ class Probe:
         self.yn = 5
 
         self.points = []  # probe points
-        self.matrix = []  # 2D matrix with Z coordinates
+        self.matrix = numpy.zeros((0, 0))  # 2D matrix with Z coordinates
+        self._table = None  # interpolation coefficients
+        self._probed = None  # nodes probed during a partial scan
+        self._cells = []  # cells to refine in the next adaptive pass
+        self._planned = 0  # number of nodes to probe in a footprint scan
+        self.warning = None  # message for the user about the last fit
         self.zeroed = False  # if probe was zeroed at any location
         self.start = False  # start collecting probes
         self.saved = False
@@ -148,20 +205,29 @@ class Probe:
     # ----------------------------------------------------------------------
     def clear(self):
         del self.points[:]
-        del self.matrix[:]
+        self.matrix = numpy.zeros((0, 0))
+        self._table = None
+        self._probed = None
+        self._cells = []
+        self._pass = []
+        self._planned = 0
         self.zeroed = False
         self.start = False
         self.saved = False
 
     # ----------------------------------------------------------------------
     def isEmpty(self):
-        return len(self.matrix) == 0
+        return self.matrix.size == 0
 
     # ----------------------------------------------------------------------
     def makeMatrix(self):
-        del self.matrix[:]
-        for j in range(self.yn):
-            self.matrix.append([0.0] * (self.xn))
+        self.matrix = numpy.zeros((self.yn, self.xn))
+        self._table = None
+
+    # ----------------------------------------------------------------------
+    def setInterpolation(self, method):
+        self.interpolation = method
+        self._table = None
 
     # ----------------------------------------------------------------------
     # Load autolevel information from file
@@ -172,6 +238,10 @@ class Probe:
         self.clear()
         self.saved = True
 
+        if os.path.splitext(self.filename)[1].lower() == ".pmap":
+            self.loadMap()
+            return
+
         def read(f):
             while True:
                 line = f.readline()
@@ -202,6 +272,53 @@ class Probe:
             raise
         f.close()
 
+    # ----------------------------------------------------------------------
+    # Load a binary probe map, the grid is memory mapped from the file
+    # ----------------------------------------------------------------------
+    def loadMap(self):
+        header = numpy.fromfile(self.filename, PROBE_HEADER, 1)
+        if len(header) == 0 or header["magic"][0] != PROBE_MAGIC:
+            raise ValueError(_("Not a bCNC probe map"))
+        header = header[0]
+        if header["version"] > PROBE_VERSION:
+            raise ValueError(_("Unsupported probe map version"))
+
+        self.xn = max(2, int(header["xn"]))
+        self.yn = max(2, int(header["yn"]))
+        self.xmin = float(header["xmin"])
+        self.xmax = float(header["xmax"])
+        self.ymin = float(header["ymin"])
+        self.ymax = float(header["ymax"])
+        self.zmin = float(header["zmin"])
+        self.zmax = float(header["zmax"])
+        CNC.vars["prbfeed"] = float(header["feed"])
+        self.xstep()
+        self.ystep()
+
+        grid = numpy.memmap(
+            self.filename,
+            dtype="<f4",
+            mode="r",
+            offset=PROBE_HEADER.itemsize,
+            shape=(self.yn, self.xn),
+        )
+        self.matrix = numpy.array(grid, dtype=float)
+        self._table = None
+        del grid
+
+        x, y = self.grid()
+        self.points = numpy.stack(
+            (x.ravel(), y.ravel(), self.matrix.ravel()), axis=1).tolist()
+
+    # ----------------------------------------------------------------------
+    # Return the X and Y coordinates of the grid nodes
+    # ----------------------------------------------------------------------
+    def grid(self):
+        return numpy.meshgrid(
+            self.xmin + self._xstep * numpy.arange(self.xn),
+            self.ymin + self._ystep * numpy.arange(self.yn),
+        )
+
     # ----------------------------------------------------------------------
     # Save level information to file
     # ----------------------------------------------------------------------
@@ -212,6 +329,12 @@ class Probe:
         fn, ext = os.path.splitext(filename)
         ext = ext.lower()
 
+        if ext == ".pmap":
+            self.filename = filename
+            self.saveMap(filename)
+            self.saved = True
+            return
+
         f = open(filename, "w")
         if ext != ".xyz":
             self.filename = filename
@@ -228,6 +351,26 @@ class Probe:
         f.close()
         self.saved = True
 
+    # ----------------------------------------------------------------------
+    # Save level information as binary probe map
+    # ----------------------------------------------------------------------
+    def saveMap(self, filename):
+        header = numpy.zeros(1, PROBE_HEADER)
+        header["magic"] = PROBE_MAGIC
+        header["version"] = PROBE_VERSION
+        header["xn"] = self.xn
+        header["yn"] = self.yn
+        header["xmin"] = self.xmin
+        header["xmax"] = self.xmax
+        header["ymin"] = self.ymin
+        header["ymax"] = self.ymax
+        header["zmin"] = self.zmin
+        header["zmax"] = self.zmax
+        header["feed"] = CNC.vars["prbfeed"]
+        with open(filename, "wb") as f:
+            header.tofile(f)
+            numpy.ascontiguousarray(self.matrix, dtype="<f4").tofile(f)
+
     # ----------------------------------------------------------------------
     # Save level information as STL file
     # ----------------------------------------------------------------------
@@ -235,20 +378,32 @@ class Probe:
         if filename is not None:
             self.filename = filename
 
+        # every grid cell v1 v2 v3 v4 as the triangles v1 v2 v3, v3 v4 v1
+        x, y = self.grid()
+        nodes = numpy.stack((x, y, self.matrix), axis=-1)
+        v1 = nodes[:-1, :-1].reshape(-1, 3)
+        v2 = nodes[:-1, 1:].reshape(-1, 3)
+        v3 = nodes[1:, 1:].reshape(-1, 3)
+        v4 = nodes[1:, :-1].reshape(-1, 3)
+        faces = numpy.stack(
+            (numpy.stack((v1, v2, v3), axis=1),
+             numpy.stack((v3, v4, v1), axis=1)),
+            axis=1,
+        ).reshape(-1, 3, 3)
+
+        normal = numpy.cross(
+            faces[:, 0] - faces[:, 1], faces[:, 1] - faces[:, 2])
+        length = numpy.linalg.norm(normal, axis=1)
+        length[length == 0.0] = 1.0
+        normal /= length[:, None]
+
+        facets = numpy.zeros(len(faces), STL_FACET)
+        facets["normal"] = normal
+        facets["vertex"] = faces
         with open(self.filename, "wb") as fp:
-            writer = Binary_STL_Writer(fp)
-            for j in range(self.yn - 1):
-                y1 = self.ymin + self._ystep * j
-                y2 = self.ymin + self._ystep * (j + 1)
-                for i in range(self.xn - 1):
-                    x1 = self.xmin + self._xstep * i
-                    x2 = self.xmin + self._xstep * (i + 1)
-                    v1 = [x1, y1, self.matrix[j][i]]
-                    v2 = [x2, y1, self.matrix[j][i + 1]]
-                    v3 = [x2, y2, self.matrix[j + 1][i + 1]]
-                    v4 = [x1, y2, self.matrix[j + 1][i]]
-                    writer.add_face([v1, v2, v3, v4])
-            writer.close()
+            fp.write(struct.pack(
+                BINARY_HEADER, b"Python Binary STL Writer", len(facets)))
+            facets.tofile(fp)
 
     # ----------------------------------------------------------------------
     # Return step
@@ -278,6 +433,9 @@ class Probe:
     # Return the code needed to scan for autoleveling
     # ----------------------------------------------------------------------
     def scan(self):
+        self._checkFootprint()
+        if self.footprint is not None:
+            return self._scanFootprint()
         self.clear()
         self.start = True
         self.makeMatrix()
@@ -305,6 +463,236 @@ class Probe:
         lines.append(f"G0X{self.xmin:.4f}Y{self.ymin:.4f}")
         return lines
 
+    # ----------------------------------------------------------------------
+    # Return the code needed to probe the (i,j) nodes of the grid
+    # ----------------------------------------------------------------------
+    def _scanNodes(self, nodes):
+        # serpentine order along X
+        rows = {}
+        for i, j in nodes:
+            rows.setdefault(j, []).append(i)
+        lines = [f"G0Z{CNC.vars['safe']:.4f}"]
+        for k, j in enumerate(sorted(rows)):
+            y = self.ymin + self._ystep * j
+            for i in sorted(rows[j], reverse=bool(k & 1)):
+                x = self.xmin + self._xstep * i
+                lines.append(f"G0Z{self.zmax:.4f}")
+                lines.append(f"G0X{x:.4f}Y{y:.4f}")
+                lines.append("%wait")  # added for smoothie
+                lines.append(
+                    f"{CNC.vars['prbcmd']}Z{self.zmin:.4f}"
+                    f"F{CNC.vars['prbfeed']:g}"
+                )
+                lines.append("%wait")  # added for smoothie
+        lines.append(f"G0Z{self.zmax:.4f}")
+        return lines
+
+    # ----------------------------------------------------------------------
+    # Return the code needed to scan only the nodes of the cells in the
+    # footprint. The rest are filled with the nearest probed value
+    # ----------------------------------------------------------------------
+    def _scanFootprint(self):
+        self.clear()
+        self.start = True
+        self.makeMatrix()
+        self._probed = numpy.zeros((self.yn, self.xn), dtype=bool)
+        j, i = numpy.nonzero(self._footprintNodes())
+        self._planned = len(i)
+        return self._scanNodes(zip(i.tolist(), j.tolist()))
+
+    # ----------------------------------------------------------------------
+    # Return the code needed to start an adaptive scan. Only a coarse grid
+    # of the xn x yn nodes is probed, the rest by the next passes of
+    # scanNext() where needed
+    # ----------------------------------------------------------------------
+    def scanAdaptive(self, tolerance):
+        self._checkFootprint()
+        self.clear()
+        self.start = True
+        self.makeMatrix()
+        self.tolerance = tolerance
+        self._probed = numpy.zeros((self.yn, self.xn), dtype=bool)
+
+        def coarse(n):
+            stride = 1
+            while (n - 1) // (2 * stride) >= 2:
+                stride *= 2
+            return sorted(set(range(0, n, stride)) | {n - 1})
+
+        xs = coarse(self.xn)
+        ys = coarse(self.yn)
+        self._cells = [
+            cell
+            for cell in (
+                (i0, i1, j0, j1)
+                for i0, i1 in zip(xs, xs[1:])
+                for j0, j1 in zip(ys, ys[1:])
+            )
+            if self._inFootprint(cell)
+        ]
+        nodes = set()
+        for i0, i1, j0, j1 in self._cells:
+            nodes.update(((i0, j0), (i1, j0), (i0, j1), (i1, j1)))
+        self._pass = list(nodes)
+        return self._scanNodes(nodes)
+
+    # ----------------------------------------------------------------------
+    # Set the mask of the cells to probe, calculated on the current grid
+    # ----------------------------------------------------------------------
+    def setFootprint(self, footprint):
+        self.footprint = footprint
+        self._footprintGrid = self._gridKey()
+
+    # ----------------------------------------------------------------------
+    def _gridKey(self):
+        return (self.xmin, self.xmax, self.xn, self.ymin, self.ymax, self.yn)
+
+    # ----------------------------------------------------------------------
+    # Forget a footprint calculated for a different grid, the same number
+    # of cells over other margins covers other coordinates
+    # ----------------------------------------------------------------------
+    def _checkFootprint(self):
+        if (self.footprint is not None
+                and self._footprintGrid != self._gridKey()):
+            self.footprint = None
+
+    # ----------------------------------------------------------------------
+    def _inFootprint(self, cell):
+        if self.footprint is None:
+            return True
+        i0, i1, j0, j1 = cell
+        return bool(self.footprint[j0:j1, i0:i1].any())
+
+    # ----------------------------------------------------------------------
+    # Return the code for the next pass of an adaptive scan, or an empty
+    # list when finished. Every cell, with probed corners, is split in
+    # four when the thin-plate spline of the probed points around it
+    # deviates more than the tolerance from the bilinear interpolation of
+    # its corners. At the end the nodes not probed are filled from the
+    # spline of all the probed points. The scan is cancelled if the last
+    # pass was interrupted before probing all its nodes
+    # ----------------------------------------------------------------------
+    def scanNext(self):
+        if not self.start or self._probed is None:
+            return []
+        if not all(self._probed[j, i] for i, j in self._pass):
+            self.scanCancel()
+            self.warning = _("Adaptive scan cancelled, the last pass "
+                             "was not completed")
+            return []
+
+        cells = []
+        nodes = set()
+        for i0, i1, j0, j1 in self._cells:
+            xs = sorted({i0, (i0 + i1) // 2, i1})
+            ys = sorted({j0, (j0 + j1) // 2, j1})
+            new = [
+                (i, j) for i in xs for j in ys
+                if not self._probed[j, i]
+            ]
+            if not new:
+                continue
+            ii = numpy.array([i for i, j in new], dtype=float)
+            jj = numpy.array([j for i, j in new], dtype=float)
+            u = (ii - i0) / (i1 - i0)
+            v = (jj - j0) / (j1 - j0)
+            m = self.matrix
+            linear = (
+                (1.0 - u) * (1.0 - v) * m[j0, i0]
+                + u * (1.0 - v) * m[j0, i1]
+                + (1.0 - u) * v * m[j1, i0]
+                + u * v * m[j1, i1]
+            )
+            # split also when the neighbourhood cannot be fitted
+            table, exact = self._localSpline(i0, i1, j0, j1)
+            if exact:
+                spline = Probe._thinPlateEval(
+                    table,
+                    self.xmin + self._xstep * ii,
+                    self.ymin + self._ystep * jj,
+                )
+                if numpy.abs(spline - linear).max() <= self.tolerance:
+                    continue
+            for cell in (
+                (a0, a1, b0, b1)
+                for a0, a1 in zip(xs, xs[1:])
+                for b0, b1 in zip(ys, ys[1:])
+            ):
+                if self._inFootprint(cell):
+                    a0, a1, b0, b1 = cell
+                    cells.append(cell)
+                    nodes.update(((a0, b0), (a1, b0), (a0, b1), (a1, b1)))
+        nodes = {n for n in nodes if not self._probed[n[1], n[0]]}
+
+        self._cells = cells
+        self._pass = list(nodes)
+        if not nodes:
+            self._scanEnd(True, True)
+            return []
+        return self._scanNodes(nodes)
+
+    # ----------------------------------------------------------------------
+    # Cancel a running footprint or adaptive scan, the nodes probed so far
+    # are kept and the rest are left unfilled
+    # ----------------------------------------------------------------------
+    def scanCancel(self):
+        if self._probed is not None:
+            self._scanEnd(False)
+
+    # ----------------------------------------------------------------------
+    # Spline of the probed nodes of a cell and of its 8 neighbours
+    # @return table, exact like _thinPlateSolve
+    # ----------------------------------------------------------------------
+    def _localSpline(self, i0, i1, j0, j1):
+        a0 = max(0, 2 * i0 - i1)
+        a1 = min(self.xn - 1, 2 * i1 - i0)
+        b0 = max(0, 2 * j0 - j1)
+        b1 = min(self.yn - 1, 2 * j1 - j0)
+        j, i = numpy.nonzero(self._probed[b0:b1 + 1, a0:a1 + 1])
+        i += a0
+        j += b0
+        xy = numpy.column_stack((
+            self.xmin + self._xstep * i,
+            self.ymin + self._ystep * j,
+        ))
+        return Probe._thinPlateSolve(xy, self.matrix[j, i])
+
+    # ----------------------------------------------------------------------
+    # Fill the nodes not probed. The nodes needed by the footprint from
+    # the spline if requested, the rest with the nearest probed value
+    # ----------------------------------------------------------------------
+    def _scanEnd(self, fill, spline=False):
+        probed = self._probed
+        if probed is None:
+            return
+        known = probed.copy()
+        if fill and spline:
+            j, i = numpy.nonzero(self._footprintNodes() & ~known)
+            if len(i):
+                table = self._thinPlateFit(
+                    {(x, y): z for x, y, z in self.points})
+                self.matrix[j, i] = Probe._thinPlateEval(
+                    table,
+                    self.xmin + self._xstep * i,
+                    self.ymin + self._ystep * j,
+                )
+                known[j, i] = True
+        if fill and probed.any():
+            j, i = numpy.nonzero(~known)
+            pj, pi = numpy.nonzero(probed)
+            for k in range(0, len(i), 1024):
+                dx = (i[k:k + 1024, None] - pi[None, :]) * self._xstep
+                dy = (j[k:k + 1024, None] - pj[None, :]) * self._ystep
+                near = numpy.argmin(dx * dx + dy * dy, axis=1)
+                self.matrix[j[k:k + 1024], i[k:k + 1024]] = self.matrix[
+                    pj[near], pi[near]]
+        self._probed = None
+        self._cells = []
+        self._pass = []
+        self._planned = 0
+        self._table = None
+        self.start = False
+
     # ----------------------------------------------------------------------
     # Add a probed point to the list and the 3D matrix
     # ----------------------------------------------------------------------
@@ -327,13 +715,21 @@ class Probe:
         if rem > self._ystep / 10.0:
             return
 
+        probed = self._probed  # the scan may be cancelled meanwhile
         try:
-            self.matrix[int(j)][int(i)] = z
+            self.matrix[int(j), int(i)] = z
             self.points.append([x, y, z])
+            self._table = None
+            if probed is not None:
+                probed[int(j), int(i)] = True
         except IndexError:
             pass
 
-        if len(self.points) >= self.xn * self.yn:
+        if self._planned:
+            if len(self.points) >= self._planned:
+                self._scanEnd(True)
+        elif probed is None and len(self.points) >= self.xn * self.yn:
+            # an adaptive scan is ended by scanNext()
             self.start = False
 
     # ----------------------------------------------------------------------
@@ -347,16 +743,19 @@ class Probe:
         zero = self.interpolate(x, y)
         self.xstep()
         self.ystep()
-        for j, row in enumerate(self.matrix):
+        self.matrix -= zero
+        self._table = None
+        for j, row in enumerate(self.matrix.tolist()):
             y = self.ymin + self._ystep * j
-            for i in range(len(row)):
+            for i, z in enumerate(row):
                 x = self.xmin + self._xstep * i
-                row[i] -= zero
-                self.points.append([x, y, row[i]])
+                self.points.append([x, y, z])
         self.zeroed = True
 
     # ----------------------------------------------------------------------
     def interpolate(self, x, y):
+        if self.interpolation != BILINEAR:
+            return float(self.interpolate_many([x], [y])[0])
         ix = (x - self.xmin) / self._xstep
         jy = (y - self.ymin) / self._ystep
         i = int(math.floor(ix))
@@ -377,13 +776,197 @@ class Probe:
         a1 = 1.0 - a
         b1 = 1.0 - b
 
+        m = self.matrix
+        return float(
+            a1 * b1 * m[j, i]
+            + a1 * b * m[j + 1, i]
+            + a * b1 * m[j, i + 1]
+            + a * b * m[j + 1, i + 1]
+        )
+
+    # ----------------------------------------------------------------------
+    # Interpolate the Z correction on many points, xs and ys are arrays
+    # ----------------------------------------------------------------------
+    def interpolate_many(self, xs, ys):
+        if self.interpolation == BICUBIC:
+            return self._bicubic(xs, ys)
+        elif self.interpolation == THINPLATE:
+            return self._thinPlate(xs, ys)
+        return self._bilinear(self.matrix, xs, ys)
+
+    # ----------------------------------------------------------------------
+    # Bilinear interpolation of the grid of values m
+    # ----------------------------------------------------------------------
+    def _bilinear(self, m, xs, ys):
+        ix = (numpy.asarray(xs, dtype=float) - self.xmin) / self._xstep
+        jy = (numpy.asarray(ys, dtype=float) - self.ymin) / self._ystep
+        i = numpy.clip(numpy.floor(ix), 0, self.xn - 2).astype(int)
+        j = numpy.clip(numpy.floor(jy), 0, self.yn - 2).astype(int)
+
+        a = ix - i
+        b = jy - j
+        a1 = 1.0 - a
+        b1 = 1.0 - b
+
         return (
-            a1 * b1 * self.matrix[j][i]
-            + a1 * b * self.matrix[j + 1][i]
-            + a * b1 * self.matrix[j][i + 1]
-            + a * b * self.matrix[j + 1][i + 1]
+            a1 * b1 * m[j, i]
+            + a1 * b * m[j + 1, i]
+            + a * b1 * m[j, i + 1]
+            + a * b * m[j + 1, i + 1]
         )
 
+    # ----------------------------------------------------------------------
+    # Bicubic interpolation using the derivatives of the grid. The
+    # coefficients of every cell are calculated once in a table.
+    # Outside the grid the value of the border is extended
+    # ----------------------------------------------------------------------
+    def _bicubic(self, xs, ys):
+        if self._table is None:
+            f = self.matrix
+            fx = numpy.gradient(f, axis=1)
+            fy = numpy.gradient(f, axis=0)
+            fxy = numpy.gradient(fx, axis=0)
+            # values and derivatives at the 4 corners of every cell
+            # first index along x, second along y
+            F = numpy.empty((self.yn - 1, self.xn - 1, 4, 4))
+            for a, v in enumerate((f, fy, fx, fxy)):
+                r, c = divmod(a, 2)
+                F[:, :, 2 * r, 2 * c] = v[:-1, :-1]
+                F[:, :, 2 * r, 2 * c + 1] = v[1:, :-1]
+                F[:, :, 2 * r + 1, 2 * c] = v[:-1, 1:]
+                F[:, :, 2 * r + 1, 2 * c + 1] = v[1:, 1:]
+            M = numpy.array([
+                [1.0, 0.0, 0.0, 0.0],
+                [0.0, 0.0, 1.0, 0.0],
+                [-3.0, 3.0, -2.0, -1.0],
+                [2.0, -2.0, 1.0, 1.0],
+            ])
+            self._table = M @ F @ M.T
+
+        ix = (numpy.asarray(xs, dtype=float) - self.xmin) / self._xstep
+        jy = (numpy.asarray(ys, dtype=float) - self.ymin) / self._ystep
+        ix = numpy.clip(ix, 0.0, self.xn - 1)
+        jy = numpy.clip(jy, 0.0, self.yn - 1)
+        i = numpy.minimum(numpy.floor(ix), self.xn - 2).astype(int)
+        j = numpy.minimum(numpy.floor(jy), self.yn - 2).astype(int)
+        u = (ix - i)[:, None] ** numpy.arange(4)
+        v = (jy - j)[:, None] ** numpy.arange(4)
+        return numpy.einsum("ni,nij,nj->n", u, self._table[j, i], v)
+
+    # ----------------------------------------------------------------------
+    # Thin-plate spline passing through all the probed points. The weights
+    # are solved once, then every point costs a sum over the probed ones.
+    # A spline fitted on a subset of the points is corrected with the
+    # bilinear interpolation of its residual on the grid
+    # ----------------------------------------------------------------------
+    def _thinPlate(self, xs, ys):
+        if self._table is None:
+            # last probe wins on the same location
+            points = {(x, y): z for x, y, z in self.points}
+            if not points:
+                for j in range(self.yn):
+                    y = self.ymin + self._ystep * j
+                    for i in range(self.xn):
+                        x = self.xmin + self._xstep * i
+                        points[x, y] = self.matrix[j, i]
+            table = self._thinPlateFit(points)
+            residual = None
+            if len(table[0]) < len(points):
+                j, i = numpy.indices(self.matrix.shape)
+                residual = self.matrix - Probe._thinPlateEval(
+                    table,
+                    (self.xmin + self._xstep * i).ravel(),
+                    (self.ymin + self._ystep * j).ravel(),
+                ).reshape(self.matrix.shape)
+            self._table = table, residual
+        table, residual = self._table
+        z = Probe._thinPlateEval(table, xs, ys)
+        if residual is not None:
+            z += self._bilinear(residual, xs, ys)
+        return z
+
+    # ----------------------------------------------------------------------
+    # Fit the spline through the points {(x,y): z}, through an evenly
+    # spread subset of THINPLATE_POINTS if there are more. A degenerate
+    # fit is reported in warning
+    # ----------------------------------------------------------------------
+    def _thinPlateFit(self, points):
+        xy = numpy.array(list(points.keys()), dtype=float)
+        z = numpy.array(list(points.values()), dtype=float)
+        if len(xy) > THINPLATE_POINTS:
+            keep = Probe._spread(xy, THINPLATE_POINTS)
+            xy = xy[keep]
+            z = z[keep]
+        table, exact = Probe._thinPlateSolve(xy, z)
+        if not exact:
+            self.warning = _(
+                "Probe points are collinear, the thin-plate spline is "
+                "a least squares approximation"
+            )
+        return table
+
+    # ----------------------------------------------------------------------
+    # Return the indices of at most limit points, one for every square of
+    # a grid over them
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def _spread(xy, limit):
+        lo = xy.min(axis=0)
+        span = xy.max(axis=0) - lo
+        h = max(math.sqrt(span[0] * span[1] / limit), span.max() / limit)
+        while True:
+            cells = numpy.floor((xy - lo) / h).astype(int)
+            keep = numpy.unique(cells, axis=0, return_index=True)[1]
+            if len(keep) <= limit:
+                return numpy.sort(keep)
+            h *= 1.2
+
+    # ----------------------------------------------------------------------
+    # Solve the weights of the spline through the points xy with values z
+    # @return (xy, weights), False if singular and approximated instead
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def _thinPlateSolve(xy, z):
+        n = len(xy)
+        A = numpy.zeros((n + 3, n + 3))
+        A[:n, :n] = Probe._kernel(xy, xy)
+        A[:n, n] = 1.0
+        A[:n, n + 1:] = xy
+        A[n, :n] = 1.0
+        A[n + 1:, :n] = xy.T
+        b = numpy.zeros(n + 3)
+        b[:n] = z
+        # collinear points leave the plane undetermined, the solve may
+        # not fail on it but rounding errors give a random tilt
+        if n >= 3 and numpy.linalg.matrix_rank(xy - xy.mean(axis=0)) == 2:
+            try:
+                return (xy, numpy.linalg.solve(A, b)), True
+            except numpy.linalg.LinAlgError:
+                pass
+        return (xy, numpy.linalg.lstsq(A, b, rcond=None)[0]), False
+
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def _thinPlateEval(table, xs, ys):
+        xy, w = table
+        n = len(xy)
+        p = numpy.column_stack((
+            numpy.asarray(xs, dtype=float), numpy.asarray(ys, dtype=float)
+        ))
+        z = w[n] + p @ w[n + 1:]
+        # limit the memory of the distance matrix
+        for k in range(0, len(p), 4096):
+            z[k:k + 4096] += Probe._kernel(p[k:k + 4096], xy) @ w[:n]
+        return z
+
+    # ----------------------------------------------------------------------
+    # Thin-plate spline kernel r^2 log(r) between two arrays of points
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def _kernel(a, b):
+        r2 = ((a[:, None, :] - b[None, :, :]) ** 2).sum(axis=2)
+        return 0.5 * r2 * numpy.log(numpy.where(r2 > 0.0, r2, 1.0))
+
     # ----------------------------------------------------------------------
     # Split line into multiple segments correcting for Z if needed
     # return only end points
@@ -458,6 +1041,122 @@ class Probe:
         segments.append((x2, y2, z2 + self.interpolate(x2, y2)))
         return segments
 
+    # ----------------------------------------------------------------------
+    # Split all the segments of a path like splitLine
+    # return the end points of every segment, without the starting point
+    # ----------------------------------------------------------------------
+    def splitPath(self, xyz):
+        p = numpy.array(xyz, dtype=float)
+        return self.splitSegments(p[:-1], p[1:])[0].tolist()
+
+    # ----------------------------------------------------------------------
+    # Split many segments at once, start and end are (n,3) arrays
+    # return the (m,3) array of the corrected end points of all the
+    # sub-segments and the index of the segment each one belongs to
+    # ----------------------------------------------------------------------
+    def splitSegments(self, start, end):
+        points, seg = self._cutSegments(start, end)
+        points[:, 2] += self.interpolate_many(points[:, 0], points[:, 1])
+        return points, seg
+
+    # ----------------------------------------------------------------------
+    # Cut the segments at the grid lines, without correcting Z
+    # ----------------------------------------------------------------------
+    def _cutSegments(self, start, end):
+        d = end - start
+        d[numpy.abs(d) < 1e-10] = 0.0
+        n = len(d)
+
+        # direction cosines along XY plane and slope in Z
+        rxy = numpy.hypot(d[:, 0], d[:, 1])
+        moving = rxy > 0.0
+        d /= numpy.where(moving, rxy, 1.0)[:, None]
+
+        # distance of every grid line crossed by the segments
+        segs = [numpy.arange(n)]
+        ts = [rxy.copy()]  # segment end point
+        rxy *= 0.999999999  # just reduce a bit to avoid precision errors
+        for c, low, step in (
+            (0, self.xmin, self._xstep),
+            (1, self.ymin, self._ystep),
+        ):
+            dc = d[:, c]
+            forward = dc > 1e-10
+            cross = moving & (forward | (dc < -1e-10))
+            g = (start[:, c] - low) / step
+            first = numpy.floor(g) + forward
+            stop = g + rxy * dc / step
+            count = numpy.where(
+                cross, numpy.floor(numpy.abs(stop - first)) + 2, 0
+            ).astype(int)
+            seg = numpy.repeat(numpy.arange(n), count)
+            k = numpy.arange(count.sum()) - numpy.repeat(
+                numpy.cumsum(count) - count, count
+            )
+            k = first[seg] + numpy.where(forward[seg], k, -k)
+            t = (k * step + low - start[seg, c]) / dc[seg]
+            inside = t < rxy[seg]
+            segs.append(seg[inside])
+            ts.append(t[inside])
+
+        seg = numpy.concatenate(segs)
+        t = numpy.concatenate(ts)
+        last = numpy.zeros(len(t), dtype=bool)
+        last[:n] = True
+        order = numpy.lexsort((t, seg))
+        seg = seg[order]
+        t = t[order]
+        last = last[order]
+        # crossing both grid lines at once, within precision errors
+        close = (seg[1:] == seg[:-1]) & (t[1:] - t[:-1] <= 1e-9)
+        keep = numpy.ones(len(t), dtype=bool)
+        keep[1:][close & ~last[1:]] = False
+        keep[:-1][close & last[1:]] = False
+        seg = seg[keep]
+        t = t[keep]
+        last = last[keep]
+
+        points = start[seg] + t[:, None] * d[seg]
+        points[last] = end[seg[last]]
+        return points, seg
+
+    # ----------------------------------------------------------------------
+    # Return the (yn-1,xn-1) mask of the grid cells crossed by the
+    # segments, start and end are (n,3) arrays
+    # ----------------------------------------------------------------------
+    def footprintCells(self, start, end):
+        mask = numpy.zeros((self.yn - 1, self.xn - 1), dtype=bool)
+        if not len(start):
+            return mask
+        points, seg = self._cutSegments(start, end)
+        # the middle of every piece lies inside a single cell
+        before = numpy.empty_like(points)
+        before[1:] = points[:-1]
+        first = numpy.ones(len(seg), dtype=bool)
+        first[1:] = seg[1:] != seg[:-1]
+        before[first] = start[seg[first]]
+        middle = (before + points) / 2.0
+        i = numpy.floor((middle[:, 0] - self.xmin) / self._xstep).astype(int)
+        j = numpy.floor((middle[:, 1] - self.ymin) / self._ystep).astype(int)
+        inside = (i >= 0) & (i < self.xn - 1) & (j >= 0) & (j < self.yn - 1)
+        mask[j[inside], i[inside]] = True
+        return mask
+
+    # ----------------------------------------------------------------------
+    # Return the (yn,xn) mask of the nodes needed by the footprint
+    # ----------------------------------------------------------------------
+    def _footprintNodes(self):
+        nodes = numpy.zeros((self.yn, self.xn), dtype=bool)
+        if self.footprint is None:
+            nodes[:] = True
+        else:
+            f = self.footprint
+            nodes[:-1, :-1] |= f
+            nodes[:-1, 1:] |= f
+            nodes[1:, :-1] |= f
+            nodes[1:, 1:] |= f
+        return nodes
+
 
 # =============================================================================
 # contains a list of machine points vs position in the gcode
@@ -672,7 +1371,9 @@ class CNC:
     travel_y = 300
     travel_z = 60
     accuracy = 0.01  # sagitta error during arc conversion
+    optimize_time = 2.0  # time budget of the rapid moves optimizer (s)
     digits = 4
+    cache = True  # keep the parsed files and their geometry on disk
     startup = "G90"
     stdexpr = False  # standard way of defining expressions with []
     comment = ""  # last parsed comment
@@ -765,6 +1466,17 @@ class CNC:
     # for feed override testing
     # FIXME will not be needed after Grbl v1.0
 
+    # Interpreter variables defining the modal state between lines
+    STATE = (
+        "x", "y", "z", "a", "b", "c",
+        "xval", "yval", "zval", "aval", "bval", "cval",
+        "ival", "jval", "kval", "uval", "vval", "wval",
+        "dx", "dy", "dz", "di", "dj", "dk",
+        "rval", "pval", "qval", "unit", "mval", "lval",
+        "tool", "_lastTool", "absolute", "arcabsolute", "retractz",
+        "gcode", "plane", "feed",
+    )
+
     # ----------------------------------------------------------------------
     def __init__(self):
         self.initPath()
@@ -897,6 +1609,10 @@ class CNC:
             CNC.accuracy = float(config.get(section, "accuracy"))
         except Exception:
             pass
+        try:
+            CNC.optimize_time = float(config.get(section, "optimize_time"))
+        except Exception:
+            pass
         try:
             CNC.digits = int(config.get(section, "round"))
         except Exception:
@@ -906,6 +1622,11 @@ class CNC:
         except Exception:
             pass
 
+        try:
+            CNC.cache = bool(int(config.get(section, "cache")))
+        except Exception:
+            pass
+
         try:
             CNC.startup = config.get(section, "startup")
         except Exception:
@@ -993,8 +1714,23 @@ class CNC:
         self.gcode = None
         self.plane = XY
         self.feed = 0  # Actual gcode feed rate (not to confuse with cutfeed
+        self.dwell = False  # G4 in the current line
         self.totalLength = 0.0
         self.totalTime = 0.0
+        self.planner = None
+
+    # ----------------------------------------------------------------------
+    # Return the modal state of the interpreter as a tuple
+    # ----------------------------------------------------------------------
+    def getState(self):
+        return tuple([getattr(self, name) for name in CNC.STATE])
+
+    # ----------------------------------------------------------------------
+    # Restore the modal state returned by getState()
+    # ----------------------------------------------------------------------
+    def setState(self, state):
+        for name, value in zip(CNC.STATE, state):
+            setattr(self, name, value)
 
     # ----------------------------------------------------------------------
     def resetEnableMargins(self):
@@ -1362,6 +2098,7 @@ class CNC:
     # ----------------------------------------------------------------------
     def motionStart(self, cmds):
         self.mval = 0  # reset m command
+        self.dwell = False
         for cmd in cmds:
             c = cmd[0].upper()
             try:
@@ -1398,7 +2135,9 @@ class CNC:
                 decimal = int(round((value - gcode) * 10))
 
                 # Execute immediately
-                if gcode in (4, 10, 53):
+                if gcode == 4:
+                    self.dwell = True
+                elif gcode in (10, 53):
                     pass  # do nothing but don't record to motion
                 elif gcode == 17:
                     self.plane = XY
@@ -1637,9 +2376,6 @@ class CNC:
 
             xyz.append((self.xval, self.yval, self.zval))
 
-        elif self.gcode == 4:  # Dwell
-            self.totalTime = self.pval
-
         elif self.gcode in (81, 82, 83, 85, 86, 89):  # Canned cycles
             # FIXME Assuming only on plane XY
             if self.absolute:
@@ -1739,30 +2475,87 @@ class CNC:
             p = i
 
         if self.gcode == 0:
-            # FIXME calculate the correct time with the feed direction
-            # and acceleration
-            block.time += length / self.feedmax_x
-            self.totalTime += length / self.feedmax_x
             block.rapid += length
-        elif ((self.gcode == 1 or self.gcode == 2 or self.gcode == 3)
-              and self.feed > 0):
-            block.time += length / self.feed
-            self.totalTime += length / self.feed
         else:
-            try:
-                if CNC.vars["feedmode"] == 94:
-                    # Normal mode
-                    t = length / self.feed
-                elif CNC.vars["feedmode"] == 93:
-                    # Inverse mode
-                    t = length * self.feed
-                block.time += t
-                self.totalTime += t
-            except Exception:
-                pass
             block.length += length
 
         self.totalLength += length
+        return length
+
+    # ----------------------------------------------------------------------
+    # Return the planner settings: maximum rates [units/min],
+    # accelerations [units/s^2] and junction deviation [units], from the
+    # controller $110-$122 and $11 settings when known
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def plannerSettings():
+        def grbl(n, default):
+            try:
+                value = float(CNC.vars[f"grbl_{n}"])
+            except (KeyError, ValueError):
+                return default
+            return value / 25.4 if CNC.inch else value
+
+        rates = (
+            grbl(110, CNC.feedmax_x),
+            grbl(111, CNC.feedmax_y),
+            grbl(112, CNC.feedmax_z),
+        )
+        accelerations = (
+            grbl(120, CNC.acceleration_x),
+            grbl(121, CNC.acceleration_y),
+            grbl(122, CNC.acceleration_z),
+        )
+        junction = grbl(11, 0.01 / 25.4 if CNC.inch else 0.01)
+        return rates, accelerations, junction
+
+    # ----------------------------------------------------------------------
+    # Start estimating the time of the motions with the planner model.
+    # The times [min] are accumulated on the blocks, their lines and total
+    # ----------------------------------------------------------------------
+    def planStart(self):
+        self.totalTime = 0.0
+        self.planner = bplanner.Planner(*CNC.plannerSettings(),
+                                        self._planTime)
+
+    # ----------------------------------------------------------------------
+    def _planTime(self, tag, seconds):
+        block, lid = tag
+        t = seconds / 60.0
+        block.time += t
+        block.addTime(lid, t)
+        self.totalTime += t
+
+    # ----------------------------------------------------------------------
+    # Finish the estimation, the machine stops at the end
+    # ----------------------------------------------------------------------
+    def planEnd(self):
+        if self.planner is not None:
+            self.planner.stop()
+            self.planner = None
+
+    # ----------------------------------------------------------------------
+    # Feed the planner with the motion xyz of length of line lid of block
+    # ----------------------------------------------------------------------
+    def planMotion(self, block, lid, xyz, length):
+        planner = self.planner
+        if planner is None:
+            return
+        tag = (block, lid)
+        if self.dwell:
+            planner.dwell(self.pval, tag)
+        elif self.mval:
+            planner.stop()  # program, spindle, coolant and tool changes
+        if not xyz:
+            return
+        if self.gcode == 0:
+            planner.add(xyz, None, tag)
+        elif self.feed > 0.0:
+            if CNC.vars["feedmode"] == 93:
+                # Inverse mode, the motion lasts 1/feed minutes
+                planner.add(xyz, length * self.feed, tag)
+            else:
+                planner.add(xyz, self.feed, tag)
 
     # ----------------------------------------------------------------------
     def pathMargins(self, block):
@@ -2014,6 +2807,7 @@ class Block(list):
         self.expand = False  # Expand in editor
         self.color = None  # Custom color for path
         self._path = []  # canvas drawing paths
+        self._compiled = None  # cached compiled output
         self.sx = self.sy = self.sz = 0  # start  coordinates
         # (entry point first non rapid motion)
         self.ex = self.ey = self.ez = 0  # ending coordinates
@@ -2027,6 +2821,8 @@ class Block(list):
         self.color = src.color
         self[:] = src[:]
         self._path = []
+        self._time = []
+        self._compiled = None
         self.sx = src.sx
         self.sy = src.sy
         self.sz = src.sz
@@ -2240,6 +3036,12 @@ class Block(list):
                 self._name = pat.group(1)
         list.append(self, line)
 
+    # ----------------------------------------------------------------------
+    # Forget the cached compiled output, block has been modified
+    # ----------------------------------------------------------------------
+    def invalidate(self):
+        self._compiled = None
+
     # ----------------------------------------------------------------------
     def resetPath(self):
         del self._path[:]
@@ -2248,6 +3050,7 @@ class Block(list):
         self.length = 0.0  # cut length
         self.rapid = 0.0  # rapid length
         self.time = 0.0
+        self._time = []  # estimated time of every line
 
     # ----------------------------------------------------------------------
     def hasPath(self):
@@ -2257,6 +3060,21 @@ class Block(list):
     def addPath(self, p):
         self._path.append(p)
 
+    # ----------------------------------------------------------------------
+    def addTime(self, lid, t):
+        if lid >= len(self._time):
+            self._time.extend([0.0] * (lid + 1 - len(self._time)))
+        self._time[lid] += t
+
+    # ----------------------------------------------------------------------
+    # @return the estimated time of line lid [min]
+    # ----------------------------------------------------------------------
+    def lineTime(self, lid):
+        try:
+            return self._time[lid]
+        except IndexError:
+            return 0.0
+
     # ----------------------------------------------------------------------
     def path(self, item):
         try:
@@ -2285,6 +3103,34 @@ class Block(list):
         self.ymax = max(self.ymax, max(i[1] for i in xyz))
         self.zmax = max(self.zmax, max(i[2] for i in xyz))
 
+    # ----------------------------------------------------------------------
+    # Return the geometry calculated while drawing, to be stored in cache
+    # ----------------------------------------------------------------------
+    def geometry(self):
+        return (
+            self.sx, self.sy, self.sz,
+            self.ex, self.ey, self.ez,
+            self.xmin, self.ymin, self.zmin,
+            self.xmax, self.ymax, self.zmax,
+            self.length, self.rapid, self.time,
+            len(self._path), list(self._time),
+        )
+
+    # ----------------------------------------------------------------------
+    # Restore the geometry from cache, with an empty path for every line
+    # ----------------------------------------------------------------------
+    def setGeometry(self, geometry):
+        (
+            self.sx, self.sy, self.sz,
+            self.ex, self.ey, self.ez,
+            self.xmin, self.ymin, self.zmin,
+            self.xmax, self.ymax, self.zmax,
+            self.length, self.rapid, self.time,
+            n, self._time,
+        ) = geometry
+        if len(self._path) != n:
+            self._path = [None] * n
+
 
 # =============================================================================
 # Gcode file
@@ -2311,6 +3157,8 @@ class GCode:
         self.undoredo.reset()
         self._lastModified = 0
         self._modified = False
+        self.cache = None  # cache entry while unmodified since loading
+        self.cacheError = None  # why the cache entry was discarded
 
     # ----------------------------------------------------------------------
     # Recalculate enabled path margins
@@ -2440,13 +3288,110 @@ class GCode:
         self._lastModified = os.stat(self.filename).st_mtime
         self.cnc.initPath()
         self.cnc.resetAllMargins()
+        cache = self.loadCache()
+        if cache is not None:
+            f.close()
+            self.blocks = [Block.load(obj) for obj in cache["blocks"]]
+            self.cache = cache
+            return True
         self._blocksExist = False
         for line in f:
             self._addLine(line[:-1].replace("\x0d", ""))
         self._trim()
         f.close()
+        if CNC.cache:
+            self.cache = {
+                "key": self.cacheKey(),
+                "blocks": [
+                    (b.name(), b.enable, b.expand, b.color, list(b))
+                    for b in self.blocks
+                ],
+            }
+            self.saveCache()
         return True
 
+    # ----------------------------------------------------------------------
+    # Key identifying the file contents and the settings used to parse it
+    # ----------------------------------------------------------------------
+    def cacheKey(self):
+        st = os.stat(self.filename)
+        return (
+            CACHE_VERSION,
+            os.path.abspath(self.filename),
+            st.st_mtime,
+            st.st_size,
+            CNC.accuracy,
+            CNC.inch,
+            CNC.drillPolicy,
+            CNC.stdexpr,
+        )
+
+    # ----------------------------------------------------------------------
+    def _cacheFile(self, filename=None):
+        if filename is None:
+            filename = os.path.abspath(self.filename)
+        name = hashlib.sha1(filename.encode())
+        return os.path.join(CACHE_DIR, f"{name.hexdigest()}.cache")
+
+    # ----------------------------------------------------------------------
+    # Return the cache entry of the file if still valid. An entry that
+    # cannot be read is discarded and the reason left in cacheError
+    # ----------------------------------------------------------------------
+    def loadCache(self):
+        self.cacheError = None
+        if not CNC.cache:
+            return None
+        filename = self._cacheFile()
+        try:
+            with open(filename, "rb") as f:
+                cache = pickle.load(f)
+            if cache["key"] == self.cacheKey():
+                os.utime(filename)
+                return cache
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            self.cacheError = f"{type(e).__name__}: {e}"
+        return None
+
+    # ----------------------------------------------------------------------
+    # Write the cache entry and remove the least recently used files
+    # @param cache  entry to write instead of the current one
+    # ----------------------------------------------------------------------
+    def saveCache(self, cache=None):
+        if cache is None:
+            cache = self.cache
+        if cache is None:
+            return
+        filename = self._cacheFile(cache["key"][1])
+        tmp = None
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            # the GUI and the path evaluator thread may save at once,
+            # each one writes its own temporary file
+            with tempfile.NamedTemporaryFile(
+                dir=CACHE_DIR, suffix=".tmp", delete=False
+            ) as f:
+                tmp = f.name
+                pickle.dump(cache, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, filename)
+            tmp = None
+            files = sorted(
+                (os.path.join(CACHE_DIR, x) for x in os.listdir(CACHE_DIR)
+                 if x.endswith(".cache")),
+                key=os.path.getmtime,
+            )
+            for old in files[:-CACHE_FILES]:
+                os.remove(old)
+        except OSError:
+            pass
+        finally:
+            if tmp is not None:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+
     # ----------------------------------------------------------------------
     # Save to a file
     # ----------------------------------------------------------------------
@@ -3224,6 +4169,7 @@ class GCode:
             return
         self.undoredo.add(undoinfo, msg)
         self._modified = True
+        self.cache = None
 
     # ----------------------------------------------------------------------
     def canUndo(self):
@@ -3259,6 +4205,7 @@ class GCode:
     def setLineUndo(self, bid, lid, line):
         undoinfo = (self.setLineUndo, bid, lid, self.blocks[bid][lid])
         self.blocks[bid][lid] = line
+        self.blocks[bid].invalidate()
         return undoinfo
 
     # ----------------------------------------------------------------------
@@ -3271,6 +4218,7 @@ class GCode:
             block.append(line)
         else:
             block.insert(lid, line)
+        block.invalidate()
         return undoinfo
 
     # ----------------------------------------------------------------------
@@ -3286,6 +4234,7 @@ class GCode:
         block = self.blocks[bid]
         undoinfo = (self.insLineUndo, bid, lid, block[lid])
         del block[lid]
+        block.invalidate()
         return undoinfo
 
     # ----------------------------------------------------------------------
@@ -3476,6 +4425,7 @@ class GCode:
         undoinfo = (self.setBlockLinesUndo, bid, block[:])
         del block[:]
         block.extend(lines)
+        block.invalidate()
         return undoinfo
 
     # ----------------------------------------------------------------------
@@ -3487,6 +4437,7 @@ class GCode:
         block = self.blocks[bid]
         undoinfo = (self.orderDownLineUndo, bid, lid - 1)
         block.insert(lid - 1, block.pop(lid))
+        block.invalidate()
         return undoinfo
 
     # ----------------------------------------------------------------------
@@ -3498,13 +4449,77 @@ class GCode:
             return None
         undoinfo = (self.orderUpLineUndo, bid, lid + 1)
         block.insert(lid + 1, block.pop(lid))
+        block.invalidate()
         return undoinfo
 
+    # ----------------------------------------------------------------------
+    # Restrict the probe scan to the grid cells crossed by the cutting
+    # motions of the enabled blocks
+    # ----------------------------------------------------------------------
+    def probeFootprint(self):
+        start = []
+        end = []
+        self.initPath()
+        for block in self.blocks:
+            if not block.enable:
+                continue
+            for line in block:
+                cmds = CNC.compileLine(line)
+                if not isinstance(cmds, str):
+                    continue
+                self.cnc.motionStart(CNC.breakLine(cmds))
+                if self.cnc.gcode in (1, 2, 3):
+                    xyz = self.cnc.motionPath()
+                    start.extend(xyz[:-1])
+                    end.extend(xyz[1:])
+                self.cnc.motionEnd()
+        self.probe.setFootprint(self.probe.footprintCells(
+            numpy.array(start, dtype=float).reshape(-1, 3),
+            numpy.array(end, dtype=float).reshape(-1, 3),
+        ))
+
+    # ----------------------------------------------------------------------
+    # Split with the probe grid all the motions of a block at once
+    # motions is a list of (xyz, g, extra, unit) with the path of each motion
+    # @return a list with the autolevelled lines of every motion
+    # ----------------------------------------------------------------------
+    def autolevelMotions(self, motions):
+        start = []
+        end = []
+        owner = []
+        for k, (xyz, g, extra, unit) in enumerate(motions):
+            start.extend(xyz[:-1])
+            end.extend(xyz[1:])
+            owner.extend([k] * (len(xyz) - 1))
+        points, seg = self.probe.splitSegments(
+            numpy.array(start, dtype=float), numpy.array(end, dtype=float)
+        )
+        owner = numpy.array(owner)[seg]
+        bounds = numpy.searchsorted(owner, numpy.arange(len(motions) + 1))
+        unit = numpy.array([m[3] for m in motions])[owner]
+        # same as fmt() on all the coordinates at once
+        points = numpy.round(points / unit[:, None], CNC.digits).tolist()
+
+        def fmt(c, v):
+            return f"{c}{v:f}".rstrip("0").rstrip(".")
+
+        result = []
+        for k, (xyz, g, extra, unit) in enumerate(motions):
+            lines = []
+            for x, y, z in points[bounds[k]:bounds[k + 1]]:
+                lines.append(
+                    f"G{int(g)}{fmt('X', x)}{fmt('Y', y)}{fmt('Z', z)}{extra}"
+                )
+                extra = ""
+            result.append(lines)
+        return result
+
     # ----------------------------------------------------------------------
     # Expand block with autolevel information
     # ----------------------------------------------------------------------
     def autolevelBlock(self, block):
         new = []
+        motions = []
         autolevel = not self.probe.isEmpty()
         for line in block:
             cmds = CNC.compileLine(line)
@@ -3531,29 +4546,27 @@ class GCode:
                         if (c[0].upper() not in
                                 ("G", "X", "Y", "Z", "I", "J", "K", "R")):
                             extra += c
-                    x1, y1, z1 = xyz[0]
                     if self.cnc.gcode == 0:
                         g = 0
                     else:
                         g = 1
-                    for x2, y2, z2 in xyz[1:]:
-                        for x, y, z in self.probe.splitLine(x1, y1, z1, x2,
-                                                            y2, z2):
-                            new.append(
-                                "".join([
-                                    f"G{int(g)}",
-                                    f"{self.fmt('X', x / self.cnc.unit)}",
-                                    f"{self.fmt('Y', y / self.cnc.unit)}",
-                                    f"{self.fmt('Z', z / self.cnc.unit)}",
-                                    extra,
-                                ])
-                            )
-                            extra = ""
-                        x1, y1, z1 = x2, y2, z2
+                    # placeholder for the lines split at the end
+                    motions.append((xyz, g, extra, self.cnc.unit))
+                    new.append(None)
                 self.cnc.motionEnd()
             else:
                 self.cnc.motionEnd()
                 new.append(line)
+
+        if motions:
+            split = iter(self.autolevelMotions(motions))
+            lines = new
+            new = []
+            for line in lines:
+                if line is None:
+                    new.extend(next(split))
+                else:
+                    new.append(line)
         return new
 
     # ----------------------------------------------------------------------
@@ -4052,7 +5065,8 @@ class GCode:
                         # compensate for cutter diameter if needed
                         if isloffset:
                             islandPath = islandPath.offsetClean(
-                                CNC.vars["diameter"] / 2
+                                CNC.vars["diameter"] / 2,
+                                accuracy=CNC.accuracy
                             )[0]
                         islandPath._inside = islz
                         islandPaths.append(islandPath)
@@ -4220,36 +5234,44 @@ class GCode:
     # ----------------------------------------------------------------------
     def reverse(self, items):
         undoinfo = []
-        remove = ["cut", "climb", "conventional", "cw", "ccw", "reverse"]
         for bid in items:
-            operation = "reverse"
-
-            if self.blocks[bid].name() in ("Header", "Footer"):
-                continue
-            newpath = Path(self.blocks[bid].name())
-
-            # Not sure if this is good idea...
-            # Might get confusing if something goes wrong,
-            # but seems to work fine
-            if self.blocks[bid].operationTest("conventional"):
-                operation += ",climb"
-            if self.blocks[bid].operationTest("climb"):
-                operation += ",conventional"
-            if self.blocks[bid].operationTest("cw"):
-                operation += ",ccw"
-            if self.blocks[bid].operationTest("ccw"):
-                operation += ",cw"
-
-            for path in self.toPath(bid):
-                path.invert()
-                newpath.extend(path)
-            if newpath:
-                block = self.fromPath(newpath)
-                undoinfo.append(
-                    self.addBlockOperationUndo(bid, operation, remove))
-                undoinfo.append(self.setBlockLinesUndo(bid, block))
+            undoinfo.extend(self.reverseBlockUndo(bid))
         self.addUndo(undoinfo)
 
+    # ----------------------------------------------------------------------
+    # Reverse direction of cut of a single block
+    # ----------------------------------------------------------------------
+    def reverseBlockUndo(self, bid):
+        undoinfo = []
+        remove = ["cut", "climb", "conventional", "cw", "ccw", "reverse"]
+        operation = "reverse"
+
+        if self.blocks[bid].name() in ("Header", "Footer"):
+            return undoinfo
+        newpath = Path(self.blocks[bid].name())
+
+        # Not sure if this is good idea...
+        # Might get confusing if something goes wrong,
+        # but seems to work fine
+        if self.blocks[bid].operationTest("conventional"):
+            operation += ",climb"
+        if self.blocks[bid].operationTest("climb"):
+            operation += ",conventional"
+        if self.blocks[bid].operationTest("cw"):
+            operation += ",ccw"
+        if self.blocks[bid].operationTest("ccw"):
+            operation += ",cw"
+
+        for path in self.toPath(bid):
+            path.invert()
+            newpath.extend(path)
+        if newpath:
+            block = self.fromPath(newpath)
+            undoinfo.append(
+                self.addBlockOperationUndo(bid, operation, remove))
+            undoinfo.append(self.setBlockLinesUndo(bid, block))
+        return undoinfo
+
     # ----------------------------------------------------------------------
     # Change cut direction
     # 1     CW
@@ -4401,7 +5423,8 @@ class GCode:
                             msg += "\n"
                         msg += m
 
-                opath = path.offsetClean(offset, overcut, newname)
+                opath = path.offsetClean(offset, overcut, newname,
+                                         CNC.accuracy)
                 if opath:
                     newpath.extend(opath)
             if newpath:
@@ -4436,66 +5459,27 @@ class GCode:
         return msg
 
     # ----------------------------------------------------------------------
-    # Generate a pocket path
+    # Generate the pockets of a list of (path, diameter) in parallel.
+    # The workers are spawned, forking the GUI with its threads is unsafe
     # ----------------------------------------------------------------------
-    def _pocket(self, path, diameter, stepover, depth):
-        # FIXME: recursions are slow and shall be avoided! Replace recursion
-        #        via a loop!
-
-        # python's internal recursion limit hit us before bCNC's
-        # limit came to place
-        # so i increased python's limit to bCNC's limit + 100
-        maxdepth = 10000
-        import sys
-
-        sys.setrecursionlimit(max(sys.getrecursionlimit(), maxdepth + 100))
-
-        newpath = []
-        if depth > maxdepth:
-            return None
-        if depth == 0:
-            offset = diameter / 2.0
-        else:
-            offset = diameter * stepover
-
-        opath = path.offset(offset)
-
-        if not opath:
-            return None
-
-        opath.intersectSelf()
-        opath.removeExcluded(path, offset)
-        opath.removeZeroLength(abs(offset) / 100.0)
-        opath = opath.split2contours()
-
-#        if not opath:
-#            return None
-        if opath:
-            for pout in opath:
-                pin = self._pocket(pout, diameter, stepover, depth + 1)
-                if not pin:
-                    newpath.append(pout)
-
-                # else: # FIXME
-                # 1. Find closest node that we can move with
-                #    a straight line without intersecting the path
-                # 2. rotate the pout to start from this node
-                # 3. join with a normal line
-                # else
-                # join with a rapid move as a separate path
-                elif len(pin) == 1:
-                    # FIXME maybe it is dangerous!!
-                    # Have to check before making a straight move
-                    pin[0].join(pout)
-                    newpath.append(pin[0])
-
-                else:
-                    # FIXME needs to check if we can go in normal move
-                    # needs to find the closest segment and rotate
-                    # pin[-1].join(pout)
-                    newpath.extend(pin)
-                    newpath.append(pout)
-        return newpath
+    @staticmethod
+    def _pocketPaths(jobs, stepover):
+        workers = min(len(jobs), os.cpu_count() or 1)
+        if workers > 1 and sum(len(p) for p, d in jobs) >= POCKET_POOL:
+            try:
+                with ProcessPoolExecutor(
+                    workers, mp_context=multiprocessing.get_context("spawn")
+                ) as pool:
+                    futures = [pool.submit(path.pocket, diameter, stepover,
+                                           accuracy=CNC.accuracy)
+                               for path, diameter in jobs]
+                    return [future.result() for future in futures]
+            except (OSError, BrokenProcessPool, pickle.PicklingError) as e:
+                sys.stderr.write(
+                    _(">>> Parallel pocket failed, running serially: {}\n")
+                    .format(e))
+        return [path.pocket(diameter, stepover, accuracy=CNC.accuracy)
+                for path, diameter in jobs]
 
     # ----------------------------------------------------------------------
     # make a pocket on block
@@ -4505,10 +5489,13 @@ class GCode:
         undoinfo = []
         msg = ""
         newblocks = []
+        bids = []
+        jobs = []  # paths to pocket with their tool diameter
+        owners = []  # block of every job
         for bid in reversed(blocks):
             if self.blocks[bid].name() in ("Header", "Footer"):
                 continue
-            newpath = []
+            bids.append(bid)
             for path in self.toPath(bid):
                 if not path.isClosed():
                     m = f"Path: '{path.name}' is OPEN"
@@ -4547,8 +5534,16 @@ class GCode:
                 else:
                     path.name = Block.operationName(path.name, name, remove)
 
-                newpath.extend(self._pocket(path, -D * diameter, stepover, 0))
+                jobs.append((path, -D * diameter))
+                owners.append(bid)
+
+        newpaths = {bid: [] for bid in bids}
+        for bid, pocket in zip(owners, self._pocketPaths(jobs, stepover)):
+            if pocket:
+                newpaths[bid].extend(pocket)
 
+        for bid in bids:
+            newpath = newpaths[bid]
             if newpath:
                 # remember length to shift all new blocks
                 # the are inserted before
@@ -4728,12 +5723,15 @@ class GCode:
                 D = path.direction()
                 if D == 0:
                     D = 1
-                opath = path.offset(D * offset, newname)
-                if opath:
-                    opath.intersectSelf()
-                    opath.removeExcluded(path, D * offset)
-                    opath.removeZeroLength(abs(offset) / 100.0)
-                opath = opath.split2contours()
+                if path.isClosed():
+                    opath = path.offsetClip(D * offset, CNC.accuracy, newname)
+                else:
+                    opath = path.offset(D * offset, newname)
+                    if opath:
+                        opath.intersectSelf()
+                        opath.removeExcluded(path, D * offset)
+                        opath.removeZeroLength(abs(offset) / 100.0)
+                    opath = opath.split2contours()
                 if opath:
                     for p in opath:
                         p.two_bit_adaptative_cut(
@@ -5059,50 +6057,24 @@ class GCode:
         pass
 
     # ----------------------------------------------------------------------
-    # Re-arrange using genetic algorithms a set of blocks to minimize
-    # rapid movements.
+    # Re-arrange a set of blocks to minimize rapid movements, optionally
+    # reversing the direction of the blocks. The first block stays first
     # ----------------------------------------------------------------------
-    def optimize(self, items):
-        n = len(items)
-
-        matrix = []
-        for i in range(n):
-            matrix.append([0.0] * n)
+    def optimize(self, items, reverse=False):
+        starts = []
+        ends = []
+        for bid in items:
+            block = self.blocks[bid]
+            # Compensate for machines, which have different
+            # speed of X and Y:
+            starts.append((block.sx / CNC.feedmax_x, block.sy / CNC.feedmax_y))
+            ends.append((block.ex / CNC.feedmax_x, block.ey / CNC.feedmax_y))
 
-        # Find distances between blocks (end to start)
-        for i in range(n):
-            block = self.blocks[items[i]]
-            x1 = block.ex
-            y1 = block.ey
-            for j in range(n):
-                if i == j:
-                    continue
-                block = self.blocks[items[j]]
-                x2 = block.sx
-                y2 = block.sy
-                dx = x1 - x2
-                dy = y1 - y2
-                # Compensate for machines, which have different
-                # speed of X and Y:
-                dx /= CNC.feedmax_x
-                dy /= CNC.feedmax_y
-                matrix[i][j] = sqrt(dx * dx + dy * dy)
-
-        best = [0]
-        unvisited = list(range(1, n))
-        while unvisited:
-            last = best[-1]
-            row = matrix[last]
-            # from all the unvisited places search the closest one
-            mindist = 1e30
-            for i, u in enumerate(unvisited):
-                d = row[u]
-                if d < mindist:
-                    mindist = d
-                    si = i
-            best.append(unvisited.pop(si))
+        best, flipped = btour.tour(starts, ends, reverse, CNC.optimize_time)
 
         undoinfo = []
+        for i in flipped:
+            undoinfo.extend(self.reverseBlockUndo(items[i]))
         for i in range(len(best)):
             b = best[i]
             if i == b:
@@ -5113,155 +6085,267 @@ class GCode:
         self.addUndo(undoinfo, "Optimize")
 
     # ----------------------------------------------------------------------
-    # Use probe information to modify the g-code to autolevel
+    # @return the global settings that the compiled output depends on
     # ----------------------------------------------------------------------
-    def compile(self, queue, stopFunc=None):
-        paths = []
-
-        def add(line, path):
-            if line is not None:
-                if isinstance(line, str):
-                    queue.put(line + "\n")
-                else:
-                    queue.put(line)
-            paths.append(path)
+    def compileSettings(self):
+        if self.probe.isEmpty():
+            probe = None
+        else:
+            probe = (
+                self.probe.xmin,
+                self.probe.ymin,
+                self.probe._xstep,
+                self.probe._ystep,
+                self.probe.matrix.tobytes(),
+                self.probe.interpolation,
+            )
+        return (
+            CNC.inch,
+            CNC.digits,
+            CNC.accuracy,
+            CNC.drillPolicy,
+            CNC.toolPolicy,
+            CNC.appendFeed,
+            CNC.stdexpr,
+            CNC.vars["running"],
+            tuple(sorted(ERROR_HANDLING.items())),
+            probe,
+        )
 
-        autolevel = not self.probe.isEmpty()
-        self.initPath()
-        for line in CNC.compile(self.cnc.startup.splitlines()):
-            add(line, None)
+    # ----------------------------------------------------------------------
+    # Compile a single block starting from the current modal state of cnc
+    # The output is cached in the block as long as the block lines, the
+    # modal state at the entry and the global settings remain the same
+    # @param cnc    CNC instance tracking the modal state, default self.cnc
+    # @param lines  lines to compile in place of the block lines (a copy)
+    # @param cache  store the output in the block, otherwise a valid cached
+    #               output is only reused
+    # @return list of (line, lid) pairs or None if the compile was aborted
+    # ----------------------------------------------------------------------
+    def compileBlock(self, block, settings=None, stopFunc=None, cnc=None,
+                     lines=None, cache=True):
+        if settings is None:
+            settings = self.compileSettings()
+        if cnc is None:
+            cnc = self.cnc
+        if lines is None:
+            lines = block
+        state = cnc.getState()
+
+        cached = block._compiled
+        if (cached is not None
+                and cached[1] == state
+                and cached[2] == settings
+                and list.__eq__(lines, cached[0])):
+            cnc.setState(cached[4])
+            return cached[3]
+
+        out = []
+        motions = []
+        cacheable = True
+
+        def add(line, lid):
+            out.append((line, lid))
+
+        autolevel = settings[-1] is not None
+        every = 50
+        for j, line in enumerate(lines):
+            every -= 1
+            if every <= 0:
+                if stopFunc is not None and stopFunc():
+                    return None
+                every = 50
 
-        every = 1
-        for i, block in enumerate(self.blocks):
-            if not block.enable:
+            newcmd = []
+            cmds = CNC.compileLine(line)
+            if cmds is None:
                 continue
-            for j, line in enumerate(block):
-                every -= 1
-                if every <= 0:
-                    if stopFunc is not None and stopFunc():
-                        return None
-                    every = 50
-
-                newcmd = []
-                cmds = CNC.compileLine(line)
-                if cmds is None:
-                    continue
-                elif isinstance(cmds, str):
-                    cmds = CNC.breakLine(cmds)
+            elif isinstance(cmds, str):
+                cmds = CNC.breakLine(cmds)
+            else:
+                # either CodeType or tuple, list[] append at it as is
+                if (isinstance(cmds, types.CodeType)
+                        or isinstance(cmds, int)):
+                    add(cmds, None)
                 else:
-                    # either CodeType or tuple, list[] append at it as is
-                    if (isinstance(cmds, types.CodeType)
-                            or isinstance(cmds, int)):
-                        add(cmds, None)
-                    else:
-                        add(cmds, (i, j))
-                    continue
+                    add(cmds, j)
+                continue
 
-                skip = False
-                expand = None
-                self.cnc.motionStart(cmds)
+            skip = False
+            expand = None
+            cnc.motionStart(cmds)
+
+            # FIXME append feed on cut commands. It will be obsolete
+            # in grbl v1.0
+            if CNC.appendFeed and cnc.gcode in (1, 2, 3):
+                # Check is not existing in cmds
+                for c in cmds:
+                    if c[0] in ("f", "F"):
+                        break
+                else:
+                    cmds.append(
+                        self.fmt("F", cnc.feed / cnc.unit))
 
-                # FIXME append feed on cut commands. It will be obsolete
-                # in grbl v1.0
-                if CNC.appendFeed and self.cnc.gcode in (1, 2, 3):
-                    # Check is not existing in cmds
+            if autolevel and cnc.gcode in (0, 1, 2, 3) and cnc.mval == 0:
+                xyz = cnc.motionPath()
+                if not xyz:
+                    # while auto-levelling, do not ignore non-movement
+                    # commands, just append the line as-is
+                    add(line, None)
+                else:
+                    extra = ""
                     for c in cmds:
-                        if c[0] in ("f", "F"):
-                            break
+                        if c[0].upper() not in (
+                            "G",
+                            "X",
+                            "Y",
+                            "Z",
+                            "I",
+                            "J",
+                            "K",
+                            "R",
+                        ):
+                            extra += c
+                    if cnc.gcode == 0:
+                        g = 0
                     else:
-                        cmds.append(
-                            self.fmt("F", self.cnc.feed / self.cnc.unit))
+                        g = 1
+                    # placeholder for the lines split at the end
+                    motions.append((xyz, g, extra, cnc.unit))
+                    add(None, j)
+                cnc.motionEnd()
+                continue
+            else:
+                # FIXME expansion policy here variable needed
+                # Canned cycles
+                if CNC.drillPolicy == 1 and cnc.gcode in (
+                    81,
+                    82,
+                    83,
+                    85,
+                    86,
+                    89,
+                ):
+                    expand = cnc.macroGroupG8X()
+                # Tool change
+                elif cnc.mval == 6:
+                    if CNC.toolPolicy == 0:
+                        pass  # send to grbl
+                    elif CNC.toolPolicy == 1:
+                        skip = True  # skip whole line
+                    elif CNC.toolPolicy >= 2:
+                        # depends on the probing variables, do not cache
+                        cacheable = False
+                        expand = CNC.compile(cnc.toolChange())
+                cnc.motionEnd()
+
+            if expand is not None:
+                for line in expand:
+                    add(line, None)
+                expand = None
+                continue
+            elif skip:
+                skip = False
+                continue
 
-                if (autolevel and self.cnc.gcode in (0, 1, 2, 3)
-                        and self.cnc.mval == 0):
-                    xyz = self.cnc.motionPath()
-                    if not xyz:
-                        # while auto-levelling, do not ignore non-movement
-                        # commands, just append the line as-is
-                        add(line, None)
-                    else:
-                        extra = ""
-                        for c in cmds:
-                            if c[0].upper() not in (
-                                "G",
-                                "X",
-                                "Y",
-                                "Z",
-                                "I",
-                                "J",
-                                "K",
-                                "R",
-                            ):
-                                extra += c
-                        x1, y1, z1 = xyz[0]
-                        if self.cnc.gcode == 0:
-                            g = 0
-                        else:
-                            g = 1
-                        for x2, y2, z2 in xyz[1:]:
-                            for x, y, z in self.probe.splitLine(x1, y1, z1,
-                                                                x2, y2, z2):
-                                add(
-                                    "".join([
-                                        f"G{int(g)}",
-                                        f"{self.fmt('X', x / self.cnc.unit)}",
-                                        f"{self.fmt('Y', y / self.cnc.unit)}",
-                                        f"{self.fmt('Z', z / self.cnc.unit)}",
-                                        f"{extra}",
-                                    ]),
-                                    (i, j),
-                                )
-                                extra = ""
-                            x1, y1, z1 = x2, y2, z2
-                    self.cnc.motionEnd()
-                    continue
+            for cmd in cmds:
+                c = cmd[0]
+                try:
+                    value = float(cmd[1:])
+                except Exception:
+                    value = 0.0
+                if c.upper() in ("F", "X", "Y", "Z",
+                                 "I", "J", "K", "R", "P"):
+                    cmd = self.fmt(c, value)
                 else:
-                    # FIXME expansion policy here variable needed
-                    # Canned cycles
-                    if CNC.drillPolicy == 1 and self.cnc.gcode in (
-                        81,
-                        82,
-                        83,
-                        85,
-                        86,
-                        89,
-                    ):
-                        expand = self.cnc.macroGroupG8X()
-                    # Tool change
-                    elif self.cnc.mval == 6:
-                        if CNC.toolPolicy == 0:
-                            pass  # send to grbl
-                        elif CNC.toolPolicy == 1:
-                            skip = True  # skip whole line
-                        elif CNC.toolPolicy >= 2:
-                            expand = CNC.compile(self.cnc.toolChange())
-                    self.cnc.motionEnd()
+                    opt = ERROR_HANDLING.get(cmd.upper(), 0)
+                    if opt == SKIP:
+                        cmd = None
+                if cmd is not None:
+                    newcmd.append(cmd)
 
-                if expand is not None:
-                    for line in expand:
-                        add(line, None)
-                    expand = None
-                    continue
-                elif skip:
-                    skip = False
-                    continue
+            add("".join(newcmd), j)
 
-                for cmd in cmds:
-                    c = cmd[0]
-                    try:
-                        value = float(cmd[1:])
-                    except Exception:
-                        value = 0.0
-                    if c.upper() in ("F", "X", "Y", "Z",
-                                     "I", "J", "K", "R", "P"):
-                        cmd = self.fmt(c, value)
-                    else:
-                        opt = ERROR_HANDLING.get(cmd.upper(), 0)
-                        if opt == SKIP:
-                            cmd = None
-                    if cmd is not None:
-                        newcmd.append(cmd)
+        if motions:
+            split = iter(self.autolevelMotions(motions))
+            compiled = out
+            out = []
+            for line, lid in compiled:
+                if line is None:
+                    out.extend((x, lid) for x in next(split))
+                else:
+                    out.append((line, lid))
+
+        if cache:
+            if cacheable:
+                block._compiled = (
+                    list(lines), state, settings, out, cnc.getState())
+            else:
+                block._compiled = None
+        return out
+
+    # ----------------------------------------------------------------------
+    # @return the enabled blocks as (index, block, copy of its lines), to
+    # compile them in another thread while the blocks can be edited
+    # ----------------------------------------------------------------------
+    def snapshot(self):
+        return [(i, block, list(block))
+                for i, block in enumerate(self.blocks) if block.enable]
+
+    # ----------------------------------------------------------------------
+    # Generator of the compiled program as (line, path) pairs, where path
+    # is the (block, line) in the editor or None. Lines are produced
+    # lazily block by block, so streaming can start before the whole
+    # file is compiled. Generation stops when stopFunc returns True.
+    # @param program    snapshot() of the blocks, default the current one
+    # @param cnc        CNC tracking the modal state, default self.cnc.
+    #                   Another thread than the GUI must use its own, as
+    #                   drawing resets self.cnc
+    # @param cache      fill the block cache, streaming doesn't so that its
+    #                   memory doesn't grow with the file size
+    # ----------------------------------------------------------------------
+    def compileIter(self, stopFunc=None, program=None, cnc=None, cache=True):
+        if program is None:
+            program = self.snapshot()
+        if cnc is None:
+            cnc = self.cnc
+        settings = self.compileSettings()
+        cnc.initPath()
+        for line in CNC.compile(CNC.startup.splitlines()):
+            yield line, None
+
+        n = every = 0
+        for i, block, copy in program:
+            if n >= every:
+                if stopFunc is not None and stopFunc():
+                    return
+                every = n + 1000
+            lines = self.compileBlock(block, settings, stopFunc, cnc, copy,
+                                      cache)
+            if lines is None:
+                return
+            n += len(lines)
+            for line, j in lines:
+                if j is None:
+                    yield line, None
+                else:
+                    yield line, (i, j)
 
-                add("".join(newcmd), (i, j))
+    # ----------------------------------------------------------------------
+    # Use probe information to modify the g-code to autolevel
+    # ----------------------------------------------------------------------
+    def compile(self, queue, stopFunc=None):
+        paths = []
+        for line, path in self.compileIter(stopFunc):
+            if isinstance(line, str):
+                queue.put(line + "\n")
+            elif isinstance(line, list):
+                # expressions are evaluated in place, send a copy
+                queue.put(line[:])
+            else:
+                queue.put(line)
+            paths.append(path)
 
+        if stopFunc is not None and stopFunc():
+            return None
         return paths
@@ -3,9 +3,14 @@
 # Author:       vvlachoudis@gmail.com
 # Date: 24-Aug-2014
 
+import bisect
 import math
+import threading
 import time
 import sys
+from array import array
+from itertools import chain
+from queue import Empty, Queue
 
 from tkinter import (
     TclError,
@@ -48,7 +53,7 @@ import bmath
 import Camera
 import tkExtra
 import Utils
-from CNC import CNC
+from CNC import CNC, Block
 
 # Probe mapping we need PIL and numpy
 try:
@@ -79,6 +84,12 @@ GANTRY_X = GANTRY_R * 2  # 10
 GANTRY_Y = GANTRY_R  # 5
 GANTRY_H = GANTRY_R * 5  # 20
 DRAW_TIME = 5  # Maximum draw time permitted
+DRAW_POLL = 50  # ms, period to collect the paths evaluated in background
+DRAW_SLICE = 0.05  # s, maximum time creating paths in one go
+PATH_POINTS = 500  # Maximum points merged in one canvas path
+LOD_TOLERANCE = 0.5  # Path decimation tolerance in pixels, 0 to disable
+LOD_ZOOM = 2.0  # Zoom ratio triggering a new decimation
+LOD_POINTS = 64  # Paths with fewer points are never decimated
 
 INSERT_COLOR = "Blue"
 GANTRY_COLOR = "Red"
@@ -132,6 +143,17 @@ ZOOM = 1.25
 S60 = math.sin(math.radians(60))
 C60 = math.cos(math.radians(60))
 
+# Projection matrix of every view, canvas (x,y) from xyz
+PROJECTION = {
+    VIEW_XY: ((1.0, 0.0, 0.0), (0.0, -1.0, 0.0)),
+    VIEW_XZ: ((1.0, 0.0, 0.0), (0.0, 0.0, -1.0)),
+    VIEW_YZ: ((0.0, 1.0, 0.0), (0.0, 0.0, -1.0)),
+    VIEW_ISO1: ((S60, S60, 0.0), (C60, -C60, -1.0)),
+    VIEW_ISO2: ((S60, -S60, 0.0), (-C60, -C60, -1.0)),
+    VIEW_ISO3: ((-S60, -S60, 0.0), (-C60, C60, -1.0)),
+}
+NUMPY_POINTS = 32  # project with numpy paths with more points
+
 DEF_CURSOR = ""
 MOUSE_CURSOR = {
     ACTION_SELECT: DEF_CURSOR,
@@ -159,6 +181,369 @@ class AlarmException(Exception):
     pass
 
 
+# =============================================================================
+# Consecutive motions of a block with the same style drawn as one canvas
+# line. Line lines[k] starts at the point with index starts[k] and ends on
+# the first point of the next line. Points are collected as xyz and
+# projected all together when the canvas item is created
+# =============================================================================
+class Polyline:
+    def __init__(self, bid, fill, rapid):
+        self.bid = bid
+        self.fill = fill
+        self.rapid = rapid
+        self.points = []  # while building, then full detail if decimable
+        self.lines = []
+        self.starts = []
+        self.kept = None  # indices of the points drawn if decimated
+        self.zoom = 1.0  # zoom of the points
+
+    # ----------------------------------------------------------------------
+    # Append the coordinates of line lid, return False if they don't
+    # continue from the last point
+    # ----------------------------------------------------------------------
+    def add(self, lid, coords):
+        if not self.points:
+            self.starts.append(0)
+            self.points.extend(coords)
+        elif self.points[-1] == coords[0]:
+            self.starts.append(len(self.points) - 1)
+            self.points.extend(coords[1:])
+        else:
+            return False
+        self.lines.append(lid)
+        return True
+
+    # ----------------------------------------------------------------------
+    # Return first and last index of the drawn points covering line lid
+    # ----------------------------------------------------------------------
+    def span(self, lid, npoints):
+        k = self.lines.index(lid)
+        if self.kept is None:
+            if k + 1 < len(self.starts):
+                return self.starts[k], self.starts[k + 1]
+            return self.starts[k], npoints - 1
+        a = bisect.bisect_right(self.kept, self.starts[k]) - 1
+        if k + 1 < len(self.starts):
+            b = bisect.bisect_left(self.kept, self.starts[k + 1])
+            return a, min(b, len(self.kept) - 1)
+        return a, len(self.kept) - 1
+
+    # ----------------------------------------------------------------------
+    # Return the indices of the drawn points where lines start or end
+    # ----------------------------------------------------------------------
+    def nodes(self, npoints):
+        if self.kept is None:
+            return self.starts + [npoints - 1]
+        starts = set(self.starts)
+        return [i for i, p in enumerate(self.kept) if p in starts] + [npoints - 1]
+
+    # ----------------------------------------------------------------------
+    # Return the line id of drawn segment seg
+    # ----------------------------------------------------------------------
+    def line(self, seg):
+        if self.kept is not None:
+            seg = self.kept[min(seg, len(self.kept) - 1)]
+        return self.lines[max(0, bisect.bisect_right(self.starts, seg) - 1)]
+
+
+# =============================================================================
+# The drawing needs the expressions of the g-code evaluated in the GUI
+# =============================================================================
+class EvaluateException(Exception):
+    pass
+
+
+# =============================================================================
+# Evaluate the paths of a copy of the blocks, either in a background thread
+# or in the GUI when the g-code contains expressions. Nothing shared is
+# modified: the polylines are queued as soon as they are completed, and at
+# the end the (geometries, totals, cache) result, applied by the canvas
+# =============================================================================
+class PathEvaluator:
+    # ----------------------------------------------------------------------
+    # @param program    (enable, color, lines) of every block
+    # @param cache      cache entry of the file or None
+    # @param key        settings the drawn geometry depends on
+    # @param app        application to evaluate the expressions with, None
+    #                   in a background thread
+    # ----------------------------------------------------------------------
+    def __init__(self, canvas, drawId, queue, program, cache, key, app=None):
+        self.canvas = canvas
+        self.drawId = drawId
+        self.queue = queue
+        self.program = program
+        self.cache = cache
+        self.key = key
+        self.app = app
+        self.gcode = canvas.gcode
+        self.draw_rapid = canvas.draw_rapid
+        self.draw_paths = canvas.draw_paths
+        self.drawG = canvas.draw_rapid or canvas.draw_paths \
+            or canvas.draw_margin
+        self.cnc = CNC()
+        self.blocks = []  # geometry of every block evaluated
+        self.paths = [] if cache is not None else None  # to store in cache
+        self._polyline = None  # path being built
+        self._last = (0.0, 0.0, 0.0)
+
+    # ----------------------------------------------------------------------
+    def cancelled(self):
+        return self.drawId != self.canvas._drawId
+
+    # ----------------------------------------------------------------------
+    def run(self):
+        queue = self.queue
+        try:
+            if self.cache is not None and \
+                    self.cache.get("pathKey") == self.key:
+                result = self.cached()
+            else:
+                result = self.evaluate()
+        except Exception as e:
+            queue.put(e)
+            return
+        if result is not None:
+            queue.put(result)
+
+    # ----------------------------------------------------------------------
+    # Send the paths stored in the cache of the file instead of evaluating
+    # ----------------------------------------------------------------------
+    def cached(self):
+        cache = self.cache
+        program = self.program
+        for bid, rapid, lines, starts, xyz in cache["paths"]:
+            if self.cancelled():
+                return None
+            enable, color, block = program[bid]
+            poly = Polyline(bid, pathColor(enable, color), rapid)
+            poly.lines = lines
+            poly.starts = starts
+            it = iter(xyz)
+            poly.points = list(zip(it, it, it))
+            self.queue.put(poly)
+        return cache["geometry"], cache["total"], None
+
+    # ----------------------------------------------------------------------
+    # Evaluate all blocks, in Block instances of our own
+    # ----------------------------------------------------------------------
+    def evaluate(self):
+        cnc = self.cnc
+        cnc.planStart()
+        try:
+            n = 1
+            startTime = time.time()
+            for i, (enable, color, lines) in enumerate(self.program):
+                start = True  # start location found
+                block = Block()
+                block.enable = enable
+                block.color = color
+                self.blocks.append(block)
+
+                for j, line in enumerate(lines):
+                    n -= 1
+                    if n == 0:
+                        if self.cancelled():
+                            return None
+                        if time.time() - startTime > DRAW_TIME:
+                            raise AlarmException()
+                        n = 100
+                    try:
+                        cmd = CNC.compileLine(line)
+                        if cmd is not None and not isinstance(
+                            cmd, (str, tuple)
+                        ):
+                            if self.app is None:
+                                raise EvaluateException()
+                            # expressions can give a different result
+                            self.paths = None
+                            cmd = self.gcode.evaluate(cmd, self.app)
+                        if isinstance(cmd, tuple):
+                            cmd = None
+                        else:
+                            cmd = CNC.breakLine(cmd)
+                    except (AlarmException, EvaluateException):
+                        raise
+                    except Exception:
+                        sys.stderr.write(
+                            _(">>> ERROR: {}\n").format(str(sys.exc_info()[1]))
+                        )
+                        sys.stderr.write(_("     line: {}\n").format(line))
+                        cmd = None
+                    block.addPath(None)
+                    if cmd is not None and self.drawG:
+                        self.drawPath(block, cmd, i, j)
+                        if start and cnc.gcode in (1, 2, 3):
+                            # Mark as start the first non-rapid motion
+                            block.startPath(cnc.x, cnc.y, cnc.z)
+                            start = False
+                self._queuePath()
+                block.endPath(cnc.x, cnc.y, cnc.z)
+            cnc.planEnd()
+        except AlarmException:
+            self._queuePath()
+            cnc.planEnd()
+            self.paths = None
+            self.queue.put(_("Rendering takes TOO Long. Interrupted..."))
+
+        geometry = [b.geometry() for b in self.blocks]
+        total = (cnc.totalLength, cnc.totalTime)
+        entry = None
+        if self.paths is not None:
+            entry = dict(self.cache)
+            entry["pathKey"] = self.key
+            entry["total"] = total
+            entry["geometry"] = geometry
+            entry["paths"] = self.paths
+            self.gcode.saveCache(entry)
+        return geometry, total, entry
+
+    # ----------------------------------------------------------------------
+    # Add the path of one g command (line lid of block bid) to the polyline
+    # under construction. Consecutive motions with the same style are
+    # drawn as a single canvas item
+    # ----------------------------------------------------------------------
+    def drawPath(self, block, cmds, bid, lid):
+        cnc = self.cnc
+        cnc.motionStart(cmds)
+        xyz = cnc.motionPath()
+        cnc.motionEnd()
+        length = cnc.pathLength(block, xyz) if xyz else 0.0
+        cnc.planMotion(block, lid, xyz, length)
+        if xyz:
+            if cnc.gcode in (1, 2, 3):
+                block.pathMargins(xyz)
+            if block.enable:
+                if cnc.gcode == 0 and self.draw_rapid:
+                    xyz[0] = self._last
+                self._last = xyz[-1]
+            else:
+                if cnc.gcode == 0:
+                    return None
+            fill = pathColor(block.enable, block.color)
+            if cnc.gcode == 0:
+                if self.draw_rapid:
+                    self._addPath(bid, lid, xyz, fill, True)
+            elif self.draw_paths:
+                self._addPath(bid, lid, xyz, fill, False)
+
+    # ----------------------------------------------------------------------
+    def _addPath(self, bid, lid, xyz, fill, rapid):
+        poly = self._polyline
+        if (
+            poly is None
+            or poly.rapid != rapid
+            or len(poly.points) >= PATH_POINTS
+            or not poly.add(lid, xyz)
+        ):
+            self._queuePath()
+            poly = self._polyline = Polyline(bid, fill, rapid)
+            poly.add(lid, xyz)
+
+    # ----------------------------------------------------------------------
+    # Send the polyline under construction to be drawn
+    # ----------------------------------------------------------------------
+    def _queuePath(self):
+        poly = self._polyline
+        if poly is not None:
+            if self.paths is not None:
+                self.paths.append((
+                    poly.bid,
+                    poly.rapid,
+                    poly.lines,
+                    poly.starts,
+                    array("d", chain.from_iterable(poly.points)),
+                ))
+            self.queue.put(poly)
+            self._polyline = None
+
+
+# -----------------------------------------------------------------------------
+def pathColor(enable, color):
+    if not enable:
+        return DISABLE_COLOR
+    return color or ENABLE_COLOR
+
+
+# -----------------------------------------------------------------------------
+# Return if segment x1,y1-x2,y2 crosses the rectangle xmin,ymin-xmax,ymax
+# -----------------------------------------------------------------------------
+def _segmentInRect(x1, y1, x2, y2, xmin, ymin, xmax, ymax):
+    if max(x1, x2) < xmin or min(x1, x2) > xmax:
+        return False
+    if max(y1, y2) < ymin or min(y1, y2) > ymax:
+        return False
+    # the rectangle corners must not lie all on the same side of the line
+    dx = x2 - x1
+    dy = y2 - y1
+    sides = 0
+    for x, y in ((xmin, ymin), (xmax, ymin), (xmax, ymax), (xmin, ymax)):
+        c = dx * (y - y1) - dy * (x - x1)
+        if c > 0.0:
+            sides |= 1
+        elif c < 0.0:
+            sides |= 2
+        else:
+            return True
+    return sides == 3
+
+
+# -----------------------------------------------------------------------------
+# Return the indices of the points of the flat xy list to keep so the
+# polyline deviates less than tolerance. Points closer than the tolerance
+# to the previous one are dropped and the rest are simplified with the
+# Douglas-Peucker algorithm, using the distance to the segment so that
+# reversals of direction are kept
+# -----------------------------------------------------------------------------
+def decimate(xy, tolerance):
+    n = len(xy) // 2
+    t2 = tolerance * tolerance
+    idx = [0]
+    lx = xy[0]
+    ly = xy[1]
+    for i in range(1, n - 1):
+        x = xy[2 * i]
+        y = xy[2 * i + 1]
+        if (x - lx) ** 2 + (y - ly) ** 2 >= t2:
+            idx.append(i)
+            lx = x
+            ly = y
+    idx.append(n - 1)
+    # Douglas-Peucker pays off only on paths made mostly of sub-pixel
+    # segments, the rest are drawn as they are
+    if len(idx) < 3 or 2 * len(idx) > n:
+        return idx
+
+    keep = [False] * len(idx)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(idx) - 1)]
+    while stack:
+        a, b = stack.pop()
+        ax = xy[2 * idx[a]]
+        ay = xy[2 * idx[a] + 1]
+        dx = xy[2 * idx[b]] - ax
+        dy = xy[2 * idx[b] + 1] - ay
+        l2 = dx * dx + dy * dy
+        worst = t2
+        w = -1
+        for k in range(a + 1, b):
+            px = xy[2 * idx[k]] - ax
+            py = xy[2 * idx[k] + 1] - ay
+            if l2 > 0.0:
+                t = min(1.0, max(0.0, (px * dx + py * dy) / l2))
+                px -= t * dx
+                py -= t * dy
+            d = px * px + py * py
+            if d > worst:
+                worst = d
+                w = k
+        if w >= 0:
+            keep[w] = True
+            stack.append((a, w))
+            stack.append((w, b))
+    return [i for i, k in zip(idx, keep) if k]
+
+
 # =============================================================================
 # Drawing canvas
 # =============================================================================
@@ -227,6 +612,13 @@ class CNCCanvas(Canvas):
         self._vector = None
         self._lastActive = None
         self._lastGantry = None
+        self._selLines = {}  # (bid,lid): item highlighting a selected line
+        self._process = None  # item showing the progress inside a path
+        self._processPath = None
+        self._drawId = 0  # current draw, increase to cancel the previous
+        self._drawQueue = None  # paths evaluated, None if not drawing
+        self._drawCenter = None
+        self._fitPending = False
 
         self._probeImage = None
         self._probeTkImage = None
@@ -657,40 +1049,33 @@ class CNCCanvas(Canvas):
             ACTION_SELECT_AREA,
         ):
             if self._mouseAction == ACTION_SELECT_AREA:
-                if self._x < event.x:  # From left->right enclosed
-                    closest = self.find_enclosed(
-                        self.canvasx(self._x),
-                        self.canvasy(self._y),
-                        self.canvasx(event.x),
-                        self.canvasy(event.y),
-                    )
-                else:  # From right->left overlapping
-                    closest = self.find_overlapping(
-                        self.canvasx(self._x),
-                        self.canvasy(self._y),
-                        self.canvasx(event.x),
-                        self.canvasy(event.y),
-                    )
+                x1 = self.canvasx(self._x)
+                y1 = self.canvasy(self._y)
+                x2 = self.canvasx(event.x)
+                y2 = self.canvasy(event.y)
+                # From left->right enclosed, right->left overlapping
+                enclosed = self._x < event.x
                 self.delete(self._select)
                 self._select = None
                 items = []
-                for i in closest:
+                for i in self.find_overlapping(x1, y1, x2, y2):
                     try:
-                        items.append(self._items[i])
-                    except Exception:
-                        pass
+                        poly = self._items[i]
+                    except KeyError:
+                        continue
+                    for lid in self._linesInRect(i, x1, y1, x2, y2, enclosed):
+                        items.append((poly.bid, lid))
 
             elif self._mouseAction in (ACTION_SELECT_SINGLE,
                                        ACTION_SELECT_DOUBLE):
-                closest = self.find_closest(
-                    self.canvasx(event.x),
-                    self.canvasy(event.y),
-                    CLOSE_DISTANCE
-                )
+                cx = self.canvasx(event.x)
+                cy = self.canvasy(event.y)
+                closest = self.find_closest(cx, cy, CLOSE_DISTANCE)
                 items = []
                 for i in closest:
                     try:
-                        items.append(self._items[i])
+                        poly = self._items[i]
+                        items.append((poly.bid, self._closestLine(i, cx, cy)))
                     except KeyError:
                         tags = self.gettags(i)
                         if "Orient" in tags:
@@ -750,25 +1135,20 @@ class CNCCanvas(Canvas):
         # ... and if we are closer than 5pixels
         for item in self.find_closest(cx, cy, CLOSE_DISTANCE):
             try:
-                bid, lid = self._items[item]
+                poly = self._items[item]
             except KeyError:
                 continue
 
             # Very cheap and inaccurate approach :)
+            # check the first and last point of every line
             coords = self.coords(item)
-            x = coords[0]  # first
-            y = coords[1]  # point
-            d = (cx - x) ** 2 + (cy - y) ** 2
-            if d < dmin:
-                dmin = d
-                xs, ys = x, y
-
-            x = coords[-2]  # last
-            y = coords[-1]  # point
-            d = (cx - x) ** 2 + (cy - y) ** 2
-            if d < dmin:
-                dmin = d
-                xs, ys = x, y
+            for p in poly.nodes(len(coords) // 2):
+                x = coords[2 * p]
+                y = coords[2 * p + 1]
+                d = (cx - x) ** 2 + (cy - y) ** 2
+                if d < dmin:
+                    dmin = d
+                    xs, ys = x, y
 
             # I need to check the real code and if
             # an arc check also the center?
@@ -778,6 +1158,75 @@ class CNCCanvas(Canvas):
         else:
             return cx, cy
 
+    # ----------------------------------------------------------------------
+    # Return the line of path item closest to canvas point cx,cy
+    # ----------------------------------------------------------------------
+    def _closestLine(self, item, cx, cy):
+        coords = self.coords(item)
+        dmin = None
+        seg = 0
+        for k in range(len(coords) // 2 - 1):
+            x1, y1, x2, y2 = coords[2 * k: 2 * k + 4]
+            dx = x2 - x1
+            dy = y2 - y1
+            l2 = dx * dx + dy * dy
+            if l2 > 0.0:
+                t = min(1.0, max(0.0, ((cx - x1) * dx + (cy - y1) * dy) / l2))
+            else:
+                t = 0.0
+            d = (x1 + t * dx - cx) ** 2 + (y1 + t * dy - cy) ** 2
+            if dmin is None or d < dmin:
+                dmin = d
+                seg = k
+        return self._items[item].line(seg)
+
+    # ----------------------------------------------------------------------
+    # Return the lines of path item enclosed or overlapping the rectangle
+    # ----------------------------------------------------------------------
+    def _linesInRect(self, item, x1, y1, x2, y2, enclosed):
+        if x1 > x2:
+            x1, x2 = x2, x1
+        if y1 > y2:
+            y1, y2 = y2, y1
+        poly = self._items[item]
+        coords = self.coords(item)
+        n = len(coords) // 2
+        lines = []
+        for lid in poly.lines:
+            a, b = poly.span(lid, n)
+            xy = coords[2 * a: 2 * b + 2]
+            if enclosed:
+                for k in range(0, len(xy), 2):
+                    if not (x1 <= xy[k] <= x2 and y1 <= xy[k + 1] <= y2):
+                        break
+                else:
+                    lines.append(lid)
+            else:
+                for k in range(0, len(xy) - 2, 2):
+                    if _segmentInRect(*xy[k: k + 4], x1, y1, x2, y2):
+                        lines.append(lid)
+                        break
+        return lines
+
+    # ----------------------------------------------------------------------
+    # Return the coordinates of line lid inside path item
+    # ----------------------------------------------------------------------
+    def _lineCoords(self, item, lid):
+        coords = self.coords(item)
+        a, b = self._items[item].span(lid, len(coords) // 2)
+        return coords[2 * a: 2 * b + 2]
+
+    # ----------------------------------------------------------------------
+    # Create a line on top of the path item tracing only line lid
+    # ----------------------------------------------------------------------
+    def _lineItem(self, item, lid, **kwargs):
+        coords = self._lineCoords(item, lid)
+        if len(coords) < 4:
+            return None
+        if self._items[item].rapid:
+            kwargs["dash"] = (4, 3)
+        return self.create_line(coords, **kwargs)
+
     # ----------------------------------------------------------------------
     # Get margins of selected items
     # ----------------------------------------------------------------------
@@ -795,6 +1244,7 @@ class CNCCanvas(Canvas):
         ret = Canvas.xview(self, *args)
         if args:
             self.cameraPosition()
+            self.levelOfDetail()
         return ret
 
     # ----------------------------------------------------------------------
@@ -802,6 +1252,7 @@ class CNCCanvas(Canvas):
         ret = Canvas.yview(self, *args)
         if args:
             self.cameraPosition()
+            self.levelOfDetail()
         return ret
 
     # ----------------------------------------------------------------------
@@ -823,6 +1274,7 @@ class CNCCanvas(Canvas):
     def panRelease(self, event):
         self._mouseAction = None
         self.config(cursor=mouseCursor(self.action))
+        self.levelOfDetail()
 
     # ----------------------------------------------------------------------
     def panLeft(self, event=None):
@@ -887,6 +1339,7 @@ class CNCCanvas(Canvas):
             self._projectProbeImage()
             self.itemconfig(self._probe, image=self._probeTkImage)
         self.cameraUpdate()
+        self.levelOfDetail()
 
     # ----------------------------------------------------------------------
     # Return selected objects bounding box
@@ -917,6 +1370,11 @@ class CNCCanvas(Canvas):
     def fit2Screen(self, event=None):
         """Zoom to Fit to Screen"""
 
+        # wait until all the paths are drawn
+        if self._drawQueue is not None:
+            self._fitPending = True
+            return
+
         bb = self.selBbox()
         if bb is None:
             return
@@ -1037,13 +1495,26 @@ class CNCCanvas(Canvas):
         if i is None:
             return
         block = self.gcode[b]
-        item = block.path(i)
+        path = block.path(i)
+        if path is None:
+            return
 
-        if item is not None and item != self._lastActive:
-            if self._lastActive is not None:
+        if self._lastActive is not None:
+            if self._lastActive in self._selLines.values():
                 self.itemconfig(self._lastActive, arrow=NONE)
-            self._lastActive = item
+            else:
+                self.delete(self._lastActive)
+        self._lastActive = self._selLines.get(item)
+        if self._lastActive is not None:
             self.itemconfig(self._lastActive, arrow=LAST)
+        else:
+            self._lastActive = self._lineItem(
+                path,
+                i,
+                fill=self.itemcget(path, "fill"),
+                width=self.itemcget(path, "width"),
+                arrow=LAST,
+            )
 
     # ----------------------------------------------------------------------
     # Display gantry
@@ -1092,11 +1563,14 @@ class CNCCanvas(Canvas):
     # ----------------------------------------------------------------------
     def clearSelection(self):
         if self._lastActive is not None:
-            self.itemconfig(self._lastActive, arrow=NONE)
+            self.delete(self._lastActive)
             self._lastActive = None
+        for i in self._selLines.values():
+            self.delete(i)
+        self._selLines.clear()
 
         for i in self.find_withtag("sel"):
-            bid, lid = self._items[i]
+            bid = self._items[i].bid
             if bid:
                 try:
                     block = self.gcode[bid]
@@ -1125,16 +1599,20 @@ class CNCCanvas(Canvas):
             block = self.gcode[b]
             if i is None:
                 sel = block.enable and "sel" or "sel2"
+                last = None
                 for path in block._path:
-                    if path is not None:
+                    if path is not None and path != last:
                         self.addtag_withtag(sel, path)
+                        last = path
                 sel = block.enable and "sel3" or "sel4"
 
             elif isinstance(i, int):
                 path = block.path(i)
-                if path:
+                if path and (b, i) not in self._selLines:
                     sel = block.enable and "sel" or "sel2"
-                    self.addtag_withtag(sel, path)
+                    item = self._lineItem(path, i, tags=sel)
+                    if item is not None:
+                        self._selLines[b, i] = item
 
         self.itemconfig("sel", width=2, fill=SELECT_COLOR)
         self.itemconfig("sel2", width=2, fill=SELECT2_COLOR)
@@ -1386,7 +1864,8 @@ class CNCCanvas(Canvas):
         if view is not None:
             self.view = view
 
-        self._last = (0.0, 0.0, 0.0)
+        self.drawCancel()
+        self._drawCenter = xyz
         self.initPosition()
 
         self.drawPaths()
@@ -1401,14 +1880,27 @@ class CNCCanvas(Canvas):
         if self._gantry2:
             self.tag_raise(self._gantry2)
         self._updateScrollBars()
+        self._center(xyz)
+
+        self._inDraw = False
 
+    # ----------------------------------------------------------------------
+    # Scroll to have the xyz point in the center of the canvas
+    # ----------------------------------------------------------------------
+    def _center(self, xyz):
         ij = self.plotCoords([xyz])[0]
         dx = int(round(self.canvasx(self.winfo_width() / 2) - ij[0]))
         dy = int(round(self.canvasy(self.winfo_height() / 2) - ij[1]))
         self.scan_mark(0, 0)
         self.scan_dragto(int(round(dx)), int(round(dy)), 1)
 
-        self._inDraw = False
+    # ----------------------------------------------------------------------
+    # Abort the evaluation of the paths of a previous draw if any
+    # ----------------------------------------------------------------------
+    def drawCancel(self):
+        self._drawId += 1
+        self._drawQueue = None
+        self._fitPending = False
 
     # ----------------------------------------------------------------------
     # Initialize gantry position
@@ -1446,6 +1938,9 @@ class CNCCanvas(Canvas):
         self._lastActive = None
         self._select = None
         self._vector = None
+        self._selLines.clear()
+        self._process = None
+        self._processPath = None
         self._items.clear()
         self.cnc.initPath()
         self.cnc.resetAllMargins()
@@ -1778,10 +2273,10 @@ class CNCCanvas(Canvas):
         # Draw image map if numpy exists
         if (
             numpy is not None
-            and probe.matrix
+            and not probe.isEmpty()
             and self.view in (VIEW_XY, VIEW_ISO1, VIEW_ISO2, VIEW_ISO3)
         ):
-            array = numpy.array(list(reversed(probe.matrix)), numpy.float32)
+            array = numpy.array(probe.matrix[::-1], numpy.float32)
 
             lw = array.min()
             hg = array.max()
@@ -1895,100 +2390,207 @@ class CNCCanvas(Canvas):
         return x, y
 
     # ----------------------------------------------------------------------
-    # Draw the paths for the whole gcode file
+    # Draw the paths for the whole gcode file. The g-code is evaluated in a
+    # background thread and the paths are created as they become ready.
+    # If it contains expressions it is evaluated here, as they may use the
+    # application.
     # ----------------------------------------------------------------------
-    def drawPaths(self):
+    def drawPaths(self, sync=False):
         if not self.draw_paths:
             for block in self.gcode.blocks:
                 block.resetPath()
             return
 
-        try:
-            n = 1
-            startTime = before = time.time()
-            self.cnc.resetAllMargins()
-            drawG = self.draw_rapid or self.draw_paths or self.draw_margin
-            for i, block in enumerate(self.gcode.blocks):
-                start = True  # start location found
-                block.resetPath()
+        program = []
+        for block in self.gcode.blocks:
+            block.resetPath()
+            block._path.extend([None] * len(block))
+            program.append((block.enable, block.color, list(block)))
+
+        # the geometry depends also on the starting position and feed mode
+        key = (
+            self.draw_rapid,
+            self.draw_paths,
+            CNC.vars["wx"],
+            CNC.vars["wy"],
+            CNC.vars["wz"],
+            CNC.vars["feedmode"],
+            CNC.plannerSettings(),
+        )
+        self._drawQueue = Queue()
+        evaluator = PathEvaluator(
+            self, self._drawId, self._drawQueue, program, self.gcode.cache,
+            key, self.app if sync else None)
+        if sync:
+            evaluator.run()
+        else:
+            threading.Thread(target=evaluator.run, daemon=True).start()
+        self.after(DRAW_POLL, self._drawPoll, self._drawId)
 
-                # Draw block
-                for j, line in enumerate(block):
-                    n -= 1
-                    if n == 0:
-                        if time.time() - startTime > DRAW_TIME:
-                            raise AlarmException()
-                        # Force a periodic update since this loop can take time
-                        if time.time() - before > 1.0:
-                            self.update()
-                            before = time.time()
-                        n = 1000
-                    try:
-                        cmd = self.gcode.evaluate(
-                            CNC.compileLine(line), self.app)
-                        if isinstance(cmd, tuple):
-                            cmd = None
-                        else:
-                            cmd = CNC.breakLine(cmd)
-                    except AlarmException:
-                        raise
-                    except Exception:
-                        sys.stderr.write(
-                            _(">>> ERROR: {}\n").format(str(sys.exc_info()[1]))
-                        )
-                        sys.stderr.write(_("     line: {}\n").format(line))
-                        cmd = None
-                    if cmd is None or not drawG:
-                        block.addPath(None)
-                    else:
-                        path = self.drawPath(block, cmd)
-                        self._items[path] = i, j
-                        block.addPath(path)
-                        if start and self.cnc.gcode in (1, 2, 3):
-                            # Mark as start the first non-rapid motion
-                            block.startPath(self.cnc.x, self.cnc.y, self.cnc.z)
-                            start = False
-                block.endPath(self.cnc.x, self.cnc.y, self.cnc.z)
-        except AlarmException:
-            self.status("Rendering takes TOO Long. Interrupted...")
+    # ----------------------------------------------------------------------
+    # Create the paths evaluated so far, and finish the drawing at the end
+    # ----------------------------------------------------------------------
+    def _drawPoll(self, drawId):
+        if drawId != self._drawId:
+            return
+        t = time.time()
+        while time.time() - t < DRAW_SLICE:
+            try:
+                poly = self._drawQueue.get_nowait()
+            except Empty:
+                break
+            if isinstance(poly, Polyline):
+                self.createPath(poly)
+            elif isinstance(poly, str):
+                self.status(poly)
+            elif isinstance(poly, EvaluateException):
+                # start again evaluating the expressions here
+                self.drawCancel()
+                self._drawRestart()
+                return
+            elif isinstance(poly, Exception):
+                self._drawEnd(None)
+                raise poly
+            else:
+                self._drawEnd(poly)
+                return
+        if self._gantry1:
+            self.tag_raise(self._gantry1)
+        if self._gantry2:
+            self.tag_raise(self._gantry2)
+        self.after(DRAW_POLL, self._drawPoll, drawId)
 
     # ----------------------------------------------------------------------
-    # Create path for one g command
+    # Draw again with the paths evaluated in the GUI
     # ----------------------------------------------------------------------
-    def drawPath(self, block, cmds):
-        self.cnc.motionStart(cmds)
-        xyz = self.cnc.motionPath()
-        self.cnc.motionEnd()
-        if xyz:
-            self.cnc.pathLength(block, xyz)
-            if self.cnc.gcode in (1, 2, 3):
-                block.pathMargins(xyz)
+    def _drawRestart(self):
+        for item in self._items:
+            self.delete(item)
+        self._items.clear()
+        self.drawPaths(True)
+
+    # ----------------------------------------------------------------------
+    # Apply the geometry of the blocks and update the margins
+    # @param result (geometries, (length, time), cache entry) or None
+    # ----------------------------------------------------------------------
+    def _drawEnd(self, result):
+        self._drawQueue = None
+        if result is not None:
+            geometry, total, entry = result
+            for block, g in zip(self.gcode.blocks, geometry):
+                block.setGeometry(g)
                 self.cnc.pathMargins(block)
-            if block.enable:
-                if self.cnc.gcode == 0 and self.draw_rapid:
-                    xyz[0] = self._last
-                self._last = xyz[-1]
-            else:
-                if self.cnc.gcode == 0:
-                    return None
-            coords = self.plotCoords(xyz)
-            if coords:
-                if block.enable:
-                    if block.color:
-                        fill = block.color
-                    else:
-                        fill = ENABLE_COLOR
-                else:
-                    fill = DISABLE_COLOR
-                if self.cnc.gcode == 0:
-                    if self.draw_rapid:
-                        return self.create_line(coords, fill=fill,
-                                                width=0, dash=(4, 3))
-                elif self.draw_paths:
-                    return self.create_line(
-                        coords, fill=fill, width=0, cap="projecting"
-                    )
-        return None
+            self.cnc.totalLength, self.cnc.totalTime = total
+            if entry is not None and self.gcode.cache is not None:
+                self.gcode.cache = entry
+
+        self.drawMargin()
+        if self._gantry1:
+            self.tag_raise(self._gantry1)
+        if self._gantry2:
+            self.tag_raise(self._gantry2)
+        self._updateScrollBars()
+        self._center(self._drawCenter)
+        if self._fitPending:
+            self._fitPending = False
+            self.fit2Screen()
+        self.app.selectionChange()
+
+    # ----------------------------------------------------------------------
+    # Create the canvas item of a polyline
+    # ----------------------------------------------------------------------
+    def createPath(self, poly):
+        if len(poly.points) < 2:
+            return
+        xy = array("d", self.plotCoordsFlat(poly.points))
+        poly.points = None
+        if LOD_TOLERANCE > 0.0 and len(xy) >= 2 * LOD_POINTS:
+            # keep the full detail to decimate again at another zoom, the
+            # path may be drawn before the zoom to fit
+            poly.points = xy
+            poly.zoom = self.zoom
+            kept = decimate(xy, LOD_TOLERANCE)
+            if len(kept) < len(xy) // 2:
+                poly.kept = kept
+                xy = [v for i in kept for v in xy[2 * i: 2 * i + 2]]
+        if poly.rapid:
+            item = self.create_line(*xy, fill=poly.fill, width=0, dash=(4, 3))
+        else:
+            item = self.create_line(
+                *xy, fill=poly.fill, width=0, cap="projecting"
+            )
+        self._items[item] = poly
+        block = self.gcode.blocks[poly.bid]
+        for lid in poly.lines:
+            block._path[lid] = item
+
+    # ----------------------------------------------------------------------
+    # Decimate again the visible paths whose zoom changed by more than
+    # LOD_ZOOM, in or out, since they were drawn or decimated
+    # ----------------------------------------------------------------------
+    def levelOfDetail(self):
+        if LOD_TOLERANCE <= 0.0:
+            return
+        for item in self.find_overlapping(
+            self.canvasx(0),
+            self.canvasy(0),
+            self.canvasx(self.winfo_width()),
+            self.canvasy(self.winfo_height()),
+        ):
+            poly = self._items.get(item)
+            if poly is None or poly.points is None:
+                continue
+            ratio = self.zoom / poly.zoom
+            if 1.0 / LOD_ZOOM < ratio < LOD_ZOOM:
+                continue
+            xy = poly.points
+            poly.kept = decimate(xy, LOD_TOLERANCE / ratio)
+            coords = []
+            for i in poly.kept:
+                coords.append(xy[2 * i] * ratio)
+                coords.append(xy[2 * i + 1] * ratio)
+            self.coords(item, *coords)
+            # keep the points in the current zoom
+            poly.points = array("d", [v * ratio for v in xy])
+            poly.zoom = self.zoom
+
+    # ----------------------------------------------------------------------
+    # Highlight as processed the path up to the end of line lid of block
+    # bid. Lines are expected in order, any previous path is completed
+    # ----------------------------------------------------------------------
+    def processPath(self, bid, lid):
+        path = self.gcode[bid].path(lid)
+        if path is None:
+            return
+        if path != self._processPath:
+            if self._processPath is not None:
+                self.itemconfig(self._processPath, width=2, fill=PROCESS_COLOR)
+            self._processPath = path
+        if lid == self._items[path].lines[-1]:
+            self.itemconfig(path, width=2, fill=PROCESS_COLOR)
+            self._processPath = None
+            coords = ()
+        else:
+            coords = self.coords(path)
+            a, b = self._items[path].span(lid, len(coords) // 2)
+            coords = coords[: 2 * b + 2]
+        if len(coords) < 4:
+            if self._process is not None:
+                self.delete(self._process)
+                self._process = None
+        elif self._process is None:
+            self._process = self.create_line(coords, width=2,
+                                             fill=PROCESS_COLOR)
+        else:
+            self.coords(self._process, *coords)
+            self.tag_raise(self._process)
+
+    # ----------------------------------------------------------------------
+    def resetProcess(self):
+        if self._process is not None:
+            self.delete(self._process)
+        self._process = None
+        self._processPath = None
 
     # ----------------------------------------------------------------------
     # Return plotting coordinates for a 3d xyz path
@@ -2041,6 +2643,19 @@ class CNCCanvas(Canvas):
                 coords[i] = (x, y)
         return coords
 
+    # ----------------------------------------------------------------------
+    # Return the plotting coordinates of a 3d xyz path as a flat list
+    # x0,y0,x1,y1,... Long paths are projected with one numpy matrix
+    # multiplication when available
+    # ----------------------------------------------------------------------
+    def plotCoordsFlat(self, xyz):
+        if numpy is None or len(xyz) < NUMPY_POINTS:
+            return list(chain.from_iterable(self.plotCoords(xyz)))
+        xy = numpy.dot(numpy.array(xyz, dtype=float),
+                       numpy.array(PROJECTION[self.view]).T * self.zoom)
+        numpy.clip(xy, -MAXDIST, MAXDIST, out=xy)
+        return xy.ravel().tolist()
+
     # ----------------------------------------------------------------------
     # Canvas to real coordinates
     # ----------------------------------------------------------------------
@@ -2129,7 +2744,7 @@ class CanvasFrame(Frame):
         global BOX_SELECT, ENABLE_COLOR, DISABLE_COLOR, SELECT_COLOR
         global SELECT2_COLOR, PROCESS_COLOR, MOVE_COLOR, RULER_COLOR
         global CAMERA_COLOR, PROBE_TEXT_COLOR, CANVAS_COLOR
-        global DRAW_TIME
+        global DRAW_TIME, LOD_TOLERANCE
 
         self.draw_axes.set(bool(int(Utils.getBool("Canvas", "axes", True))))
         self.draw_grid.set(bool(int(Utils.getBool("Canvas", "grid", True))))
@@ -2142,6 +2757,7 @@ class CanvasFrame(Frame):
         self.view.set(Utils.getStr("Canvas", "view", VIEWS[0]))
 
         DRAW_TIME = Utils.getInt("Canvas", "drawtime", DRAW_TIME)
+        LOD_TOLERANCE = Utils.getFloat("Canvas", "lod", LOD_TOLERANCE)
 
         INSERT_COLOR = Utils.getStr("Color", "canvas.insert", INSERT_COLOR)
         GANTRY_COLOR = Utils.getStr("Color", "canvas.gantry", GANTRY_COLOR)
@@ -72,6 +72,15 @@ TOOL_POLICY = [
 
 TOOL_WAIT = [_("ONLY before probing"), _("BEFORE & AFTER probing")]
 
+SCAN_POLL = 500  # ms, check for the end of an adaptive scan pass
+
+# Same order as the interpolation methods of CNC.Probe
+PROBE_INTERPOLATION = [
+    _("Bilinear"),  # 0
+    _("Bicubic"),  # 1
+    _("Thin-plate spline"),  # 2
+]
+
 CAMERA_LOCATION = {
     "Gantry": NONE,
     "Top-Left": NW,
@@ -1327,6 +1336,79 @@ class AutolevelFrame(CNCRibbon.PageFrame):
         tkExtra.Balloon.set(self.probeZmax, _("Z safe to move"))
         self.addWidget(self.probeZmax)
 
+        # Interpolation
+        row += 1
+        col = 0
+        Label(lframe, text=_("Interpolation:")).grid(
+            row=row, column=col, sticky=E)
+        col += 1
+        self.interpolation = tkExtra.Combobox(
+            lframe,
+            True,
+            background=tkExtra.GLOBAL_CONTROL_BACKGROUND,
+            command=self.interpolationChange,
+            width=16,
+        )
+        self.interpolation.grid(row=row, column=col, columnspan=4, sticky=EW)
+        self.interpolation.fill(PROBE_INTERPOLATION)
+        self.interpolation.set(PROBE_INTERPOLATION[0])
+        tkExtra.Balloon.set(
+            self.interpolation,
+            _("Interpolation of the probed heights. Bicubic and thin-plate "
+              "spline need less probe points for the same accuracy"),
+        )
+        self.addWidget(self.interpolation)
+
+        # Adaptive scan
+        row += 1
+        col = 0
+        Label(lframe, text=_("Adaptive:")).grid(row=row, column=col, sticky=E)
+        col += 1
+        self.adaptive = IntVar()
+        b = Checkbutton(
+            lframe,
+            variable=self.adaptive,
+            activebackground="LightYellow",
+            padx=2,
+            pady=1,
+        )
+        b.grid(row=row, column=col, sticky=W)
+        tkExtra.Balloon.set(
+            b,
+            _("Probe a coarse grid first and then only the nodes where "
+              "the surface deviates more than the tolerance"),
+        )
+        self.addWidget(b)
+
+        col += 1
+        self.tolerance = tkExtra.FloatEntry(
+            lframe, background=tkExtra.GLOBAL_CONTROL_BACKGROUND, width=5
+        )
+        self.tolerance.grid(row=row, column=col, sticky=EW)
+        tkExtra.Balloon.set(self.tolerance, _("Adaptive scan tolerance"))
+        self.addWidget(self.tolerance)
+
+        # Toolpath footprint
+        row += 1
+        col = 0
+        Label(lframe, text=_("Only cut:")).grid(row=row, column=col, sticky=E)
+        col += 1
+        self.toolpath = IntVar()
+        b = Checkbutton(
+            lframe,
+            variable=self.toolpath,
+            activebackground="LightYellow",
+            padx=2,
+            pady=1,
+        )
+        b.grid(row=row, column=col, sticky=W)
+        tkExtra.Balloon.set(
+            b,
+            _("Probe only the cells crossed by the enabled blocks, the "
+              "rest takes the nearest probed value"),
+        )
+        self.addWidget(b)
+
         lframe.grid_columnconfigure(1, weight=2)
         lframe.grid_columnconfigure(2, weight=2)
         lframe.grid_columnconfigure(3, weight=1)
@@ -1361,6 +1443,13 @@ class AutolevelFrame(CNCRibbon.PageFrame):
         Utils.setInt("Probe", "yn", self.probeYbins.get())
         Utils.setFloat("Probe", "zmin", self.probeZmin.get())
         Utils.setFloat("Probe", "zmax", self.probeZmax.get())
+        Utils.setInt(
+            "Probe", "interpolation",
+            PROBE_INTERPOLATION.index(self.interpolation.get())
+        )
+        Utils.setBool("Probe", "adaptive", self.adaptive.get())
+        Utils.setBool("Probe", "toolpath", self.toolpath.get())
+        Utils.setFloat("Probe", "tolerance", self.tolerance.get())
 
     # -----------------------------------------------------------------------
     def loadConfig(self):
@@ -1376,8 +1465,22 @@ class AutolevelFrame(CNCRibbon.PageFrame):
 
         self.probeYbins.delete(0, END)
         self.probeYbins.insert(0, max(2, Utils.getInt("Probe", "yn", 5)))
+        try:
+            self.interpolation.set(
+                PROBE_INTERPOLATION[Utils.getInt("Probe", "interpolation", 0)])
+        except IndexError:
+            pass
+        self.interpolationChange()
+        self.adaptive.set(Utils.getBool("Probe", "adaptive"))
+        self.toolpath.set(Utils.getBool("Probe", "toolpath"))
+        self.tolerance.set(Utils.getFloat("Probe", "tolerance", 0.01))
         self.change(False)
 
+    # -----------------------------------------------------------------------
+    def interpolationChange(self):
+        self.app.gcode.probe.setInterpolation(
+            PROBE_INTERPOLATION.index(self.interpolation.get()))
+
     # -----------------------------------------------------------------------
     def getMargins(self, event=None):
         self.probeXmin.set(str(CNC.vars["xmin"]))
@@ -1501,8 +1604,49 @@ class AutolevelFrame(CNCRibbon.PageFrame):
         if self.change():
             return
         self.event_generate("<<DrawProbe>>")
+        probe = self.app.gcode.probe
+        if self.toolpath.get():
+            self.app.gcode.probeFootprint()
+        else:
+            probe.footprint = None
+        if self.adaptive.get():
+            try:
+                tolerance = abs(float(self.tolerance.get()))
+            except ValueError:
+                messagebox.showerror(
+                    _("Probe Error"),
+                    _("Invalid adaptive scan tolerance"),
+                    parent=self.winfo_toplevel(),
+                )
+                return
+            self.app.run(lines=probe.scanAdaptive(tolerance))
+            self.after(SCAN_POLL, self.scanNext)
+            return
         # absolute
-        self.app.run(lines=self.app.gcode.probe.scan())
+        self.app.run(lines=probe.scan())
+
+    # -----------------------------------------------------------------------
+    # Start the next pass of an adaptive scan once the previous ended.
+    # A stop, an alarm or an error cancel the scan
+    # -----------------------------------------------------------------------
+    def scanNext(self):
+        if self.app.running:
+            self.after(SCAN_POLL, self.scanNext)
+            return
+        probe = self.app.gcode.probe
+        if CNC.vars["errline"] or "Alarm" in str(CNC.vars["state"]):
+            probe.scanCancel()
+            self.app.setStatus(_("Adaptive scan cancelled after an error"))
+            self.event_generate("<<DrawProbe>>")
+            return
+        lines = probe.scanNext()
+        if probe.warning:
+            self.app.setStatus(probe.warning)
+            probe.warning = None
+        self.event_generate("<<DrawProbe>>")
+        if lines:
+            self.app.run(lines=lines)
+            self.after(SCAN_POLL, self.scanNext)
 
     # -----------------------------------------------------------------------
     # Scan autolevel margins
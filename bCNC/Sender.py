@@ -7,11 +7,14 @@
 import glob
 import os
 import re
+import selectors
+import socket
 import sys
 import threading
 import time
 import traceback
 import webbrowser
+from collections import deque
 from datetime import datetime
 from tkinter import messagebox
 from queue import (
@@ -37,7 +40,9 @@ WIKI = "https://github.com/vlachoudis/bCNC/wiki"
 SERIAL_POLL = 0.125  # s
 SERIAL_TIMEOUT = 0.10  # s
 G_POLL = 10  # s
-RX_BUFFER_SIZE = 128
+RX_BUFFER_SIZE = 128  # default, until the controller reports its own
+STREAM_LOOKAHEAD = 1000  # lines compiled in advance while streaming
+LOG_SIZE = 10000  # display records kept until the terminal fetches them
 
 GPAT = re.compile(r"[A-Za-z]\s*[-+]?\d+.*")
 FEEDPAT = re.compile(r"^(.*)[fF](\d+\.?\d+)(.*)$")
@@ -68,6 +73,144 @@ STATECOLOR = {
 }
 
 
+# =============================================================================
+# Lengths of the commands sent and not yet acknowledged by the controller,
+# keeping a running total of the bytes occupying its RX buffer
+# =============================================================================
+class Pipeline(list):
+    def __init__(self):
+        list.__init__(self)
+        self.total = 0
+
+    # ----------------------------------------------------------------------
+    def append(self, length):
+        list.append(self, length)
+        self.total += length
+
+    # ----------------------------------------------------------------------
+    def __delitem__(self, item):
+        if isinstance(item, slice):
+            list.__delitem__(self, item)
+            self.total = sum(self)
+        else:
+            self.total -= self[item]
+            list.__delitem__(self, item)
+
+    # ----------------------------------------------------------------------
+    def clear(self):
+        list.clear(self)
+        self.total = 0
+
+
+# =============================================================================
+# Buffer of (type, text) log records, filled by the serial thread and
+# emptied at once by the GUI. The GUI tracks the run and the commands in
+# the controller buffer with the records, so they are all kept, except
+# the display only ones: if the GUI falls behind only the last size of
+# them are delivered instead of growing without bound
+# =============================================================================
+class LogBuffer:
+    def __init__(self, size=LOG_SIZE, display=()):
+        self.size = size
+        self.display = display  # record types which can be dropped
+        self._records = deque()
+        self._displayed = 0  # display only records in _records
+        self._lock = threading.Lock()
+
+    # ----------------------------------------------------------------------
+    def put(self, record):
+        with self._lock:
+            self._records.append(record)
+            if record[0] in self.display:
+                self._displayed += 1
+                if self._displayed >= 2 * self.size:
+                    self._trim()
+
+    # ----------------------------------------------------------------------
+    # Drop the oldest display only records keeping the last size of them
+    # ----------------------------------------------------------------------
+    def _trim(self):
+        drop = self._displayed - self.size
+        records = deque()
+        for record in self._records:
+            if drop and record[0] in self.display:
+                drop -= 1
+            else:
+                records.append(record)
+        self._records = records
+        self._displayed = self.size
+
+    # ----------------------------------------------------------------------
+    def qsize(self):
+        return len(self._records)
+
+    # ----------------------------------------------------------------------
+    # Remove and return all records
+    # ----------------------------------------------------------------------
+    def getAll(self):
+        with self._lock:
+            records = self._records
+            self._records = deque()
+            self._displayed = 0
+        return records
+
+
+# =============================================================================
+# Command queue waking up the serial I/O thread when something is put in it
+# =============================================================================
+class CommandQueue(Queue):
+    def __init__(self):
+        Queue.__init__(self)
+        self._wakeR, self._wakeW = socket.socketpair()
+        self._wakeR.setblocking(False)
+        self._wakeW.setblocking(False)
+        self._signaled = False
+
+    # ----------------------------------------------------------------------
+    def put(self, item, block=True, timeout=None):
+        Queue.put(self, item, block, timeout)
+        self.wakeup()
+
+    # ----------------------------------------------------------------------
+    # Wake up the I/O thread, only once until it drains the signal
+    # ----------------------------------------------------------------------
+    def wakeup(self):
+        if self._signaled:
+            return
+        self._signaled = True
+        try:
+            self._wakeW.send(b"\0")
+        except OSError:
+            pass
+
+    # ----------------------------------------------------------------------
+    # Block until less than size items are queued or stopFunc returns True.
+    # Every get() notifies not_full, release() wakes up the waiting thread
+    # ----------------------------------------------------------------------
+    def waitBelow(self, size, stopFunc):
+        with self.not_full:
+            while self._qsize() >= size and not stopFunc():
+                self.not_full.wait()
+
+    # ----------------------------------------------------------------------
+    def release(self):
+        with self.not_full:
+            self.not_full.notify_all()
+
+    # ----------------------------------------------------------------------
+    def drain(self):
+        try:
+            while self._wakeR.recv(4096):
+                pass
+        except OSError:
+            pass
+        self._signaled = False
+
+    # ----------------------------------------------------------------------
+    def fileno(self):
+        return self._wakeR.fileno()
+
+
 # =============================================================================
 # bCNC Sender class
 # =============================================================================
@@ -95,11 +238,19 @@ class Sender:
         self.gcode = GCode()
         self.cnc = self.gcode.cnc
 
-        self.log = Queue()  # Log queue returned from GRBL
-        self.queue = Queue()  # Command queue to be send to GRBL
+        # Log records returned from GRBL
+        self.log = LogBuffer(LOG_SIZE, (Sender.MSG_SEND, Sender.MSG_RECEIVE))
+        self.queue = CommandQueue()  # Command queue to be send to GRBL
         self.pendant = Queue()  # Command queue to be executed from Pendant
         self.serial = None
         self.thread = None
+        self.streaming = True  # compile lazily while sending
+        self._purge = False  # purge requested by the stopped producer
+        self._paths = None
+        self._runTotal = 0.0  # estimated time of the run [min]
+        self._runDone = 0.0  # estimated time of the executed lines [min]
+        self._timeI = 0  # last executed line summed in _runDone
+        self._timePath = None  # last line counted in _runDone
 
         self._posUpdate = False  # Update position
         self._probeUpdate = False  # Update probe
@@ -116,6 +267,8 @@ class Sender:
         self._alarm = True  # Display alarm message if true
         self._msg = None
         self._sumcline = 0
+        self.rxBufferSize = RX_BUFFER_SIZE
+        self._rxDetected = False
         self._lastFeed = 0
         self._newFeed = 0
 
@@ -157,6 +310,7 @@ class Sender:
         self.controllerSet(Utils.getStr("Connection", "controller"))
         Pendant.port = Utils.getInt("Connection", "pendantport", Pendant.port)
         GCode.LOOP_MERGE = Utils.getBool("File", "dxfloopmerge")
+        self.streaming = Utils.getBool("Connection", "streaming", True)
         self.loadHistory()
 
     # ----------------------------------------------------------------------
@@ -404,7 +558,7 @@ class Sender:
     def load(self, filename):
         fn, ext = os.path.splitext(filename)
         ext = ext.lower()
-        if ext == ".probe":
+        if ext in (".probe", ".pmap"):
             if filename is not None:
                 self.gcode.probe.filename = filename
                 self._saveConfigFile()
@@ -437,7 +591,7 @@ class Sender:
     def save(self, filename):
         fn, ext = os.path.splitext(filename)
         ext = ext.lower()
-        if ext == ".probe" or ext == ".xyz":
+        if ext in (".probe", ".pmap", ".xyz"):
             # save probe
             if not self.gcode.probe.isEmpty():
                 self.gcode.probe.save(filename)
@@ -512,6 +666,8 @@ class Sender:
             pass
         time.sleep(1)
         self.serial_write("\n\n")
+        self.rxBufferSize = RX_BUFFER_SIZE
+        self._rxDetected = False
         self.mcontrol.initController()
         self._gcount = 0
         self._alarm = True
@@ -531,6 +687,7 @@ class Sender:
             pass
         self._runLines = 0
         self.thread = None
+        self.queue.wakeup()
         time.sleep(1)
         try:
             self.serial.close()
@@ -642,18 +799,92 @@ class Sender:
 
     # ----------------------------------------------------------------------
     def getBufferFill(self):
-        return self._sumcline * 100.0 / RX_BUFFER_SIZE
+        return self._sumcline * 100.0 / self.rxBufferSize
+
+    # ----------------------------------------------------------------------
+    # Learn the RX buffer size from the free space reported by the
+    # controller while nothing of ours is pending in it. The largest
+    # value seen is kept, as the controller may still be draining bytes
+    # ----------------------------------------------------------------------
+    def rxBufferUpdate(self, rxbytes, cline):
+        if cline or rxbytes <= 0:
+            return
+        if not self._rxDetected or rxbytes > self.rxBufferSize:
+            self.rxBufferSize = rxbytes
+            self._rxDetected = True
 
     # ----------------------------------------------------------------------
     def initRun(self):
         self._quit = 0
         self._pause = False
         self._paths = None
+        self._purge = False
+        self._runTotal = 0.0
+        self._runDone = 0.0
+        self._timeI = 0
+        self._timePath = None
         self.running = True
         self.disable()
         self.emptyQueue()
         time.sleep(1)
 
+    # ----------------------------------------------------------------------
+    # Stream the enabled blocks to the controller. The program is compiled
+    # in a separate thread, keeping at most STREAM_LOOKAHEAD lines queued
+    # in front of the controller, so sending starts immediately and the
+    # memory doesn't grow with the file size. The thread compiles a copy
+    # of the blocks with its own CNC, so editing and drawing while it runs
+    # don't change what is sent.
+    # ----------------------------------------------------------------------
+    def stream(self):
+        self._paths = []
+        threading.Thread(target=self._streamProducer,
+                         args=(self.gcode.snapshot(), self._paths)).start()
+
+    # ----------------------------------------------------------------------
+    def _streamStop(self):
+        return self._stop
+
+    # ----------------------------------------------------------------------
+    # Thread compiling the g-code and feeding the queue
+    # ----------------------------------------------------------------------
+    def _streamProducer(self, program, paths):
+        cnc = CNC()
+        for line, path in self.gcode.compileIter(self._streamStop, program,
+                                                 cnc, cache=False):
+            self.queue.waitBelow(STREAM_LOOKAHEAD, self._streamStop)
+            if self._stop:
+                break
+            if isinstance(line, str):
+                self.queue.put(line + "\n")
+            elif isinstance(line, list):
+                # expressions are evaluated in place, send a copy
+                self.queue.put(line[:])
+            else:
+                self.queue.put(line)
+            paths.append(path)
+
+        probe = self.gcode.probe
+        if probe.warning:
+            self.log.put((Sender.MSG_ERROR, probe.warning))
+            probe.warning = None
+
+        if self._stop:
+            if self.thread is None:
+                self.runEnded()
+            else:
+                # the serial I/O thread purges the controller, it is the
+                # only one writing to the port while streaming
+                self._purge = True
+                self.queue.wakeup()
+        elif not paths:
+            self.runEnded()
+            self.log.put((Sender.MSG_ERROR, _("Not gcode file was loaded")))
+        else:
+            self.queue.put((WAIT,))  # wait at the end to become idle
+            # set it at the end to be sure that all lines are queued
+            self._runLines = len(paths) + 1
+
     # ----------------------------------------------------------------------
     # Called when run is finished
     # ----------------------------------------------------------------------
@@ -680,6 +911,9 @@ class Sender:
     def stopRun(self, event=None):
         self.feedHold()
         self._stop = True
+        self.gcode.probe.scanCancel()
+        self.queue.wakeup()
+        self.queue.release()
         # if we are in the process of submitting do not do anything
         if self._runLines != sys.maxsize:
             self.purgeController()
@@ -718,10 +952,12 @@ class Sender:
         # wait for commands to complete (status change to Idle)
         self.sio_wait = False
         self.sio_status = False  # waiting for status <...> report
-        cline = []  # length of pipeline commands
+        cline = Pipeline()  # length of pipeline commands
         sline = []  # pipeline commands
         tosend = None  # next string to send
         tr = tg = time.time()  # last time a ? or $G was send to grbl
+        self._rxbuf = b""
+        sel = self._ioSelector()
 
         while self.thread:
             t = time.time()
@@ -821,15 +1057,36 @@ class Sender:
                     cline.append(len(tosend))
 
             # Anything to receive?
-            if self.serial.inWaiting() or tosend is None:
-                try:
-                    line = str(self.serial.readline().decode("ascii", "ignore")).strip()
-                except Exception:
-                    self.log.put((Sender.MSG_RECEIVE, str(sys.exc_info()[1])))
-                    self.emptyQueue()
-                    self.close()
-                    return
+            try:
+                if sel is not None:
+                    # Sleep until the controller answers, a new command
+                    # arrives or the next status report is due
+                    if tosend is not None and cline.total < self.rxBufferSize:
+                        timeout = 0.0
+                    elif (
+                        tosend is None
+                        and not self.sio_wait
+                        and not self._pause
+                        and self.queue.qsize() > 0
+                    ):
+                        timeout = 0.0
+                    else:
+                        timeout = max(0.0, tr + SERIAL_POLL - time.time())
+                    lines = self._ioSelect(sel, timeout)
+                elif self.serial.inWaiting() or tosend is None:
+                    lines = [self.serial.readline()]
+                else:
+                    lines = ()
+            except Exception:
+                self.log.put((Sender.MSG_RECEIVE, str(sys.exc_info()[1])))
+                if sel is not None:
+                    sel.close()
+                self.emptyQueue()
+                self.close()
+                return
 
+            for line in lines:
+                line = str(line.decode("ascii", "ignore")).strip()
                 if not line:
                     pass
                 elif self.mcontrol.parseLine(line, cline, sline):
@@ -845,11 +1102,16 @@ class Sender:
                 # WARNING if runLines==maxint then it means we are
                 # still preparing/sending lines from from bCNC.run(),
                 # so don't stop
-                if self._runLines != sys.maxsize:
+                if self._purge:
+                    # the stream producer has stopped
+                    self._purge = False
+                    self._stop = False
+                    self.purgeController()
+                elif self._runLines != sys.maxsize:
                     self._stop = False
 
-            if tosend is not None and sum(cline) < RX_BUFFER_SIZE:
-                self._sumcline = sum(cline)
+            if tosend is not None and cline.total < self.rxBufferSize:
+                self._sumcline = cline.total
                 if self.mcontrol.gcode_case > 0:
                     tosend = tosend.upper()
                 if self.mcontrol.gcode_case < 0:
@@ -863,3 +1125,45 @@ class Sender:
                 if not self.running and t - tg > G_POLL:
                     self.mcontrol.viewState()
                     tg = t
+
+        if sel is not None:
+            sel.close()
+
+    # ----------------------------------------------------------------------
+    # Selector waiting on the serial port and the command queue, or None
+    # if the port can't be waited on (e.g. Windows or url handlers) and
+    # the serial I/O thread has to poll
+    # ----------------------------------------------------------------------
+    def _ioSelector(self):
+        try:
+            fd = self.serial.fileno()
+        except Exception:
+            return None
+        sel = selectors.DefaultSelector()
+        try:
+            sel.register(fd, selectors.EVENT_READ, "serial")
+            sel.register(self.queue, selectors.EVENT_READ, "queue")
+        except (OSError, ValueError):
+            sel.close()
+            return None
+        return sel
+
+    # ----------------------------------------------------------------------
+    # Wait up to timeout for data from the controller or a wake up call,
+    # and return the complete lines received
+    # ----------------------------------------------------------------------
+    def _ioSelect(self, sel, timeout):
+        ready = False
+        for key, _events in sel.select(timeout):
+            if key.data == "queue":
+                self.queue.drain()
+            else:
+                ready = True
+        if not ready:
+            return ()
+        # a readable port with nothing waiting means it was disconnected,
+        # a blocking read of one byte raises then the SerialException
+        self._rxbuf += self.serial.read(max(1, self.serial.in_waiting))
+        lines = self._rxbuf.split(b"\n")
+        self._rxbuf = lines.pop()
+        return lines
@@ -29,6 +29,8 @@ from Helpers import N_
 __author__ = "Vasilis Vlachoudis"
 __email__ = "vvlachoudis@gmail.com"
 
+TERMINAL_LINES = 1000  # default number of lines kept in the terminal
+
 
 # =============================================================================
 # Terminal Group
@@ -220,9 +222,83 @@ class TerminalFrame(CNCRibbon.PageFrame):
         self.grid_columnconfigure(0, weight=1)
         self.grid_rowconfigure(0, weight=1)
 
+        # Lines are collected here and the listboxes are updated
+        # in bulk by render()
+        self.maxLines = max(1, Utils.getInt("Connection", "terminallines",
+                                            TERMINAL_LINES))
+        self.lines = []  # (text, color) of the terminal
+        self.pending = []  # commands buffered in the controller
+        self._dirty = None  # first terminal line to redraw
+        self._pendingDirty = False
+
     # ----------------------------------------------------------------------
     def clear(self, event=None):
         self.terminal.delete(0, END)
+        del self.lines[:]
+        self._dirty = None
+
+    # ----------------------------------------------------------------------
+    # Add a line to the terminal, before the last 'before' lines if given
+    # ----------------------------------------------------------------------
+    def add(self, text, color=None, before=0):
+        pos = len(self.lines) - before
+        if before:
+            self.lines.insert(pos, (text, color))
+        else:
+            self.lines.append((text, color))
+        if self._dirty is None or pos < self._dirty:
+            self._dirty = pos
+
+    # ----------------------------------------------------------------------
+    def buffered(self, text):
+        self.pending.append(text)
+        self._pendingDirty = True
+
+    # ----------------------------------------------------------------------
+    # Remove and return the oldest buffered command
+    # ----------------------------------------------------------------------
+    def acknowledge(self):
+        if not self.pending:
+            return None
+        self._pendingDirty = True
+        return self.pending.pop(0)
+
+    # ----------------------------------------------------------------------
+    def clearBuffered(self):
+        del self.pending[:]
+        self._pendingDirty = True
+
+    # ----------------------------------------------------------------------
+    # Update the listboxes with the lines changed since the last call.
+    # Only the last maxLines are kept, so whatever the amount received
+    # it is at most one delete and one insert
+    # ----------------------------------------------------------------------
+    def render(self):
+        if self._pendingDirty:
+            self._pendingDirty = False
+            self.buffer.delete(0, END)
+            if self.pending:
+                self.buffer.insert(END, *self.pending)
+
+        if self._dirty is None:
+            return
+        excess = len(self.lines) - self.maxLines
+        if excess > 0:
+            del self.lines[:excess]
+            self.terminal.delete(0, excess - 1)
+            self._dirty = max(0, self._dirty - excess)
+
+        dirty = self._dirty
+        self._dirty = None
+        self.terminal.delete(dirty, END)
+        lines = self.lines[dirty:]
+        if not lines:
+            return
+        self.terminal.insert(END, *[text for text, color in lines])
+        for i, (text, color) in enumerate(lines, dirty):
+            if color is not None:
+                self.terminal.itemconfig(i, foreground=color)
+        self.terminal.see(END)
 
     # ----------------------------------------------------------------------
     def copy(self, event):
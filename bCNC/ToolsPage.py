@@ -647,6 +647,7 @@ class Config(_Base):
             ("travel_z", "mm", 100, _("Travel z")),
             ("round", "int", 4, _("Decimal digits")),
             ("accuracy", "mm", 0.1, _("Plotting Arc accuracy")),
+            ("optimize_time", "float", 2.0, _("Optimize time budget (s)")),
             ("startup", "str", "G90", _("Start up")),
             ("spindlemin", "int", 0, _("Spindle min (RPM)")),
             ("spindlemax", "int", 12000, _("Spindle max (RPM)")),
@@ -3,6 +3,7 @@
 import os
 import sys
 import getopt
+import multiprocessing
 
 PRGPATH = os.path.abspath(os.path.dirname(__file__))
 sys.path.append(PRGPATH)
@@ -209,6 +210,8 @@ def main():
     Utils.saveConfiguration()
 
 if __name__ == "__main__":
+	# pool workers of the frozen executable
+	multiprocessing.freeze_support()
 	sys.stdout.write("=" * 80 + "\n")
 	sys.stdout.write(
 		"WARNING: bCNC was recently ported to only support \n"
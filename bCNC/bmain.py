@@ -120,6 +120,7 @@ FILETYPES = [
             "*.gcode",
             "*.dxf",
             "*.probe",
+            "*.pmap",
             "*.orient",
             "*.stl",
             "*.svg",
@@ -129,7 +130,7 @@ FILETYPES = [
     (_("G-Code clean"), ("*.txt")),
     ("DXF", "*.dxf"),
     ("SVG", "*.svg"),
-    (_("Probe"), ("*.probe", "*.xyz")),
+    (_("Probe"), ("*.probe", "*.pmap", "*.xyz")),
     (_("Orient"), "*.orient"),
     ("STL", "*.stl"),
     (_("All"), "*"),
@@ -1205,6 +1206,27 @@ class Application(Tk, Sender):
 
         frame.grid_columnconfigure(1, weight=1)
 
+        # ===========
+        frame = LabelFrame(toplevel, text=_("Block Time"),
+                           foreground="DarkRed")
+        frame.pack(fill=BOTH, expand=YES)
+
+        blockList = tkExtra.MultiListbox(
+            frame,
+            ((_("Block"), 24, None), (_("Time"), 10, None)),
+            height=min(10, max(e, 1)),
+            stretch="first",
+            background=tkExtra.GLOBAL_CONTROL_BACKGROUND,
+        )
+        blockList.sortAssist = None
+        blockList.pack(fill=BOTH, expand=YES)
+        for block in self.gcode.blocks:
+            if block.enable:
+                h, m = divmod(block.time, 60)  # t in min
+                s = (m - int(m)) * 60
+                blockList.insert(
+                    END, (block.name(), f"{int(h)}:{int(m):02}:{int(s):02}"))
+
         # ===========
         frame = LabelFrame(toplevel, text=_("All GCode"), foreground="DarkRed")
         frame.pack(fill=BOTH)
@@ -1719,7 +1741,8 @@ class Application(Tk, Sender):
                     dz = 0.0
             self.executeOnSelection("MOVE", False, dx, dy, dz)
 
-        # OPT*IMIZE: reorder selected blocks to minimize rapid motions
+        # OPT*IMIZE [REV*ERSE]: reorder selected blocks to minimize rapid
+        # motions, optionally reversing their direction
         elif rexx.abbrev("OPTIMIZE", cmd, 3):
             if not self.editor.curselection():
                 messagebox.showinfo(
@@ -1729,7 +1752,9 @@ class Application(Tk, Sender):
                     parent=self,
                 )
             else:
-                self.executeOnSelection("OPTIMIZE", True)
+                reverse = len(line) > 1 and rexx.abbrev(
+                    "REVERSE", line[1].upper(), 3)
+                self.executeOnSelection("OPTIMIZE", True, reverse)
 
         # # FIXME comment for ORIENT not OPTIMIZE
         # OPT*IMIZE: reorder selected blocks to minimize rapid motions
@@ -2008,7 +2033,7 @@ class Application(Tk, Sender):
         elif cmd == "MOVE":
             self.gcode.moveLines(items, *args)
         elif cmd == "OPTIMIZE":
-            self.gcode.optimize(items)
+            self.gcode.optimize(items, *args)
         elif cmd == "ORIENT":
             self.gcode.orientLines(items)
         elif cmd == "REVERSE":
@@ -2351,7 +2376,8 @@ class Application(Tk, Sender):
     # -----------------------------------------------------------------------
     def load(self, filename, autoloaded=False):
         fn, ext = os.path.splitext(filename)
-        if ext == ".probe":
+        ext = ext.lower()
+        if ext in (".probe", ".pmap"):
             pass
         else:
             if self.fileModified():
@@ -2369,7 +2395,7 @@ class Application(Tk, Sender):
         self.setStatus(_("Loading: {} ...").format(filename), True)
         Sender.load(self, filename)
 
-        if ext == ".probe":
+        if ext in (".probe", ".pmap"):
             self.autolevel.setValues()
             self.event_generate("<<DrawProbe>>")
 
@@ -2391,8 +2417,14 @@ class Application(Tk, Sender):
                 _("'{}' reloaded at '{}'").format(
                     filename, str(datetime.now()))
             )
+        elif self.gcode.cacheError:
+            self.setStatus(
+                _("'{}' loaded, cache entry discarded: {}").format(
+                    filename, self.gcode.cacheError)
+            )
         else:
             self.setStatus(_("'{}' loaded").format(filename))
+        self.gcode.cacheError = None
         self.title(
             f"{Utils.__prg__} {__version__}: {self.gcode.filename} "
             + f"{__platform_fingerprint__}"
@@ -2579,39 +2611,36 @@ class Application(Tk, Sender):
         if lines is None:
             self.statusbar.setLimits(0, 9999)
             self.statusbar.setProgress(0, 0)
-            self._paths = self.gcode.compile(self.queue, self.checkStop)
-            if self._paths is None:
-                self.emptyQueue()
-                self.purgeController()
-                return
-            elif not self._paths:
-                self.runEnded()
-                messagebox.showerror(
-                    _("Empty gcode"),
-                    _("Not gcode file was loaded"),
-                    parent=self
-                )
-                return
-
-            # reset colors
-            before = time.time()
-            for ij in self._paths:  # Slow loop
-                if not ij:
-                    continue
-                path = self.gcode[ij[0]].path(ij[1])
-                if path:
-                    color = self.canvas.itemcget(path, "fill")
-                    if color != CNCCanvas.ENABLE_COLOR:
-                        self.canvas.itemconfig(
-                            path, width=1, fill=CNCCanvas.ENABLE_COLOR
-                        )
-                    # Force a periodic update since this loop can take time
-                    if time.time() - before > 0.25:
-                        self.update()
-                        before = time.time()
-
-            # the buffer of the machine should be empty?
-            self._runLines = len(self._paths) + 1  # plus the wait
+            self._runTotal = sum(block.time for block in self.gcode.blocks
+                                 if block.enable)
+            if self.streaming:
+                self.resetRunColors()
+                # estimate of the number of lines until streaming completes
+                total = sum(len(block) for block in self.gcode.blocks
+                            if block.enable)
+                self.stream()
+                self.statusbar.setLimits(0, total + 1)
+            else:
+                self._paths = self.gcode.compile(self.queue, self.checkStop)
+                if self._paths is None:
+                    self.emptyQueue()
+                    self.purgeController()
+                    return
+                elif not self._paths:
+                    self.runEnded()
+                    messagebox.showerror(
+                        _("Empty gcode"),
+                        _("Not gcode file was loaded"),
+                        parent=self
+                    )
+                    return
+
+                self.resetRunColors()
+
+                # the buffer of the machine should be empty?
+                self._runLines = len(self._paths) + 1  # plus the wait
+                self.queue.put((WAIT,))  # wait at the end to become idle
+                self.statusbar.setLimits(0, self._runLines)
         else:
             n = 1  # including one wait command
             for line in CNC.compile(lines):
@@ -2623,10 +2652,10 @@ class Application(Tk, Sender):
                     n += 1
             # set it at the end to be sure that all lines are queued
             self._runLines = n
-        self.queue.put((WAIT,))  # wait at the end to become idle
+            self.queue.put((WAIT,))  # wait at the end to become idle
+            self.statusbar.setLimits(0, self._runLines)
 
         self.setStatus(_("Running..."))
-        self.statusbar.setLimits(0, self._runLines)
         self.statusbar.configText(fill="White")
         self.statusbar.config(background="DarkGray")
 
@@ -2634,6 +2663,31 @@ class Application(Tk, Sender):
         self.bufferbar.config(background="DarkGray")
         self.bufferbar.setText("")
 
+    # -----------------------------------------------------------------------
+    # Reset the colors of the paths processed in a previous run
+    # -----------------------------------------------------------------------
+    def resetRunColors(self):
+        self.canvas.resetProcess()
+        before = time.time()
+        for block in self.gcode.blocks:  # Slow loop
+            if not block.enable:
+                continue
+            last = None
+            for path in block._path:
+                # consecutive lines share the same path
+                if not path or path == last:
+                    continue
+                last = path
+                color = self.canvas.itemcget(path, "fill")
+                if color != CNCCanvas.ENABLE_COLOR:
+                    self.canvas.itemconfig(
+                        path, width=1, fill=CNCCanvas.ENABLE_COLOR
+                    )
+                # Force a periodic update since this loop can take time
+                if time.time() - before > 0.25:
+                    self.update()
+                    before = time.time()
+
     # -----------------------------------------------------------------------
     # Start the web pendant
     # -----------------------------------------------------------------------
@@ -2671,79 +2725,52 @@ class Application(Tk, Sender):
     # -----------------------------------------------------------------------
     def _monitorSerial(self):
         # Check serial output
-        t = time.time()
+        # dump in the terminal everything received since the last call
+        records = self.log.getAll()
+        term = Page.frames["Terminal"]
+        for msg, line in records:
+            line = str(line).rstrip("\n")
+
+            if msg == Sender.MSG_BUFFER:
+                term.buffered(line)
+
+            elif msg == Sender.MSG_SEND:
+                term.add(line, "Blue")
+
+            elif msg == Sender.MSG_RECEIVE:
+                term.add(line)
+                if self._insertCount:
+                    # when counting is started, then continue
+                    self._insertCount += 1
+                elif line and line[0] in ("[", "$"):
+                    # start the counting on the first line received
+                    # starting with $ or [
+                    self._insertCount = 1
+
+            elif msg in (Sender.MSG_OK, Sender.MSG_ERROR):
+                cmd = term.acknowledge()
+                if cmd is not None:
+                    term.add(cmd, "Blue", self._insertCount)
+                self._insertCount = 0
+                if msg == Sender.MSG_OK:
+                    term.add(line)
+                else:
+                    term.add(line, "Red")
 
-        # dump in the terminal what ever you can in less than 0.1s
-        inserted = False
-        while self.log.qsize() > 0 and time.time() - t < 0.1:
-            try:
-                msg, line = self.log.get_nowait()
-                line = str(line).rstrip("\n")
-                inserted = True
-
-                if msg == Sender.MSG_BUFFER:
-                    self.buffer.insert(END, line)
-
-                elif msg == Sender.MSG_SEND:
-                    self.terminal.insert(END, line)
-                    self.terminal.itemconfig(END, foreground="Blue")
-
-                elif msg == Sender.MSG_RECEIVE:
-                    self.terminal.insert(END, line)
-                    if self._insertCount:
-                        # when counting is started, then continue
-                        self._insertCount += 1
-                    elif line and line[0] in ("[", "$"):
-                        # start the counting on the first line received
-                        # starting with $ or [
-                        self._insertCount = 1
-
-                elif msg == Sender.MSG_OK:
-                    if self.terminal.size() > 0:
-                        if self._insertCount:
-                            pos = self.terminal.size() - self._insertCount
-                            self._insertCount = 0
-                        else:
-                            pos = END
-                        self.terminal.insert(pos, self.buffer.get(0))
-                        self.terminal.itemconfig(pos, foreground="Blue")
-                        self.buffer.delete(0)
-                    self.terminal.insert(END, line)
-
-                elif msg == Sender.MSG_ERROR:
-                    if self.terminal.size() > 0:
-                        if self._insertCount:
-                            pos = self.terminal.size() - self._insertCount
-                            self._insertCount = 0
-                        else:
-                            pos = END
-                        self.terminal.insert(pos, self.buffer.get(0))
-                        self.terminal.itemconfig(pos, foreground="Blue")
-                        self.buffer.delete(0)
-                    self.terminal.insert(END, line)
-                    self.terminal.itemconfig(END, foreground="Red")
-
-                elif msg == Sender.MSG_RUNEND:
-                    self.terminal.insert(END, line)
-                    self.terminal.itemconfig(END, foreground="Magenta")
-                    self.setStatus(line)
-                    self.enable()
-
-                elif msg == Sender.MSG_CLEAR:
-                    self.buffer.delete(0, END)
+            elif msg == Sender.MSG_RUNEND:
+                term.add(line, "Magenta")
+                self.setStatus(line)
+                self.enable()
 
-                else:
-                    # Unknown?
-                    self.buffer.insert(END, line)
-                    self.terminal.itemconfig(END, foreground="Magenta")
+            elif msg == Sender.MSG_CLEAR:
+                term.clearBuffered()
 
-                if self.terminal.size() > 1000:
-                    self.terminal.delete(0, 500)
-            except Empty:
-                break
+            else:
+                # Unknown?
+                term.buffered(line)
 
-        if inserted:
-            self.terminal.see(END)
+        if records:
+            term.render()
 
         # Check pendant
         try:
@@ -2803,9 +2830,20 @@ class Application(Tk, Sender):
             self._update = None
 
         if self.running:
-            self.statusbar.setProgress(
-                self._runLines - self.queue.qsize(), self._gcount
-            )
+            if self._runLines == sys.maxsize:
+                # still streaming, the total is not known yet
+                if self._paths is not None:
+                    self.statusbar.setProgress(
+                        len(self._paths) - self.queue.qsize(), self._gcount,
+                        remain=self.runRemain()
+                    )
+            else:
+                if self.statusbar.high != self._runLines:
+                    self.statusbar.setHigh(self._runLines)
+                self.statusbar.setProgress(
+                    self._runLines - self.queue.qsize(), self._gcount,
+                    remain=self.runRemain()
+                )
             CNC.vars["msg"] = self.statusbar.msg
             self.bufferbar.setProgress(Sender.getBufferFill(self))
             self.bufferbar.setText(f"{Sender.getBufferFill(self):3.0f}%")
@@ -2816,16 +2854,31 @@ class Application(Tk, Sender):
                 ):
                     if self._paths[self._selectI]:
                         i, j = self._paths[self._selectI]
-                        path = self.gcode[i].path(j)
-                        if path:
-                            self.canvas.itemconfig(
-                                path, width=2, fill=CNCCanvas.PROCESS_COLOR
-                            )
+                        self.canvas.processPath(i, j)
                     self._selectI += 1
 
             if self._gcount >= self._runLines:
                 self.runEnded()
 
+    # -----------------------------------------------------------------------
+    # @return the estimated remaining time [s] of the run, from the time of
+    # the executed lines, or None if not known. A source line expanded to
+    # many compiled lines (autolevel, tool change) is counted once
+    # -----------------------------------------------------------------------
+    def runRemain(self):
+        if not self._runTotal or not self._paths:
+            return None
+        paths = self._paths
+        done = min(self._gcount, len(paths))
+        while self._timeI < done:
+            path = paths[self._timeI]
+            if path and path != self._timePath:
+                bid, lid = path
+                self._runDone += self.gcode.blocks[bid].lineTime(lid)
+                self._timePath = path
+            self._timeI += 1
+        return max(self._runTotal - self._runDone, 0.0) * 60.0
+
     # -----------------------------------------------------------------------
     # "thread" timed function looking for messages in the serial thread
     # and reporting back in the terminal
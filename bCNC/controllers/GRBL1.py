@@ -164,6 +164,7 @@ class Controller(_GenericGRBL):
                 try:
                     CNC.vars["planner"] = int(word[1])
                     CNC.vars["rxbytes"] = int(word[2])
+                    self.master.rxBufferUpdate(CNC.vars["rxbytes"], cline)
                 except (ValueError, IndexError):
                     CNC.vars["state"] = f"Garbage receive {word[0]}: {line}"
                     self.master.log.put(
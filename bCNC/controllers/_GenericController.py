@@ -195,6 +195,7 @@ class _GenericController:
         self.master._msg = None
         self.master._alarm = False
         self.master._pause = False
+        self.master.queue.wakeup()
 
     # ----------------------------------------------------------------------
     def pause(self, event=None):
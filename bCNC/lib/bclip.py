@@ -0,0 +1,418 @@
+# Polygon union with the positive winding rule
+#
+# Used to remove the self intersections of the raw offset polygons.
+# The polygons are lists of (x, y) points, implicitly closed. The edges are
+# split at all their crossings, the faces of the resulting planar graph are
+# traced and their winding numbers propagated across the edges. The edges
+# separating the filled faces (winding >= 1) from the empty ones are then
+# joined into loops with the filled area on their left: outer loops are
+# CCW and holes CW.
+#
+# A point can carry a tag as third item (x, y, tag), attached to the edge
+# starting at it. The tags follow the edges through the splits and are
+# returned the same way on the loop points.
+
+from math import atan2, sqrt
+
+EPS = 1e-9  # snapping tolerance relative to the size of the polygons
+
+
+# -----------------------------------------------------------------------------
+# Return the union of the polygons as a list of loops
+# -----------------------------------------------------------------------------
+def union(polygons):
+    graph = _Graph(polygons)
+    if not graph.edges:
+        return []
+    graph.intersect()
+    graph.split()
+    if not graph.origin:
+        return []  # all the edges cancel out
+    graph.faces()
+    graph.winding()
+    return graph.loops()
+
+
+# -----------------------------------------------------------------------------
+# Signed area of a polygon, positive when CCW
+# -----------------------------------------------------------------------------
+def area(polygon):
+    a = 0.0
+    x0, y0 = polygon[-1][:2]
+    for p in polygon:
+        a += x0 * p[1] - p[0] * y0
+        x0, y0 = p[:2]
+    return a / 2.0
+
+
+# =============================================================================
+# Planar graph of the polygon edges
+# =============================================================================
+class _Graph:
+    # ----------------------------------------------------------------------
+    def __init__(self, polygons):
+        xs = [p[0] for polygon in polygons for p in polygon]
+        ys = [p[1] for polygon in polygons for p in polygon]
+        if not xs:
+            self.edges = []
+            return
+        size = max(max(xs) - min(xs), max(ys) - min(ys), 1.0)
+        self.tol = EPS * size
+
+        self.nodes = []  # node coordinates
+        self._snap = {}  # snapping cell -> node ids
+        self.edges = []  # (node a, node b)
+        self.tags = []  # tag of every edge
+        self.tagged = False
+        for polygon in polygons:
+            ids = [self.node(p[0], p[1]) for p in polygon]
+            for p, a, b in zip(polygon, ids, ids[1:] + ids[:1]):
+                if a != b:
+                    self.edges.append((a, b))
+                    if len(p) > 2:
+                        self.tags.append(p[2])
+                        self.tagged = True
+                    else:
+                        self.tags.append(None)
+
+    # ----------------------------------------------------------------------
+    # Return the id of the node at x,y merging nodes closer than tol
+    # ----------------------------------------------------------------------
+    def node(self, x, y):
+        tol = self.tol
+        i = int(x // tol)
+        j = int(y // tol)
+        for di in (-1, 0, 1):
+            for dj in (-1, 0, 1):
+                for n in self._snap.get((i + di, j + dj), ()):
+                    px, py = self.nodes[n]
+                    if abs(px - x) <= tol and abs(py - y) <= tol:
+                        return n
+        n = len(self.nodes)
+        self.nodes.append((x, y))
+        self._snap.setdefault((i, j), []).append(n)
+        return n
+
+    # ----------------------------------------------------------------------
+    # Find the crossings of all edges using a uniform grid, and record the
+    # nodes where every edge has to be split
+    # ----------------------------------------------------------------------
+    def intersect(self):
+        nodes = self.nodes
+        boxes = []
+        for a, b in self.edges:
+            ax, ay = nodes[a]
+            bx, by = nodes[b]
+            boxes.append((min(ax, bx), min(ay, by), max(ax, bx), max(ay, by)))
+
+        minx = min(box[0] for box in boxes)
+        miny = min(box[1] for box in boxes)
+        w = max(max(box[2] for box in boxes) - minx, self.tol)
+        h = max(max(box[3] for box in boxes) - miny, self.tol)
+        n = len(boxes)
+        side = sqrt(w * h / n)
+        nx = max(1, min(n, int(w / side)))
+        ny = max(1, min(n, int(h / side)))
+        dx = w / nx
+        dy = h / ny
+
+        def cell(x, y):
+            return (min(max(int((x - minx) / dx), 0), nx - 1),
+                    min(max(int((y - miny) / dy), 0), ny - 1))
+
+        cells = {}
+        for k, (x0, y0, x1, y1) in enumerate(boxes):
+            i0, j0 = cell(x0, y0)
+            i1, j1 = cell(x1, y1)
+            for i in range(i0, i1 + 1):
+                for j in range(j0, j1 + 1):
+                    cells.setdefault((i, j), []).append(k)
+
+        self._splits = [[] for _ in self.edges]
+        tol = self.tol
+        for key in sorted(cells):
+            edges = cells[key]
+            for p, e in enumerate(edges):
+                bx0, by0, bx1, by1 = boxes[e]
+                for f in edges[p + 1:]:
+                    cx0, cy0, cx1, cy1 = boxes[f]
+                    lx = max(bx0, cx0)
+                    ly = max(by0, cy0)
+                    if lx > min(bx1, cx1) + tol or ly > min(by1, cy1) + tol:
+                        continue
+                    # test every pair only once, in the cell of the lower
+                    # left corner of the common box
+                    if cell(lx, ly) != key:
+                        continue
+                    self._cross(e, f)
+
+    # ----------------------------------------------------------------------
+    # Record the crossing of edges e and f
+    # ----------------------------------------------------------------------
+    def _cross(self, e, f):
+        nodes = self.nodes
+        a, b = self.edges[e]
+        c, d = self.edges[f]
+        px, py = nodes[a]
+        rx = nodes[b][0] - px
+        ry = nodes[b][1] - py
+        qx, qy = nodes[c]
+        sx = nodes[d][0] - qx
+        sy = nodes[d][1] - qy
+        lr = sqrt(rx * rx + ry * ry)
+        ls = sqrt(sx * sx + sy * sy)
+        tol = self.tol
+
+        denom = rx * sy - ry * sx
+        qpx = qx - px
+        qpy = qy - py
+        if abs(denom) <= tol * tol + EPS * lr * ls:
+            # parallel, split at the ends overlapping the other edge
+            if abs(qpx * ry - qpy * rx) > tol * lr:
+                return
+            self._splitAt(e, c, True)
+            self._splitAt(e, d, True)
+            self._splitAt(f, a, True)
+            self._splitAt(f, b, True)
+            return
+
+        t = (qpx * sy - qpy * sx) / denom
+        u = (qpx * ry - qpy * rx) / denom
+        tt = tol / lr
+        tu = tol / ls
+        if t < -tt or t > 1.0 + tt or u < -tu or u > 1.0 + tu:
+            return
+        t = min(max(t, 0.0), 1.0)
+        n = self.node(px + t * rx, py + t * ry)
+        self._splitAt(e, n)
+        self._splitAt(f, n)
+
+    # ----------------------------------------------------------------------
+    # Split edge e at node n, if clip only when n lays inside the edge
+    # ----------------------------------------------------------------------
+    def _splitAt(self, e, n, clip=False):
+        a, b = self.edges[e]
+        if n == a or n == b:
+            return
+        ax, ay = self.nodes[a]
+        rx = self.nodes[b][0] - ax
+        ry = self.nodes[b][1] - ay
+        px = self.nodes[n][0] - ax
+        py = self.nodes[n][1] - ay
+        t = (px * rx + py * ry) / (rx * rx + ry * ry)
+        if not clip or 0.0 < t < 1.0:
+            self._splits[e].append((t, n))
+
+    # ----------------------------------------------------------------------
+    # Split the edges at the crossings, merge the coincident ones and build
+    # the half edges sorted by angle around every node
+    # ----------------------------------------------------------------------
+    def split(self):
+        count = {}  # (a, b) with a < b -> net multiplicity from a to b
+        tags = {}  # (a, b) with a < b -> tag of the first edge
+        for (a, b), tag, splits in zip(self.edges, self.tags, self._splits):
+            splits.sort()
+            chain = [a] + [n for t, n in splits] + [b]
+            for u, v in zip(chain, chain[1:]):
+                if u == v:
+                    continue
+                if u < v:
+                    count[u, v] = count.get((u, v), 0) + 1
+                else:
+                    count[v, u] = count.get((v, u), 0) - 1
+                tags.setdefault((min(u, v), max(u, v)), tag)
+        del self._splits
+
+        # half edge 2k goes from a to b, 2k+1 from b to a
+        self.origin = []
+        self.mult = []
+        self.tags = []
+        for (a, b), m in sorted(count.items()):
+            if m == 0:
+                continue
+            self.origin.append(a)
+            self.origin.append(b)
+            self.mult.append(m)
+            self.mult.append(-m)
+            self.tags.append(tags[a, b])
+
+        # outgoing half edges of every node sorted CCW
+        nodes = self.nodes
+        out = {}
+        for h, a in enumerate(self.origin):
+            out.setdefault(a, []).append(h)
+        self.pos = [0] * len(self.origin)
+        for a, hs in out.items():
+            ax, ay = nodes[a]
+            hs.sort(key=lambda h: atan2(nodes[self.origin[h ^ 1]][1] - ay,
+                                        nodes[self.origin[h ^ 1]][0] - ax))
+            for i, h in enumerate(hs):
+                self.pos[h] = i
+        self.out = out
+
+    # ----------------------------------------------------------------------
+    # Trace the faces keeping them on the left of the half edges
+    # ----------------------------------------------------------------------
+    def faces(self):
+        nodes = self.nodes
+        origin = self.origin
+        self.face = [-1] * len(origin)
+        self.areas = []
+        for start in range(len(origin)):
+            if self.face[start] >= 0:
+                continue
+            f = len(self.areas)
+            a = 0.0
+            h = start
+            while self.face[h] < 0:
+                self.face[h] = f
+                x0, y0 = nodes[origin[h]]
+                x1, y1 = nodes[origin[h ^ 1]]
+                a += x0 * y1 - x1 * y0
+                h = self._next(h)
+            self.areas.append(a / 2.0)
+
+    # ----------------------------------------------------------------------
+    # Next half edge after h, the first clockwise from its twin
+    # ----------------------------------------------------------------------
+    def _next(self, h):
+        hs = self.out[self.origin[h ^ 1]]
+        return hs[self.pos[h ^ 1] - 1]
+
+    # ----------------------------------------------------------------------
+    # Winding number of every face, propagated across the half edges from
+    # the outer face of every connected component
+    # ----------------------------------------------------------------------
+    def winding(self):
+        nodes = self.nodes
+        origin = self.origin
+        mult = self.mult
+        face = self.face
+
+        # connected components of the nodes
+        parent = list(range(len(nodes)))
+
+        def find(n):
+            while parent[n] != n:
+                parent[n] = parent[parent[n]]
+                n = parent[n]
+            return n
+
+        for h in range(0, len(origin), 2):
+            a = find(origin[h])
+            b = find(origin[h + 1])
+            if a != b:
+                parent[max(a, b)] = min(a, b)
+        comp = [find(a) for a in origin]
+
+        # faces bordered by every half edge, grouped by component
+        border = {}
+        components = {}
+        for h, f in enumerate(face):
+            border.setdefault(f, []).append(h)
+            components.setdefault(comp[h], []).append(h)
+
+        # rows of edges for the ray casting
+        ys = [nodes[a][1] for a in origin]
+        miny = min(ys)
+        nrows = max(1, int(sqrt(len(origin) / 2)))
+        dy = max(max(ys) - miny, self.tol) / nrows
+        rows = [[] for _ in range(nrows)]
+        for h in range(0, len(origin), 2):
+            ay = nodes[origin[h]][1]
+            by = nodes[origin[h + 1]][1]
+            r0 = min(int((min(ay, by) - miny) / dy), nrows - 1)
+            r1 = min(int((max(ay, by) - miny) / dy), nrows - 1)
+            for r in range(r0, r1 + 1):
+                rows[r].append(h)
+
+        self.wind = [None] * len(self.areas)
+        for c in sorted(components):
+            hs = components[c]
+            outer = min((face[h] for h in hs),
+                        key=lambda f: (self.areas[f], f))
+
+            # winding of the leftmost node wrt the other components
+            x, y = min(nodes[origin[h]] for h in hs)
+            w = 0
+            for h in rows[min(int((y - miny) / dy), nrows - 1)]:
+                if comp[h] == c:
+                    continue
+                ax, ay = nodes[origin[h]]
+                bx, by = nodes[origin[h + 1]]
+                if (ay <= y < by) or (by <= y < ay):
+                    if ax + (y - ay) * (bx - ax) / (by - ay) < x:
+                        w += -mult[h] if by > ay else mult[h]
+
+            self.wind[outer] = w
+            stack = [outer]
+            while stack:
+                f = stack.pop()
+                for h in border[f]:
+                    g = face[h ^ 1]
+                    if self.wind[g] is None:
+                        self.wind[g] = self.wind[f] - mult[h]
+                        stack.append(g)
+
+    # ----------------------------------------------------------------------
+    # Join the half edges with filled face on the left and empty on the
+    # right into loops
+    # ----------------------------------------------------------------------
+    def loops(self):
+        nodes = self.nodes
+        origin = self.origin
+        face = self.face
+        wind = self.wind
+        kept = [wind[face[h]] >= 1 and wind[face[h ^ 1]] < 1
+                for h in range(len(origin))]
+
+        loops = []
+        visited = [False] * len(origin)
+        for start in range(len(origin)):
+            if not kept[start] or visited[start]:
+                continue
+            loop = []
+            h = start
+            while not visited[h]:
+                visited[h] = True
+                if self.tagged:
+                    loop.append(nodes[origin[h]] + (self.tags[h >> 1],))
+                else:
+                    loop.append(nodes[origin[h]])
+                # tightest turn to the right
+                hs = self.out[origin[h ^ 1]]
+                i = self.pos[h ^ 1]
+                for k in range(1, len(hs) + 1):
+                    g = hs[(i - k) % len(hs)]
+                    if kept[g]:
+                        break
+                h = g
+            loop = self._simplify(loop)
+            if len(loop) >= 3:
+                loops.append(loop)
+        return loops
+
+    # ----------------------------------------------------------------------
+    # Remove the points in the middle of straight lines with the same tag
+    # ----------------------------------------------------------------------
+    def _simplify(self, loop):
+        tol = self.tol
+        result = []
+        n = len(loop)
+        for i in range(n):
+            prev = result[-1] if result else loop[i - 1]
+            if prev[2:] != loop[i][2:]:
+                result.append(loop[i])
+                continue
+            x0, y0 = prev[:2]
+            x1, y1 = loop[i][:2]
+            x2, y2 = loop[(i + 1) % n][:2]
+            ux = x1 - x0
+            uy = y1 - y0
+            vx = x2 - x1
+            vy = y2 - y1
+            l = sqrt(ux * ux + uy * uy) + sqrt(vx * vx + vy * vy)
+            if abs(ux * vy - uy * vx) <= tol * l and ux * vx + uy * vy > 0.0:
+                continue
+            result.append(loop[i])
+        return result
@@ -8,6 +8,7 @@
 
 from copy import deepcopy
 from math import (
+    acos,
     atan,
     atan2,
     ceil,
@@ -19,6 +20,7 @@ from math import (
 )
 from operator import itemgetter
 
+import bclip
 from bmath import Vector, quadratic
 from Helpers import to_zip
 
@@ -30,6 +32,7 @@ EPS2 = EPS**2
 EPSV = EPS * 10  # relaxed tolerances for vectors
 EPSV2 = EPSV**2
 PI2 = 2.0 * pi
+POCKET_MAXDEPTH = 10000  # maximum number of pocket rings
 
 
 # -----------------------------------------------------------------------------
@@ -711,6 +714,144 @@ class Segment:
         return new
 
 
+# =============================================================================
+# Uniform grid over the bounding boxes of a list of segments, to retrieve
+# quickly the segments that may intersect or be close to a region
+# =============================================================================
+class SegmentGrid:
+    # ----------------------------------------------------------------------
+    def __init__(self, segments):
+        self.segments = list(segments)
+        self.stamp = tuple(map(id, self.segments))
+        self.cells = {}
+        if not self.segments:
+            self.minx = self.miny = self.maxx = self.maxy = 0.0
+            self.dx = self.dy = 1.0
+            self.nx = self.ny = 1
+            return
+
+        self.minx = min(s.minx for s in self.segments)
+        self.miny = min(s.miny for s in self.segments)
+        self.maxx = max(s.maxx for s in self.segments)
+        self.maxy = max(s.maxy for s in self.segments)
+        w = max(self.maxx - self.minx, EPSV)
+        h = max(self.maxy - self.miny, EPSV)
+
+        # about one cell per segment, square as far as possible
+        n = len(self.segments)
+        side = sqrt(w * h / n)
+        self.nx = max(1, min(n, int(w / side)))
+        self.ny = max(1, min(n, int(h / side)))
+        self.dx = w / self.nx
+        self.dy = h / self.ny
+
+        for k, segment in enumerate(self.segments):
+            minx, miny, maxx, maxy = self._extent(segment)
+            i0, i1 = self._col(minx), self._col(maxx)
+            j0, j1 = self._row(miny), self._row(maxy)
+            for i in range(i0, i1 + 1):
+                for j in range(j0, j1 + 1):
+                    cell = self.cells.get((i, j))
+                    if cell is None:
+                        self.cells[i, j] = [k]
+                    else:
+                        cell.append(k)
+
+    # ----------------------------------------------------------------------
+    # Extent of the segment, for arcs only the part of the circle swept
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def _extent(segment):
+        if segment.type == Segment.LINE:
+            return segment.minx, segment.miny, segment.maxx, segment.maxy
+        xs = [segment.A[0], segment.B[0]]
+        ys = [segment.A[1], segment.B[1]]
+        cx, cy = segment.C[0], segment.C[1]
+        r = segment.radius
+        for x, y in ((cx + r, cy), (cx - r, cy), (cx, cy + r), (cx, cy - r)):
+            if segment._insideArc((x, y)):
+                xs.append(x)
+                ys.append(y)
+        return (min(xs) - EPSV, min(ys) - EPSV,
+                max(xs) + EPSV, max(ys) + EPSV)
+
+    # ----------------------------------------------------------------------
+    def _col(self, x):
+        return min(max(int((x - self.minx) / self.dx), 0), self.nx - 1)
+
+    # ----------------------------------------------------------------------
+    def _row(self, y):
+        return min(max(int((y - self.miny) / self.dy), 0), self.ny - 1)
+
+    # ----------------------------------------------------------------------
+    # @return sorted indices of the segments whose bounding box overlaps
+    # the box minx,miny - maxx,maxy. Arcs are indexed by the part swept,
+    # only those with that part in a cell overlapping the box are returned
+    # ----------------------------------------------------------------------
+    def box(self, minx, miny, maxx, maxy):
+        found = set()
+        for i in range(self._col(minx), self._col(maxx) + 1):
+            for j in range(self._row(miny), self._row(maxy) + 1):
+                cell = self.cells.get((i, j))
+                if cell is not None:
+                    found.update(cell)
+        result = []
+        for k in sorted(found):
+            s = self.segments[k]
+            if (s.minx <= maxx and s.maxx >= minx
+                    and s.miny <= maxy and s.maxy >= miny):
+                result.append(k)
+        return result
+
+    # ----------------------------------------------------------------------
+    # @return sorted indices of the segments that may intersect segment
+    # ----------------------------------------------------------------------
+    def query(self, segment):
+        if segment.type != Segment.LINE:
+            return self.box(segment.minx, segment.miny,
+                            segment.maxx, segment.maxy)
+        return self.line(segment.A, segment.B)
+
+    # ----------------------------------------------------------------------
+    # @return sorted indices of the segments whose bounding box is crossed
+    # by the line A-B, visiting only the cells along the line
+    # ----------------------------------------------------------------------
+    def line(self, A, B):
+        if A[0] > B[0]:
+            A, B = B, A
+        x1, y1 = A[0], A[1]
+        x2, y2 = B[0], B[1]
+        dx = x2 - x1
+        slope = (y2 - y1) / dx if dx > EPS else None
+
+        found = set()
+        for i in range(self._col(x1 - EPSV), self._col(x2 + EPSV) + 1):
+            # part of the line within the column
+            xa = max(x1, self.minx + i * self.dx)
+            xb = min(x2, self.minx + (i + 1) * self.dx)
+            if slope is None or xa > xb:
+                ya, yb = y1, y2
+            else:
+                ya = y1 + slope * (xa - x1)
+                yb = y1 + slope * (xb - x1)
+            if ya > yb:
+                ya, yb = yb, ya
+            for j in range(self._row(ya - EPSV), self._row(yb + EPSV) + 1):
+                cell = self.cells.get((i, j))
+                if cell is not None:
+                    found.update(cell)
+
+        minx, maxx = x1 - EPSV, x2 + EPSV
+        miny, maxy = min(y1, y2) - EPSV, max(y1, y2) + EPSV
+        result = []
+        for k in sorted(found):
+            s = self.segments[k]
+            if (s.minx <= maxx and s.maxx >= minx
+                    and s.miny <= maxy and s.maxy >= miny):
+                result.append(k)
+        return result
+
+
 # =============================================================================
 # Path: a list of joint segments
 # Closed path?
@@ -723,6 +864,15 @@ class Path(list):
         self.name = name
         self.color = color
         self._length = None
+        self._grid = None
+
+    # ----------------------------------------------------------------------
+    # The spatial index is rebuilt on demand, never copy it
+    # ----------------------------------------------------------------------
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_grid"] = None
+        return state
 
     # ----------------------------------------------------------------------
     def __repr__(self):
@@ -741,6 +891,16 @@ class Path(list):
             self.maxx = max(self.maxx, segment.maxx)
             self.maxy = max(self.maxy, segment.maxy)
 
+    # ----------------------------------------------------------------------
+    # @return the spatial index of the segments, rebuilt if the path changed
+    # WARNING: segments modified in place must not grow their bounding box
+    # ----------------------------------------------------------------------
+    def spatialIndex(self):
+        grid = getattr(self, "_grid", None)
+        if grid is None or grid.stamp != tuple(map(id, self)):
+            grid = self._grid = SegmentGrid(self)
+        return grid
+
     # ----------------------------------------------------------------------
     # @return true if path is closed
     # ----------------------------------------------------------------------
@@ -1144,7 +1304,8 @@ class Path(list):
     # WARNING: the path must be closed otherwise it is meaningless
     # ----------------------------------------------------------------------
     def isInside(self, P):
-        maxx = self.bbox()[2]
+        grid = self.spatialIndex()
+        maxx = grid.maxx
         # FIXME: this is strange. adding +1000 to line endpoint changes the
         #        outcome of method i've found that doing this works around some
         #        unknown problem in most cases, but it's not really ideal
@@ -1153,8 +1314,13 @@ class Path(list):
         count = 0
         PP1 = None  # previous points to avoid double counting
         PP2 = None
-        for segment in self:
-            P1, P2 = line.intersect(segment)
+        last = None
+        for i in grid.query(line):
+            # segments skipped by the index do not intersect
+            if last is None or i != last + 1:
+                PP1 = PP2 = None
+            last = i
+            P1, P2 = line.intersect(self[i])
             if P1 is not None:
                 if PP1 is None and PP2 is None:
                     count += 1
@@ -1318,7 +1484,7 @@ class Path(list):
     # ----------------------------------------------------------------------
     # Return path with offset, overcuts and cleanup
     # ----------------------------------------------------------------------
-    def offsetClean(self, offset, overcut=False, name=None):
+    def offsetClean(self, offset, overcut=False, name=None, accuracy=0.01):
         path = self  # deepcopy??
         # Remove tiny segments
         path.removeZeroLength(abs(offset) / 100.0)
@@ -1328,6 +1494,13 @@ class Path(list):
         D = path.direction()
         if D == 0:
             D = 1
+        if path.isClosed():
+            opath = path.offsetClip(D * offset, accuracy, name)
+            if overcut:
+                for p in opath:
+                    p.overcut(D * offset)
+            return opath
+
         # Offset
         opath = path.offset(D * offset, name)
         # Post clean
@@ -1342,6 +1515,348 @@ class Path(list):
 
         return opath
 
+    # ----------------------------------------------------------------------
+    # Return the points (x, y, arc) of the closed path with the arcs
+    # linearized within accuracy. arc is the (x, y, radius) of the circle
+    # of the edge starting at the point or None for lines
+    # ----------------------------------------------------------------------
+    def polygon(self, accuracy=0.01):
+        points = []
+        for segment in self:
+            if segment.type == Segment.LINE or segment.radius <= accuracy:
+                points.append((segment.A[0], segment.A[1], None))
+                continue
+            center = (segment.C[0], segment.C[1], segment.radius)
+            points.append((segment.A[0], segment.A[1], center))
+            if segment.type == Segment.CW:
+                phi = segment.startPhi - segment.endPhi
+            else:
+                phi = segment.endPhi - segment.startPhi
+            if phi <= 0.0:  # full circle
+                phi += PI2
+            step = 2.0 * acos(1.0 - accuracy / segment.radius)
+            n = int(ceil(phi / step))
+            if segment.type == Segment.CW:
+                phi = -phi
+            for i in range(1, n):
+                angle = segment.startPhi + phi * i / n
+                points.append((segment.C[0] + segment.radius * cos(angle),
+                               segment.C[1] + segment.radius * sin(angle),
+                               center))
+        n = len(points)
+        return [P for i, P in enumerate(points)
+                if P[:2] != points[(i + 1) % n][:2]]
+
+    # ----------------------------------------------------------------------
+    # Return the raw offset of a polygon (positive to the left), convex
+    # corners are rounded and concave ones pass through the vertex.
+    # The points are tagged with the circle of the arcs like polygon()
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def _offsetPolygon(points, offset, accuracy):
+        n = len(points)
+        starts = []  # left normals at the start of the edges
+        ends = []  # left normals at the end of the edges
+        tags = []  # circles of the offset edges
+        for i in range(n):
+            x0, y0, arc = points[i]
+            x1, y1 = points[(i + 1) % n][:2]
+            length = sqrt((x1 - x0) ** 2 + (y1 - y0) ** 2)
+            nx = (y0 - y1) / length
+            ny = (x1 - x0) / length
+            starts.append((nx, ny))
+            ends.append((nx, ny))
+            if arc is None:
+                tags.append(None)
+                continue
+
+            # the circle shrinks when its center is on the left
+            cx, cy, r = arc
+            side = 1.0 if nx * (cx - x0) + ny * (cy - y0) > 0.0 else -1.0
+            # the ends of the arc move along the radius, not the chord
+            if arc != points[i - 1][2]:
+                d = side / sqrt((cx - x0) ** 2 + (cy - y0) ** 2)
+                starts[i] = ((cx - x0) * d, (cy - y0) * d)
+            if arc != points[(i + 1) % n][2]:
+                d = side / sqrt((cx - x1) ** 2 + (cy - y1) ** 2)
+                ends[i] = ((cx - x1) * d, (cy - y1) * d)
+            r -= side * offset
+            tags.append((cx, cy, r) if r > accuracy else None)
+
+        radius = abs(offset)
+        if accuracy < radius:
+            step = 2.0 * acos(1.0 - accuracy / radius)
+        else:
+            step = pi / 2.0
+
+        raw = []
+        for i in range(n):
+            x, y, center = points[i]
+            px, py = ends[i - 1]
+            nx, ny = starts[i]
+            if center is not None and center == points[i - 1][2]:
+                # inside an arc, move the vertex along the radius unless
+                # it passes over the center
+                bx = px + nx
+                by = py + ny
+                length = sqrt(bx * bx + by * by)
+                bx *= offset / length
+                by *= offset / length
+                cx = center[0] - x
+                cy = center[1] - y
+                if bx * cx + by * cy < bx * bx + by * by:
+                    raw.append((x + bx, y + by, tags[i]))
+                    continue
+
+            Eo = (x + px * offset, y + py * offset)
+            So = (x + nx * offset, y + ny * offset, tags[i])
+            cross = px * ny - py * nx
+            dot = px * nx + py * ny
+            if abs(cross) <= EPS and dot > 0.0:
+                raw.append(So)
+            elif cross * offset > 0.0:
+                raw.append(Eo + (None,))
+                raw.append((x, y, None))
+                raw.append(So)
+            else:
+                theta = atan2(cross, dot)
+                if abs(cross) <= EPS:
+                    theta = -pi if offset > 0.0 else pi
+                phi = atan2(Eo[1] - y, Eo[0] - x)
+                m = int(ceil(abs(theta) / step))
+                corner = (x, y, radius)
+                raw.append(Eo + (corner,))
+                for j in range(1, m):
+                    angle = phi + theta * j / m
+                    raw.append((x + radius * cos(angle),
+                                y + radius * sin(angle), corner))
+                raw.append(So)
+        return raw
+
+    # ----------------------------------------------------------------------
+    # Return the contours of the closed path offset as offset() (positive
+    # to the left) without self intersections. The arcs are linearized
+    # within accuracy and the raw offset is cleaned with a polygon union.
+    # The edges remember the circle of their arc so the arcs are rebuilt
+    # on it. Every contour starts close to the path start
+    # ----------------------------------------------------------------------
+    def offsetClip(self, offset, accuracy=0.01, name=None):
+        if name is None:
+            name = self.name
+        points = self.polygon(accuracy)
+        if len(points) < 3 or offset == 0.0:
+            return []
+
+        # work on a CCW polygon
+        ccw = bclip.area(points) > 0.0
+        if not ccw:
+            # the center tags belong to the edge starting at the point
+            points = [P[:2] + (points[i - 1][2],)
+                      for i, P in enumerate(points)]
+            points.reverse()
+            offset = -offset
+
+        loops = bclip.union([self._offsetPolygon(points, offset, accuracy)])
+
+        x0, y0 = self[0].A[0], self[0].A[1]
+        paths = []
+        for loop in loops:
+            if not self._isClear(loop, abs(offset) - 2.0 * accuracy):
+                continue  # inverted region of an offset larger than the path
+            if not ccw:
+                loop = [P[:2] + (loop[i - 1][2],) for i, P in enumerate(loop)]
+                loop.reverse()
+            i = min(range(len(loop)),
+                    key=lambda i: (loop[i][0] - x0) ** 2
+                    + (loop[i][1] - y0) ** 2)
+            loop = loop[i:] + loop[:i]
+            paths.append(self._loop2Path(loop, name, accuracy))
+        return paths
+
+    # ----------------------------------------------------------------------
+    # Return True if the middle of all loop edges is at least chkofs away
+    # from the path
+    # ----------------------------------------------------------------------
+    def _isClear(self, loop, chkofs):
+        grid = self.spatialIndex()
+        for A, B in zip(loop, loop[1:] + loop[:1]):
+            P = Vector((A[0] + B[0]) / 2.0, (A[1] + B[1]) / 2.0)
+            for i in grid.box(P[0] - chkofs, P[1] - chkofs,
+                              P[0] + chkofs, P[1] + chkofs):
+                if self[i].distance(P) < chkofs:
+                    return False
+        return True
+
+    # ----------------------------------------------------------------------
+    # Convert a loop of tagged points to a path, joining the edges with the
+    # same circle to arcs. The ends of the arcs, linearized or clipped
+    # within accuracy, are moved back on their circle
+    # ----------------------------------------------------------------------
+    def _loop2Path(self, loop, name, accuracy):
+        n = len(loop)
+        runs = []  # (first point, last point, circle) of every segment
+        i = 0
+        while i < n:
+            arc = loop[i][2]
+            j = i + 1
+            if arc is not None:
+                while j < n and loop[j][2] == arc:
+                    j += 1
+                if i == 0 and j == n:
+                    j = n // 2  # full circle, split it in two arcs
+            runs.append((i, j % n, arc))
+            i = j
+
+        points = [Vector(P[0], P[1]) for P in loop]
+        tol = 10.0 * accuracy
+        for k, (i, j, arc) in enumerate(runs):
+            h, _, prev = runs[k - 1]
+            if prev is None:
+                Q = points[h]  # start of the line before
+            elif arc is None:
+                Q = points[j]  # end of the line after
+            else:
+                Q = None
+            # shallow crossings move far, but never past the neighbours
+            P = points[i]
+            move = 0.5 * min((P - points[i - 1]).length(),
+                             (P - points[(i + 1) % n]).length())
+            points[i] = Path._snap(P, prev, arc, Q, tol, max(tol, move))
+
+        path = Path(name, self.color)
+        for i, j, arc in runs:
+            A = points[i]
+            B = points[j]
+            if arc is None:
+                path.append(Segment(Segment.LINE, A, B))
+            else:
+                cx, cy, r = arc
+                x, y = loop[(i + 1) % n][:2]
+                if (A[0] - cx) * (y - cy) - (A[1] - cy) * (x - cx) > 0.0:
+                    t = Segment.CCW
+                else:
+                    t = Segment.CW
+                path.append(Segment(t, A, B, Vector(cx, cy)))
+        return path
+
+    # ----------------------------------------------------------------------
+    # Return P moved on the circles (x, y, radius) arc1 and arc2 that meet
+    # at it. When one of them is None, a line, P moves along the line P-Q.
+    # P is returned unchanged if it is further than tol from the circles
+    # or it would move more than move
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def _snap(P, arc1, arc2, Q, tol, move):
+        if arc1 is None:
+            arc1, arc2 = arc2, arc1
+        if arc1 is None:
+            return P
+        for arc in (arc1, arc2):
+            if arc is not None and abs(
+                (P - Vector(arc[0], arc[1])).length() - arc[2]
+            ) > tol:
+                return P
+        cx, cy, r = arc1
+        C = Vector(cx, cy)
+        if arc2 is not None and arc2 != arc1:
+            # intersections of the two circles
+            D = Vector(arc2[0], arc2[1]) - C
+            d = D.length()
+            if d < EPS:
+                return P
+            a = (r * r - arc2[2] * arc2[2] + d * d) / (2.0 * d)
+            h2 = r * r - a * a
+            if h2 < 0.0:
+                return P
+            M = C + D * (a / d)
+            H = D.orthogonal() * (sqrt(h2) / d)
+            candidates = (M + H, M - H)
+        elif arc2 is None and Q is not None and (P - Q).length2() > EPS2:
+            # intersections of the line Q + t*D with the circle, or the
+            # point closest to it if they are tangent
+            D = P - Q
+            F = Q - C
+            a = D.length2()
+            b = F[0] * D[0] + F[1] * D[1]  # Vector.dot() clamps to [-1, 1]
+            disc = sqrt(max(b * b - a * (F.length2() - r * r), 0.0))
+            candidates = (Q + D * ((-b + disc) / a), Q + D * ((-b - disc) / a))
+        else:
+            d = (P - C).length()
+            if d < EPS:
+                return P
+            candidates = (C + (P - C) * (r / d),)
+        S = min(candidates, key=lambda X: (X - P).length2())
+        if (S - P).length() > move:
+            return P
+        return S
+
+    # ----------------------------------------------------------------------
+    # Return the contours of the next pocket ring inside the path
+    # or None if the offset path vanishes
+    # ----------------------------------------------------------------------
+    def _pocketRing(self, offset, accuracy):
+        return self.offsetClip(offset, accuracy) or None
+
+    # ----------------------------------------------------------------------
+    # Generate the pocket rings inside the path with a tool of diameter
+    # (signed by the direction) and stepover as fraction of the diameter,
+    # with the arcs linearized within accuracy. The rings are generated from a work queue of contours and then joined
+    # from the innermost outwards
+    # @return list of paths or None if the tool does not fit
+    # ----------------------------------------------------------------------
+    def pocket(self, diameter, stepover, maxdepth=POCKET_MAXDEPTH,
+               accuracy=0.01):
+        # node: [path, depth, contours of the next ring, joined paths]
+        nodes = [[self, 0, None, None]]
+        k = 0
+        while k < len(nodes):
+            node = nodes[k]
+            k += 1
+            if node[1] > maxdepth:
+                continue
+            if node[1] == 0:
+                offset = diameter / 2.0
+            else:
+                offset = diameter * stepover
+            opath = node[0]._pocketRing(offset, accuracy)
+            if opath is not None:
+                node[2] = [[pout, node[1] + 1, None, None] for pout in opath]
+                nodes.extend(node[2])
+
+        # inner rings come after their parents in the queue
+        for node in reversed(nodes):
+            if node[2] is None:
+                continue
+            newpath = []
+            for child in node[2]:
+                pout = child[0]
+                pin = child[3]
+                if not pin:
+                    newpath.append(pout)
+
+                # else: # FIXME
+                # 1. Find closest node that we can move with
+                #    a straight line without intersecting the path
+                # 2. rotate the pout to start from this node
+                # 3. join with a normal line
+                # else
+                # join with a rapid move as a separate path
+                elif len(pin) == 1:
+                    # FIXME maybe it is dangerous!!
+                    # Have to check before making a straight move
+                    pin[0].join(pout)
+                    newpath.append(pin[0])
+
+                else:
+                    # FIXME needs to check if we can go in normal move
+                    # needs to find the closest segment and rotate
+                    # pin[-1].join(pout)
+                    newpath.extend(pin)
+                    newpath.append(pout)
+            node[3] = newpath
+            node[2] = None  # release the rings already joined
+        return nodes[0][3]
+
     # ----------------------------------------------------------------------
     # intersect path with self and mark all intersections
     # ----------------------------------------------------------------------
@@ -1359,12 +1874,15 @@ class Path(list):
             points.append((i, oi, P))
 
         # Find all intersection points
+        grid = self.spatialIndex()
         for i, si in enumerate(self[:-2]):
             if si.type == Segment.LINE and self[i + 1].type == Segment.LINE:
-                j = i + 2
+                first = i + 2
             else:
-                j = i + 1
-            while j < len(self):
+                first = i + 1
+            for j in grid.query(si):
+                if j < first:
+                    continue
                 P1, P2 = si.intersect(self[j])
                 # skip doublet solution
                 if P1 is not None and P2 is not None and eq(P1, P2, EPS):
@@ -1375,7 +1893,6 @@ class Path(list):
                 if P2:
                     addPoint(i, P2)
                     addPoint(j, P2)
-                j += 1
 
         # sort according to index, and position of point
         points.sort(key=itemgetter(0, 1))
@@ -1412,9 +1929,10 @@ class Path(list):
             points.append((i, oi, P))
 
         # Find all intersection points
+        grid = path.spatialIndex()
         for i, si in enumerate(self):
-            for cut in path:
-                P1, P2 = si.intersect(cut)
+            for j in grid.query(si):
+                P1, P2 = si.intersect(path[j])
                 # skip doublet solution
                 if P1 is not None and P2 is not None and eq(P1, P2, EPS):
                     P2 = None
@@ -1449,19 +1967,17 @@ class Path(list):
     # ----------------------------------------------------------------------
     def removeExcluded(self, path, offset):
         chkofs = abs(offset) * (1.0 - EPS)
+        grid = path.spatialIndex()
 
         # --------------------------------------------------------------
         # Search if point P is closer than chkofs or not
         # --------------------------------------------------------------
         def isClose(P, last):
             # search in the close vicinity first
-            i0 = last - min(10, len(path))
-            if i0 < 0:
-                i0 += len(path)
-            for i in range(i0, len(path)):
-                if path[i].distance(P) < chkofs:
-                    return False, i
-            for i in range(i0):
+            if last < len(path) and path[last].distance(P) < chkofs:
+                return False, last
+            for i in grid.box(P[0] - chkofs, P[1] - chkofs,
+                              P[0] + chkofs, P[1] + chkofs):
                 if path[i].distance(P) < chkofs:
                     return False, i
             return True, last
@@ -1640,15 +2156,11 @@ class Path(list):
     # referring to minimum distance from P to every Segment of path
     # ----------------------------------------------------------------------
     def isOnPath(self, P):
-        mindist = float("inf")
-        for s in self:
-            d = s.distance(P)
-            if d < mindist:
-                mindist = d
-        if mindist < EPS:
-            return True
-        else:
-            return False
+        for i in self.spatialIndex().box(P[0] - EPS, P[1] - EPS,
+                                         P[0] + EPS, P[1] + EPS):
+            if self[i].distance(P) < EPS:
+                return True
+        return False
 
     # ----------------------------------------------------------------------
     # @return values 1,-1,0,2
@@ -1676,8 +2188,8 @@ class Path(list):
         nbInter = 0
         i1 = None
         i2 = None
-        for segpath in self:
-            a, b = segpath.intersect(seg)
+        for i in self.spatialIndex().query(seg):
+            a, b = self[i].intersect(seg)
             if a is not None and not eq(a, i1) and not eq(a, i2):
                 nbInter += 1
                 i1 = a
@@ -0,0 +1,165 @@
+# Motion planner model for the estimation of the machining time
+#
+# Replays the linear moves through a model of the GRBL planner: the speed
+# at the junction of two moves is limited by the junction deviation, every
+# move follows a trapezoidal velocity profile with the acceleration allowed
+# by the axes, and the look ahead is limited to the planner buffer, as the
+# last planned move must always be able to stop.
+#
+# The planner doesn't convert units: the positions, rates, accelerations
+# and junction deviation must all be in the same length unit, the one of
+# the g-code (mm or inch) as CNC.plannerSettings() returns them. Times are
+# in seconds.
+
+from collections import deque
+from math import sqrt
+
+BUFFER = 16  # moves in the planner buffer of the controller
+MIN_LENGTH = 1e-6  # moves shorter than this are ignored
+STRAIGHT = 0.999999  # cosine limit of straight and reversing junctions
+
+
+# =============================================================================
+class _Move:
+    __slots__ = ("tag", "length", "nominal", "accel", "maxEntry", "entry")
+
+
+# =============================================================================
+# Motion planner
+# =============================================================================
+class Planner:
+    # ----------------------------------------------------------------------
+    # @param rates          maximum rate of every axis [units/min]
+    # @param accelerations  acceleration of every axis [units/s^2]
+    # @param junction       junction deviation [units]
+    # @param emit           function(tag, seconds) called for every move in
+    #                       execution order
+    # ----------------------------------------------------------------------
+    def __init__(self, rates, accelerations, junction, emit):
+        self.rates = [r / 60.0 for r in rates]
+        self.accelerations = accelerations
+        self.junction = junction
+        self.emit = emit
+        self._buffer = deque()
+        self._unit = None  # direction of the last move, None after a stop
+        self._nominal = 0.0  # nominal speed of the last move
+        self._speed = 0.0  # entry speed of the first move in buffer
+
+    # ----------------------------------------------------------------------
+    # Return the minimum of the per axis limits along the unit vector
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def _limit(limits, unit):
+        value = float("inf")
+        for limit, u in zip(limits, unit):
+            if u != 0.0:
+                value = min(value, limit / abs(u))
+        return value
+
+    # ----------------------------------------------------------------------
+    # Add the polyline xyz, moving at feed [units/min] or at the maximum rate
+    # when feed is None
+    # ----------------------------------------------------------------------
+    def add(self, xyz, feed, tag):
+        for A, B in zip(xyz, xyz[1:]):
+            delta = [b - a for a, b in zip(A, B)]
+            length = sqrt(sum(d * d for d in delta))
+            if length < MIN_LENGTH:
+                continue
+            unit = [d / length for d in delta]
+            nominal = self._limit(self.rates, unit)
+            if feed is not None:
+                nominal = min(nominal, feed / 60.0)
+            if nominal <= 0.0:
+                continue
+            self._push(tag, length, unit, nominal)
+
+    # ----------------------------------------------------------------------
+    def _push(self, tag, length, unit, nominal):
+        move = _Move()
+        move.tag = tag
+        move.length = length
+        move.nominal = nominal
+        move.accel = self._limit(self.accelerations, unit)
+
+        # maximum speed at the junction with the previous move
+        prev = self._unit
+        if prev is None:
+            v2 = 0.0
+        else:
+            cos = -sum(p * u for p, u in zip(prev, unit))
+            if cos > STRAIGHT:
+                v2 = 0.0  # reversal
+            elif cos < -STRAIGHT:
+                v2 = float("inf")  # straight
+            else:
+                junction = [u - p for p, u in zip(prev, unit)]
+                norm = sqrt(sum(j * j for j in junction))
+                accel = self._limit(self.accelerations,
+                                    [j / norm for j in junction])
+                sin2 = sqrt(0.5 * (1.0 - cos))
+                v2 = accel * self.junction * sin2 / (1.0 - sin2)
+            v2 = min(v2, nominal * nominal, self._nominal * self._nominal)
+        move.maxEntry = sqrt(v2)
+        self._unit = unit
+        self._nominal = nominal
+
+        # backward pass, the new move has to stop at its end
+        buffer = self._buffer
+        move.entry = min(move.maxEntry, sqrt(2.0 * move.accel * length))
+        buffer.append(move)
+        exit = move.entry
+        for i in range(len(buffer) - 2, -1, -1):
+            m = buffer[i]
+            entry = min(m.maxEntry,
+                        sqrt(exit * exit + 2.0 * m.accel * m.length))
+            if entry <= m.entry:
+                break
+            m.entry = entry
+            exit = entry
+
+        if len(buffer) >= BUFFER:
+            self._execute()
+
+    # ----------------------------------------------------------------------
+    # Execute the first move of the buffer with the profile planned so far
+    # ----------------------------------------------------------------------
+    def _execute(self):
+        move = self._buffer.popleft()
+        v0 = self._speed
+        v1 = self._buffer[0].entry if self._buffer else 0.0
+        v1 = min(v1, sqrt(v0 * v0 + 2.0 * move.accel * move.length))
+        self._speed = v1
+        self.emit(move.tag, _trapezoid(move.length, v0, v1, move.nominal,
+                                       move.accel))
+
+    # ----------------------------------------------------------------------
+    # Execute all moves coming to a full stop
+    # ----------------------------------------------------------------------
+    def stop(self):
+        while self._buffer:
+            self._execute()
+        self._unit = None
+        self._speed = 0.0
+
+    # ----------------------------------------------------------------------
+    # Stop and wait for the given seconds
+    # ----------------------------------------------------------------------
+    def dwell(self, seconds, tag):
+        self.stop()
+        self.emit(tag, seconds)
+
+
+# -----------------------------------------------------------------------------
+# Time of a move of length at nominal speed, entering at v0 and exiting at
+# v1, with constant acceleration
+# -----------------------------------------------------------------------------
+def _trapezoid(length, v0, v1, nominal, accel):
+    accelerate = (nominal * nominal - v0 * v0) / (2.0 * accel)
+    decelerate = (nominal * nominal - v1 * v1) / (2.0 * accel)
+    cruise = length - accelerate - decelerate
+    if cruise >= 0.0:
+        return ((nominal - v0) + (nominal - v1)) / accel + cruise / nominal
+    # triangle profile never reaching the nominal speed
+    peak = sqrt(max(accel * length + (v0 * v0 + v1 * v1) / 2.0, 0.0))
+    return ((peak - v0) + (peak - v1)) / accel
@@ -0,0 +1,397 @@
+# Open tour optimizer for the rapid movements between blocks
+#
+# Every block is a node entered from its start point and left from its end
+# point. The tour starts from node 0 and doesn't return to it. A nearest
+# neighbour tour, searched with a KD-tree, is improved with 2-opt and
+# Or-opt moves among the nearest neighbours of every node, until no move
+# improves it or the time budget expires. Reversible nodes can be
+# traversed from their end to their start.
+
+import heapq
+import time
+from math import sqrt
+
+NEIGHBOURS = 8  # candidate neighbours of every node
+OROPT_CHAIN = 3  # longest chain of nodes moved by the Or-opt
+EPS = 1e-9  # minimum gain of a move and distance of distinct points
+
+
+# -----------------------------------------------------------------------------
+# Return the visiting order of the nodes and the list of reversed nodes
+# @param starts, ends   (x, y) points of every node
+# @param reverse        allow reversing the nodes with distinct end points
+# @param budget         time budget in seconds of the improvement
+# -----------------------------------------------------------------------------
+def tour(starts, ends, reverse=False, budget=1.0):
+    return _Tour(starts, ends, reverse).solve(budget)
+
+
+# =============================================================================
+# Static KD-tree of points with removal
+# =============================================================================
+class KDTree:
+    # ----------------------------------------------------------------------
+    def __init__(self, points):
+        self.points = points
+        n = len(points)
+        self.index = list(range(n))  # point at every tree position
+        self.axis = [0] * n  # split axis of every position
+        self.alive = [0] * n  # points left in the subtree of every position
+        self.removed = [False] * n
+
+        # the subtree of range lo:hi is rooted at its middle position
+        stack = [(0, n)]
+        while stack:
+            lo, hi = stack.pop()
+            if lo >= hi:
+                continue
+            sub = self.index[lo:hi]
+            xs = [points[i][0] for i in sub]
+            ys = [points[i][1] for i in sub]
+            axis = int(max(ys) - min(ys) > max(xs) - min(xs))
+            sub.sort(key=lambda i: points[i][axis])
+            self.index[lo:hi] = sub
+            mid = (lo + hi) // 2
+            self.axis[mid] = axis
+            self.alive[mid] = hi - lo
+            stack.append((lo, mid))
+            stack.append((mid + 1, hi))
+
+        self.position = [0] * n
+        for p, i in enumerate(self.index):
+            self.position[i] = p
+
+    # ----------------------------------------------------------------------
+    # Remove point i from the searches
+    # ----------------------------------------------------------------------
+    def remove(self, i):
+        if self.removed[i]:
+            return
+        self.removed[i] = True
+        p = self.position[i]
+        lo = 0
+        hi = len(self.index)
+        while True:
+            mid = (lo + hi) // 2
+            self.alive[mid] -= 1
+            if p == mid:
+                return
+            if p < mid:
+                hi = mid
+            else:
+                lo = mid + 1
+
+    # ----------------------------------------------------------------------
+    # Return the k nearest points to x,y sorted by distance
+    # ----------------------------------------------------------------------
+    def nearest(self, x, y, k=1):
+        points = self.points
+        index = self.index
+        axis = self.axis
+        alive = self.alive
+        removed = self.removed
+        heap = []  # max heap of (-distance2, point)
+        bound = float("inf")
+        stack = [(0, len(index), 0.0)]
+        while stack:
+            lo, hi, d2 = stack.pop()
+            if lo >= hi or d2 >= bound:
+                continue
+            mid = (lo + hi) // 2
+            if not alive[mid]:
+                continue
+            i = index[mid]
+            px, py = points[i]
+            if not removed[i]:
+                d = (px - x) ** 2 + (py - y) ** 2
+                if d < bound:
+                    heapq.heappush(heap, (-d, i))
+                    if len(heap) > k:
+                        heapq.heappop(heap)
+                    if len(heap) == k:
+                        bound = -heap[0][0]
+            diff = x - px if axis[mid] == 0 else y - py
+            # visit first the side of x,y
+            if diff < 0.0:
+                stack.append((mid + 1, hi, max(d2, diff * diff)))
+                stack.append((lo, mid, d2))
+            else:
+                stack.append((lo, mid, max(d2, diff * diff)))
+                stack.append((mid + 1, hi, d2))
+        return [i for d, i in sorted(heap, reverse=True)]
+
+
+# =============================================================================
+# Tour of the nodes
+# =============================================================================
+class _Tour:
+    # ----------------------------------------------------------------------
+    def __init__(self, starts, ends, reverse):
+        self.starts = starts
+        self.ends = ends
+        n = len(starts)
+        # nodes with the same start and end can always be reversed
+        self.flippable = [
+            reverse or _dist(starts[k], ends[k]) <= EPS for k in range(n)
+        ]
+        self.reversible = [
+            reverse and _dist(starts[k], ends[k]) > EPS for k in range(n)
+        ]
+        self.flip = [False] * n
+        self.order = []
+        self.pos = []
+
+    # ----------------------------------------------------------------------
+    def entry(self, k):
+        return self.ends[k] if self.flip[k] else self.starts[k]
+
+    # ----------------------------------------------------------------------
+    def exit(self, k):
+        return self.starts[k] if self.flip[k] else self.ends[k]
+
+    # ----------------------------------------------------------------------
+    # Cost of the link from node a to node b, zero at the end of the tour
+    # ----------------------------------------------------------------------
+    def link(self, a, b):
+        if b is None:
+            return 0.0
+        return _dist(self.exit(a), self.entry(b))
+
+    # ----------------------------------------------------------------------
+    def length(self):
+        order = self.order
+        return sum(self.link(a, b) for a, b in zip(order, order[1:]))
+
+    # ----------------------------------------------------------------------
+    def solve(self, budget):
+        n = len(self.starts)
+        if n == 0:
+            return [], []
+        deadline = time.time() + budget
+        self.seed()
+        if n > 3:
+            self.neighbours()
+            improved = True
+            while improved and time.time() < deadline:
+                improved = False
+                if all(self.flippable):
+                    improved = self.twoOpt(deadline)
+                improved = self.orOpt(deadline) or improved
+        return self.order, [
+            k for k in range(n) if self.flip[k] and self.reversible[k]
+        ]
+
+    # ----------------------------------------------------------------------
+    # Nearest neighbour tour from node 0
+    # ----------------------------------------------------------------------
+    def seed(self):
+        n = len(self.starts)
+        # entry points: (node, reversed)
+        points = []
+        owners = []
+        for k in range(n):
+            points.append(self.starts[k])
+            owners.append((k, False))
+            if self.reversible[k]:
+                points.append(self.ends[k])
+                owners.append((k, True))
+        entries = [[] for _ in range(n)]
+        for i, (k, flip) in enumerate(owners):
+            entries[k].append(i)
+
+        tree = KDTree(points)
+        self.order = [0]
+        for i in entries[0]:
+            tree.remove(i)
+        while len(self.order) < n:
+            x, y = self.exit(self.order[-1])
+            k, flip = owners[tree.nearest(x, y)[0]]
+            self.flip[k] = flip
+            self.order.append(k)
+            for i in entries[k]:
+                tree.remove(i)
+        self.pos = [0] * n
+        for p, k in enumerate(self.order):
+            self.pos[k] = p
+
+    # ----------------------------------------------------------------------
+    # Nearest nodes to both end points of every node
+    # ----------------------------------------------------------------------
+    def neighbours(self):
+        n = len(self.starts)
+        points = []
+        owners = []
+        for k in range(n):
+            points.append(self.starts[k])
+            owners.append(k)
+            if _dist(self.starts[k], self.ends[k]) > EPS:
+                points.append(self.ends[k])
+                owners.append(k)
+        tree = KDTree(points)
+        k2 = min(2 * NEIGHBOURS + 2, len(points))
+        self.near = []
+        for k in range(n):
+            found = tree.nearest(*self.starts[k], k2)
+            if _dist(self.starts[k], self.ends[k]) > EPS:
+                found.extend(tree.nearest(*self.ends[k], k2))
+                found.sort(key=lambda i: min(
+                    _dist(points[i], self.starts[k]),
+                    _dist(points[i], self.ends[k])))
+            near = []
+            for i in found:
+                j = owners[i]
+                if j != k and j not in near:
+                    near.append(j)
+                    if len(near) == NEIGHBOURS:
+                        break
+            self.near.append(near)
+
+    # ----------------------------------------------------------------------
+    # Reverse the nodes of the tour between positions p and q included
+    # ----------------------------------------------------------------------
+    def reverse(self, p, q):
+        order = self.order
+        order[p:q + 1] = order[p:q + 1][::-1]
+        for i in range(p, q + 1):
+            k = order[i]
+            self.flip[k] = not self.flip[k]
+            self.pos[k] = i
+
+    # ----------------------------------------------------------------------
+    # 2-opt moves, reversing a part of the tour, all nodes are flippable
+    # ----------------------------------------------------------------------
+    def twoOpt(self, deadline):
+        order = self.order
+        pos = self.pos
+        n = len(order)
+        improved = False
+        for a in range(n):
+            if time.time() > deadline:
+                break
+            i = pos[a]
+            # join the exit of a with the exit of c, reversing the nodes
+            # from the successor of a up to c
+            if i + 1 < n:
+                b = order[i + 1]
+                ab = self.link(a, b)
+                for c in self.near[a]:
+                    j = pos[c]
+                    if j <= i + 1:
+                        continue
+                    d = order[j + 1] if j + 1 < n else None
+                    old = ab + self.link(c, d)
+                    new = _dist(self.exit(a), self.exit(c))
+                    if d is not None:
+                        new += _dist(self.entry(b), self.entry(d))
+                    if new < old - EPS:
+                        self.reverse(i + 1, j)
+                        improved = True
+                        break
+            # join the entry of a with the entry of c, reversing the nodes
+            # from the successor of c up to the predecessor of a
+            i = pos[a]
+            if i > 1:
+                z = order[i - 1]
+                za = self.link(z, a)
+                for c in self.near[a]:
+                    j = pos[c]
+                    if j >= i - 1:
+                        continue
+                    e = order[j + 1]
+                    old = za + self.link(c, e)
+                    new = (_dist(self.exit(c), self.exit(z))
+                           + _dist(self.entry(e), self.entry(a)))
+                    if new < old - EPS:
+                        self.reverse(j + 1, i - 1)
+                        improved = True
+                        break
+        return improved
+
+    # ----------------------------------------------------------------------
+    # Or-opt moves, moving a chain of nodes next to a neighbour of its ends,
+    # reversed when possible
+    # ----------------------------------------------------------------------
+    def orOpt(self, deadline):
+        order = self.order
+        pos = self.pos
+        n = len(order)
+        improved = False
+        for length in range(1, OROPT_CHAIN + 1):
+            for first in range(n):
+                if time.time() > deadline:
+                    return improved
+                s = pos[first]
+                t = s + length - 1
+                if s == 0 or t >= n:
+                    continue
+                last = order[t]
+                prev = order[s - 1]
+                after = order[t + 1] if t + 1 < n else None
+                gain = (self.link(prev, first) + self.link(last, after)
+                        - self.link(prev, after))
+                if gain <= EPS:
+                    continue
+                flippable = all(self.flippable[order[i]]
+                                for i in range(s, t + 1))
+                move = self._insertion(s, t, gain, flippable)
+                if move is None:
+                    continue
+                p, flip = move
+                chain = order[s:t + 1]
+                if flip:
+                    chain.reverse()
+                    for k in chain:
+                        self.flip[k] = not self.flip[k]
+                del order[s:t + 1]
+                if p > t:
+                    p -= len(chain)
+                order[p + 1:p + 1] = chain
+                for i in range(min(s, p + 1), max(t, p + len(chain)) + 1):
+                    pos[order[i]] = i
+                improved = True
+        return improved
+
+    # ----------------------------------------------------------------------
+    # Best insertion of the chain s..t after a position p outside it,
+    # @return (p, reversed) if it reduces the tour more than gain
+    # ----------------------------------------------------------------------
+    def _insertion(self, s, t, gain, flippable):
+        order = self.order
+        pos = self.pos
+        n = len(order)
+        first = order[s]
+        last = order[t]
+        best = None
+        bestgain = EPS
+        candidates = set()
+        for k in self.near[first] + self.near[last]:
+            p = pos[k]
+            candidates.add(p)
+            candidates.add(p - 1)
+        for p in candidates:
+            if p < 0 or s - 1 <= p <= t:
+                continue
+            P = order[p]
+            Q = order[p + 1] if p + 1 < n else None
+            base = self.link(P, Q)
+            cost = (self.link(P, first)
+                    + (0.0 if Q is None
+                       else _dist(self.exit(last), self.entry(Q)))
+                    - base)
+            if gain - cost > bestgain:
+                best = (p, False)
+                bestgain = gain - cost
+            if flippable:
+                cost = (_dist(self.exit(P), self.exit(last))
+                        + (0.0 if Q is None
+                           else _dist(self.entry(first), self.entry(Q)))
+                        - base)
+                if gain - cost > bestgain:
+                    best = (p, True)
+                    bestgain = gain - cost
+        return best
+
+
+# -----------------------------------------------------------------------------
+def _dist(a, b):
+    return sqrt((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2)
@@ -24,6 +24,7 @@ import sys
 
 epsilon = 1e-5
 MAXINT = 1000000000
+HEIGHT_ROWS = 64  # image rows computed at once by height_field()
 
 
 def ball_tool(r, rad):
@@ -324,6 +325,12 @@ class Converter:
         self.splitpixels = splitpixels
 
         self.cache = {}
+        # tool compensated heights of all pixels, when the image can
+        # compute them at once, else get_z() computes and caches them
+        if hasattr(image, "height_field"):
+            self.heights = image.height_field(tool_shape)
+        else:
+            self.heights = None
 
         w, h = self.w, self.h = image.shape
         self.h1 = h
@@ -432,6 +439,8 @@ class Converter:
         return output_gcode
 
     def get_z(self, x, y):
+        if self.heights is not None:
+            return min(0, max(self.rd, self.heights[y, x]))
         try:
             return min(0, max(self.rd, self.cache[x, y]))
         except KeyError:
@@ -814,7 +823,7 @@ class Image_Matrix_Numpy:
 
         self.width = width
         self.height = height
-        self.matrix = numpy.zeros((width, height), "Float32")
+        self.matrix = numpy.zeros((width, height), "float32")
         self.shape = [width, height]
         self.t_offset = 0
 
@@ -832,7 +841,7 @@ class Image_Matrix_Numpy:
         self.width = s
         self.height = s
 
-        self.matrix = numpy.zeros((s, s), "Float32")
+        self.matrix = numpy.zeros((s, s), "float32")
         for x in range(s):
             for y in range(s):
                 self.matrix[x, y] = float(input_list[x][y])
@@ -845,15 +854,11 @@ class Image_Matrix_Numpy:
 
         if pil_format:
             him, wim = im.size
-            self.matrix = numpy.zeros((wim, him), "Float32")
-            for i in range(0, wim):
-                for j in range(0, him):
-                    pix = im.getpixel((j, i))
-                    self.matrix[i, j] = float(pix)
+            self.matrix = numpy.asarray(im, "float32")
         else:
             him = im.width()
             wim = im.height()
-            self.matrix = numpy.zeros((wim, him), "Float32")
+            self.matrix = numpy.zeros((wim, him), "float32")
             for i in range(0, wim):
                 for j in range(0, him):
                     try:
@@ -877,10 +882,7 @@ class Image_Matrix_Numpy:
         w, h = self.shape
         w1 = w + ts - 1
         h1 = h + ts - 1
-        temp = numpy.zeros((w1, h1), "Float32")
-        for j in range(0, w1):
-            for i in range(0, h1):
-                temp[j, i] = -1e1000000
+        temp = numpy.full((w1, h1), -numpy.inf, "float32")
         temp[to:to + w, to:to + h] = self.matrix
         self.matrix = temp
 
@@ -891,6 +893,28 @@ class Image_Matrix_Numpy:
         d = (m1 - tool.matrix).max()
         return d
 
+    # Return the height_calc() of every pixel as a [w, h] array: the grey
+    # scale dilation of the padded image by the tool shape. Every point of
+    # the tool shifts a block of HEIGHT_ROWS rows of the image, keeping
+    # the maximum in place
+    def height_field(self, tool):
+        import numpy
+
+        w, h = self.shape
+        field = numpy.full((w, h), -numpy.inf, "float32")
+        points = [(a, b, tool.matrix[a, b])
+                  for a, b in zip(*numpy.nonzero(numpy.isfinite(tool.matrix)))]
+        temp = numpy.empty((HEIGHT_ROWS, h), "float32")
+        for y in range(0, w, HEIGHT_ROWS):
+            n = min(HEIGHT_ROWS, w - y)
+            rows = field[y:y + n]
+            shifted = temp[:n]
+            for a, b, t in points:
+                numpy.subtract(self.matrix[y + a:y + a + n, b:b + h], t,
+                               out=shifted)
+                numpy.maximum(rows, shifted, out=rows)
+        return field
+
     def min(self):
         return self.matrix[
             self.t_offset:self.t_offset + self.width,
@@ -3,15 +3,18 @@ Functions to slice a mesh. For now, computes planar cross-section
 """
 
 import collections
+import multiprocessing
+import os
+import pickle
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 import numpy as np
 import numpy.linalg as la
 
-try:
-    import scipy.spatial.distance as spdist
-    USE_SCIPY = True
-except ImportError:
-    USE_SCIPY = False
+# Minimum number of triangles times planes to slice in a pool of processes
+SLICE_POOL = 1000000
 
 # ---- Geometry datastructures
 
@@ -34,11 +37,11 @@ class TriangleMesh:
         self.verts = np.array(verts)
         # For each edge, contains the list of triangles it belongs to
         # If the mesh is closed, each edge belongs to 2 triangles
-        self.edges_to_tris = collections.defaultdict(lambda: [])
+        self.edges_to_tris = collections.defaultdict(list)
         # For each triangle, contains the edges it contains
         self.tris_to_edges = {}
         # For each vertex, the list of triangles it belongs to
-        self.verts_to_tris = collections.defaultdict(lambda: [])
+        self.verts_to_tris = collections.defaultdict(list)
 
         self.tris = tris
 
@@ -100,7 +103,8 @@ INTERSECT_EDGE = 0
 INTERSECT_VERTEX = 1
 
 
-def compute_triangle_plane_intersections(mesh, tid, plane, dist_tol=1e-8):
+def compute_triangle_plane_intersections(mesh, tid, plane, dist_tol=1e-8,
+                                         plane_dists=None):
     """
     Compute the intersection between a triangle and a plane
 
@@ -115,11 +119,16 @@ def compute_triangle_plane_intersections(mesh, tid, plane, dist_tol=1e-8):
           "touches" the plane without really intersecting)
     - 2 : the plane slice the triangle in two parts (either vertex-edge,
           vertex-vertex or edge-edge)
+
+    plane_dists is an optional array of the signed distance of every vertex
+    to the plane
     """
-    # TODO: Use a distance cache
-    dists = {
-        vid: point_to_plane_dist(mesh.verts[vid],
-                                 plane) for vid in mesh.tris[tid]}
+    if plane_dists is None:
+        dists = {
+            vid: point_to_plane_dist(mesh.verts[vid],
+                                     plane) for vid in mesh.tris[tid]}
+    else:
+        dists = {vid: plane_dists[vid] for vid in mesh.tris[tid]}
     # TODO: Use an edge intersection cache (we currently compute each edge
     # intersection twice : once for each tri)
 
@@ -165,10 +174,11 @@ def compute_triangle_plane_intersections(mesh, tid, plane, dist_tol=1e-8):
     return intersections
 
 
-def get_next_triangle(mesh, T, plane, intersection, dist_tol):
+def get_next_triangle(mesh, T, plane, intersection, dist_tol,
+                      plane_dists=None):
     """
     Returns the next triangle to visit given the intersection and
-    the list of unvisited triangles (T)
+    the set of unvisited triangles (T), which is updated in place
 
     We look for a triangle that is cut by the plane (2 intersections) as
     opposed to one that only touch the plane (1 vertex intersection)
@@ -195,25 +205,25 @@ def get_next_triangle(mesh, T, plane, intersection, dist_tol):
     # remove all the neighbors of the visited triangle so we don't come
     # back to it
 
-    T = set(T)
     for tid in tris:
         if tid in T:
             intersections = compute_triangle_plane_intersections(
-                mesh, tid, plane, dist_tol
+                mesh, tid, plane, dist_tol, plane_dists
             )
             if len(intersections) == 2:
-                T = T.difference(tris)
+                T.difference_update(tris)
                 return tid, intersections, T
     return None, [], T
 
 
-def _walk_polyline(tid, intersect, T, mesh, plane, dist_tol):
+def _walk_polyline(tid, intersect, T, mesh, plane, dist_tol,
+                   plane_dists=None):
     """
     Given an intersection, walk through the mesh triangles, computing
     intersection with the cut plane for each visited triangle and adding
-    those intersection to a polyline.
+    those intersection to a polyline. The visited triangles are removed
+    from the set T.
     """
-    T = set(T)
     p = []
     # Loop until we have explored all the triangles for the current
     # polyline
@@ -224,7 +234,8 @@ def _walk_polyline(tid, intersect, T, mesh, plane, dist_tol):
                                                   T,
                                                   plane,
                                                   intersect,
-                                                  dist_tol)
+                                                  dist_tol,
+                                                  plane_dists)
         if tid is None:
             break
 
@@ -246,16 +257,22 @@ def _walk_polyline(tid, intersect, T, mesh, plane, dist_tol):
     return p, T
 
 
-def cross_section_mesh(mesh, plane, dist_tol=1e-8):
+def cross_section_mesh(mesh, plane, dist_tol=1e-8, tids=None):
     """
     Args:
         mesh: A geom.TriangleMesh instance
         plane: The cut plane : geom.Plane instance
         dist_tol: If two points are closer than dist_tol, they are considered
                   the same
+        tids: The triangles that may be cut by the plane, all if None
     """
     # Set of all triangles
-    T = set(range(len(mesh.tris)))
+    if tids is None:
+        T = set(range(len(mesh.tris)))
+    else:
+        T = set(np.asarray(tids).tolist())
+    # Signed distance of every vertex to the plane
+    plane_dists = np.dot(mesh.verts - plane.orig, plane.n)
     # List of all cross-section polylines
     P = []
 
@@ -265,7 +282,8 @@ def cross_section_mesh(mesh, plane, dist_tol=1e-8):
         intersections = compute_triangle_plane_intersections(mesh,
                                                              tid,
                                                              plane,
-                                                             dist_tol)
+                                                             dist_tol,
+                                                             plane_dists)
 
         if len(intersections) == 2:
             for intersection in intersections:
@@ -274,7 +292,8 @@ def cross_section_mesh(mesh, plane, dist_tol=1e-8):
                                       T,
                                       mesh,
                                       plane,
-                                      dist_tol)
+                                      dist_tol,
+                                      plane_dists)
                 if len(p) > 1:
                     P.append(np.array(p))
     return P
@@ -300,6 +319,112 @@ def cross_section(verts, tris, plane_orig, plane_normal, **kwargs):
     return cross_section_mesh(mesh, plane, **kwargs)
 
 
+class MeshSlicer:
+    def __init__(self, mesh, plane_normal):
+        """
+        Slice a mesh with planes perpendicular to plane_normal, reusing
+        the mesh topology for every plane.
+
+        The triangles are sorted by the lowest height of their vertices
+        along the normal, so the triangles that may be cut by a plane are
+        found with a binary search over this interval index.
+
+        Args:
+            mesh: A TriangleMesh instance
+            plane_normal: 3-vector indicating the normal of the planes
+        """
+        self.mesh = mesh
+        self.normal = np.asarray(plane_normal, dtype=np.float64)
+        self.normal = self.normal / la.norm(self.normal)
+
+        heights = np.dot(mesh.verts, self.normal)[np.asarray(mesh.tris)]
+        low = heights.min(axis=1)
+        high = heights.max(axis=1)
+        self.order = np.argsort(low, kind="stable")
+        self.low = low[self.order]
+        self.high = high[self.order]
+        # the triangles of a plane are within the highest extent below it
+        self.extent = float((high - low).max()) if len(low) else 0.0
+
+    def triangles(self, height, dist_tol=1e-8):
+        """Returns the triangles that may be cut by the plane at height"""
+        start = np.searchsorted(self.low, height - dist_tol - self.extent)
+        end = np.searchsorted(self.low, height + dist_tol, side="right")
+        cut = self.high[start:end] >= height - dist_tol
+        return self.order[start:end][cut]
+
+    def cross_section(self, height, dist_tol=1e-8):
+        """
+        Compute the cross section with the plane at the given signed
+        distance from the origin along the normal
+        """
+        plane = Plane(self.normal * height, self.normal)
+        return cross_section_mesh(self.mesh, plane, dist_tol,
+                                  self.triangles(height, dist_tol))
+
+    def cross_sections(self, heights, dist_tol=1e-8):
+        """Returns the list of the cross sections at every height"""
+        return [self.cross_section(h, dist_tol) for h in heights]
+
+
+# Slicer of the worker processes, built once per process
+_slicer = None
+
+
+def _init_slicer(verts, tris, plane_normal):
+    global _slicer
+    _slicer = MeshSlicer(TriangleMesh(verts, tris), plane_normal)
+
+
+def _slice_heights(heights, dist_tol):
+    return _slicer.cross_sections(heights, dist_tol)
+
+
+def cross_sections(verts, tris, plane_normal, heights, dist_tol=1e-8,
+                   workers=None):
+    """
+    Compute the planar cross sections of a mesh with many parallel planes.
+    The mesh topology is built once and large jobs are sliced in a pool of
+    processes. The workers are spawned, as forking the GUI with its
+    threads is unsafe.
+
+    Args:
+        verts: Nx3 array of the vertices position
+        tris: Nx3 array of the faces, containing vertex indices
+        plane_normal: 3-vector indicating the normal of the planes
+        heights: signed distance of every plane from the origin along the
+                 normal
+        workers: number of processes, os.cpu_count() if None
+
+    Returns:
+        The list of the cross sections of every plane, as returned by
+        cross_section()
+    """
+    heights = list(heights)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(heights))
+    if workers > 1 and len(tris) * len(heights) >= SLICE_POOL:
+        # chunks of consecutive heights, split among the workers
+        size = -(-len(heights) // (4 * workers))
+        chunks = [heights[i:i + size] for i in range(0, len(heights), size)]
+        try:
+            with ProcessPoolExecutor(
+                workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_slicer,
+                initargs=(np.asarray(verts), np.asarray(tris), plane_normal),
+            ) as pool:
+                futures = [pool.submit(_slice_heights, chunk, dist_tol)
+                           for chunk in chunks]
+                return [P for future in futures for P in future.result()]
+        except (OSError, BrokenProcessPool, pickle.PicklingError) as e:
+            sys.stderr.write(
+                f">>> Parallel slicing failed, running serially: {e}\n")
+    slicer = MeshSlicer(TriangleMesh(verts, tris), plane_normal)
+    return slicer.cross_sections(heights, dist_tol)
+
+
 def pdist_squareformed_numpy(a):
     """
     Compute spatial distance using pure numpy
@@ -318,45 +443,114 @@ def pdist_squareformed_numpy(a):
     return dist
 
 
-def merge_close_vertices(verts, faces, close_epsilon=1e-5):
+# Maximum number of grid cells along every axis to weld vertices, so that
+# the index of a cell fits in 64 bits
+WELD_CELLS = 1 << 20
+
+
+def weld_vertices(verts, close_epsilon=1e-5):
     """
-    Will merge vertices that are closer than close_epsilon.
+    Find the vertices that are closer than close_epsilon, chaining them
+    into groups of welded vertices.
 
-    Warning, this has a O(n^2) memory usage because we compute the full
-    vert-to-vert distance matrix. If you have a large mesh, might want
-    to use some kind of spatial search structure like an octree or some fancy
-    hashing scheme
+    Identical vertices are merged first. The remaining vertices are
+    sorted by the index of their cell in a grid of at least close_epsilon
+    spacing, so every vertex is only compared with the vertices of the
+    neighbouring cells and the memory usage is O(n).
 
-    Returns: new_verts, new_faces
+    Returns: new_verts, old2new
+        new_verts: the first vertex of every group, in input order
+        old2new: the index in new_verts of every input vertex
     """
-    # Pairwise distance between verts
-    if USE_SCIPY:
-        D = spdist.cdist(verts, verts)
-    else:
-        D = np.sqrt(np.abs(pdist_squareformed_numpy(verts)))
-
-    # Compute a mapping from old to new : for each input vert, store the index
-    # of the new vert it will be merged into
-    old2new = np.zeros(D.shape[0], dtype=np.int_)
-    # A mask indicating if a vertex has already been merged into another
-    merged_verts = np.zeros(D.shape[0], dtype=np.bool_)
-    new_verts = []
-    for i in range(D.shape[0]):
-        if merged_verts[i]:
-            continue
-        else:
-            # The vertices that will be merged into this one
-            merged = np.flatnonzero(D[i, :] < close_epsilon)
-            old2new[merged] = len(new_verts)
-            new_verts.append(verts[i])
-            merged_verts[merged] = True
+    verts = np.asarray(verts, dtype=np.float64).reshape(-1, 3)
+    if len(verts) == 0:
+        return verts.copy(), np.zeros(0, dtype=np.int_)
+
+    # Merge the identical vertices, comparing the rows as raw bytes
+    rows = np.ascontiguousarray(verts + 0.0)  # without -0.0
+    rows = rows.view(np.dtype((np.void, rows.itemsize * 3))).reshape(-1)
+    unique, first, inverse = np.unique(
+        rows, return_index=True, return_inverse=True
+    )
+    unique = unique.view(np.float64).reshape(-1, 3)
+    inverse = inverse.reshape(-1)
+    n = len(unique)
+
+    # Label every unique vertex with the lowest label of its group
+    label = np.arange(n)
+    if close_epsilon > 0.0 and n > 1:
+        low = unique.min(axis=0)
+        size = max(close_epsilon,
+                   float((unique.max(axis=0) - low).max()) / WELD_CELLS)
+        # cells padded by one on every side, numbered along z, y, x
+        cells = np.floor((unique - low) / size).astype(np.int64) + 1
+        dims = cells.max(axis=0) + 2
+        keys = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        eps2 = close_epsilon * close_epsilon
+        pairs_a = []
+        pairs_b = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    delta = (dx * dims[1] + dy) * dims[2] + dz
+                    if delta < 0:
+                        continue  # the pair is found from the other cell
+                    near = sorted_keys + delta
+                    lo = np.searchsorted(sorted_keys, near, side="left")
+                    hi = np.searchsorted(sorted_keys, near, side="right")
+                    count = hi - lo
+                    a = np.repeat(order, count)
+                    if len(a) == 0:
+                        continue
+                    # position of every candidate within its cell
+                    start = np.repeat(np.cumsum(count) - count, count)
+                    b = order[np.repeat(lo, count)
+                              + np.arange(len(a)) - start]
+                    if delta == 0:
+                        keep = a < b
+                        a = a[keep]
+                        b = b[keep]
+                    d = unique[a] - unique[b]
+                    close = np.einsum("ij,ij->i", d, d) < eps2
+                    pairs_a.append(a[close])
+                    pairs_b.append(b[close])
+        a = np.concatenate(pairs_a)
+        b = np.concatenate(pairs_b)
+        # Propagate the lowest label through the pairs
+        while len(a):
+            old = label.copy()
+            np.minimum.at(label, a, label[b])
+            np.minimum.at(label, b, label[a])
+            label = label[label]
+            if np.array_equal(label, old):
+                break
+
+    # Number the groups in order of their first input vertex
+    group_first = np.full(n, len(verts), dtype=np.int_)
+    np.minimum.at(group_first, label, first)
+    roots = np.flatnonzero(label == np.arange(n))
+    roots = roots[np.argsort(group_first[roots], kind="stable")]
+    root2new = np.zeros(n, dtype=np.int_)
+    root2new[roots] = np.arange(len(roots))
+
+    old2new = root2new[label[inverse]]
+    new_verts = verts[group_first[roots]]
+    return new_verts, old2new
+
 
-    new_verts = np.array(new_verts)
+def merge_close_vertices(verts, faces, close_epsilon=1e-5):
+    """
+    Will merge vertices that are closer than close_epsilon, using
+    weld_vertices()
+
+    Returns: new_verts, new_faces
+    """
+    new_verts, old2new = weld_vertices(verts, close_epsilon)
 
     # Recompute face indices to index in new_verts
-    new_faces = np.zeros((len(faces), 3), dtype=np.int_)
-    for i, f in enumerate(faces):
-        new_faces[i] = (old2new[f[0]], old2new[f[1]], old2new[f[2]])
+    new_faces = old2new[np.asarray(faces, dtype=np.int_).reshape(-1, 3)]
 
     # again, plot with utils.trimesh3d(new_verts, new_faces)
     return new_verts, new_faces
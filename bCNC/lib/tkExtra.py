@@ -665,7 +665,16 @@ class ProgressBar(Canvas):
         self.msg = ""
 
     # ----------------------------------------------------------------------
-    def setProgress(self, now, done=None, txt=None):
+    # Change the upper limit without restarting the timer
+    # ----------------------------------------------------------------------
+    def setHigh(self, high):
+        self.high = float(high)
+        self.length = float(self.high - self.low)
+
+    # ----------------------------------------------------------------------
+    # remain: estimated remaining time [s], None to extrapolate it
+    # ----------------------------------------------------------------------
+    def setProgress(self, now, done=None, txt=None, remain=None):
         self.now = now
         if self.now < self.low:
             self.now = self.low
@@ -685,7 +694,9 @@ class ProgressBar(Canvas):
         # calculate remaining time
         dt = time.time() - self.t0
         p = now - self.low
-        if p > 0:
+        if remain is not None:
+            tot = dt + remain
+        elif p > 0:
             tot = dt / p * (self.high - self.low)
         else:
             tot = 0.0
@@ -166,17 +166,24 @@ Also note you can export resulting slices to DXF and SVG if needed.
             # make sure zmin<zmax
             zmin, zmax = min(zmin, zmax), max(zmin, zmax)
             # loop over multiple layers if zstep > 0
+            heights = []
             z = zmax
             while z >= zmin:
-                self.app.setStatus(
-                    _("Slicing {} {:f} in {:f} -> "
-                      + "{:f} of {}").format(axis, z, zmin, zmax, file),
-                    True,
-                )
-                block = self.slice(verts, faces, z, zout, axis)
+                heights.append(z)
+                z -= abs(zstep)
+            self.app.setStatus(
+                _("Slicing {} {:d} layers in {:f} -> "
+                  + "{:f} of {}").format(axis, len(heights), zmin, zmax,
+                                          file),
+                True,
+            )
+            # all layers at once, reusing the mesh topology
+            sections = meshcut.cross_sections(
+                verts, faces, self.planeNormal(axis), heights)
+            for z, contours in zip(heights, sections):
+                block = self.contoursBlock(contours, z, zout, axis)
                 if block is not None:
                     blocks.append(block)
-                z -= abs(zstep)
 
         # Insert blocks to bCNC
         active = app.activeBlock()
@@ -208,25 +215,28 @@ Also note you can export resulting slices to DXF and SVG if needed.
         for vert in verts:
             vert[a], vert[b] = ia * vert[b], ib * vert[a]
 
-    def slice(self, verts, faces, z, zout=None, axis="z"):
-        tags = "[slice]"
-        if axis == "z":
-            tags = f"[slice,minz:{float(z):f}]"
-        block = Block(f"slice {axis}{float(z):f} {tags}")
-
-        # FIXME: slice along different axes
+    # Normal of the slicing planes along axis
+    def planeNormal(self, axis):
         if axis == "x":
-            plane_orig = (z, 0, 0)
-            plane_norm = (1, 0, 0)
+            return (1, 0, 0)
         elif axis == "y":
-            plane_orig = (0, z, 0)
-            plane_norm = (0, 1, 0)
+            return (0, 1, 0)
         else:
-            plane_orig = (0, 0, z)  # z height to slice
-            plane_norm = (0, 0, 1)
+            return (0, 0, 1)
 
+    def slice(self, verts, faces, z, zout=None, axis="z"):
         # Crosscut
+        plane_norm = self.planeNormal(axis)
+        plane_orig = [z * n for n in plane_norm]  # height to slice
         contours = meshcut.cross_section(verts, faces, plane_orig, plane_norm)
+        return self.contoursBlock(contours, z, zout, axis)
+
+    # Convert the contours of the slice at height z to a block
+    def contoursBlock(self, contours, z, zout=None, axis="z"):
+        tags = "[slice]"
+        if axis == "z":
+            tags = f"[slice,minz:{float(z):f}]"
+        block = Block(f"slice {axis}{float(z):f} {tags}")
 
         # Flatten contours
         if zout is not None:
@@ -273,64 +283,15 @@ Also note you can export resulting slices to DXF and SVG if needed.
             D[i] = D[:, i] = np.sqrt(np.sum(np.square(verts - verts[i]), axis=1))
         return D
 
-    def pdist_squareformed_numpy(self, a):
-        # Thanks to Divakar Roy (@droyed)
-        # https://stackoverflow.com/questions/52030458/vectorized-spatial-distance-in-python-using-numpy
-        a_sumrows = np.einsum("ij,ij->i", a, a)
-        dist = a_sumrows[:, None] + a_sumrows - 2 * np.dot(a, a.T)
-        np.fill_diagonal(dist, 0)
-        return dist
-
     def merge_close_vertices(self, verts, faces, close_epsilon=1e-5):
         """
         Will merge vertices that are closer than close_epsilon.
 
-        Warning, this has a O(n^2) memory usage because we compute the full
-        vert-to-vert distance matrix. If you have a large mesh, might want
-        to use some kind of spatial search structure like an octree or some
-        fancy hashing scheme
-
         Returns: new_verts, new_faces
         """
-        # Pairwise distance between verts
-        verts = np.array(verts, dtype=np.float64)
-        # Use SciPy, otherwise use slow fallback
-        try:
-            import scipy.spatial.distance as spdist
-
-            D = spdist.cdist(verts, verts)
-        except ImportError:
-            D = np.sqrt(np.abs(self.pdist_squareformed_numpy(verts)))
-
-        # Test
-        print(len(verts), len(D), len(D[0]))
-
-        # Compute a mapping from old to new : for each input vert, store the
-        # index of the new vert it will be merged into
-        close_epsilon = 1e-5
-        old2new = np.zeros(D.shape[0], dtype=np.int_)
-        # A mask indicating if a vertex has already been merged into another
-        merged_verts = np.zeros(D.shape[0], dtype=np.bool_)
-        new_verts = []
-        for i in range(D.shape[0]):
-            if merged_verts[i]:
-                continue
-            else:
-                # The vertices that will be merged into this one
-                merged = np.flatnonzero(D[i, :] < close_epsilon)
-                old2new[merged] = len(new_verts)
-                new_verts.append(verts[i])
-                merged_verts[merged] = True
-
-        new_verts = np.array(new_verts)
-
-        # Recompute face indices to index in new_verts
-        new_faces = np.zeros((len(faces), 3), dtype=np.int_)
-        for i, f in enumerate(faces):
-            new_faces[i] = (old2new[f[0]], old2new[f[1]], old2new[f[2]])
-
-        # again, plot with utils.trimesh3d(new_verts, new_faces)
-        return new_verts, new_faces
+        self.app.setStatus(
+            _("Merging {} vertices").format(len(verts)), True)
+        return meshcut.merge_close_vertices(verts, faces, close_epsilon)
 
     def load_stl(self, stl_fname):
         m = stl.mesh.Mesh.from_file(stl_fname)
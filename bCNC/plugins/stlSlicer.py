@@ -17,9 +17,11 @@ import re
 from struct import unpack
 import sys
 
-from CNC import CNC, Block
+import numpy
+from CNC import CNC, Block, STL_FACET
 from ToolsPage import Plugin
 from bmath import Vector
+import meshcut
 from bpath import EPS, EPSV,eq, Path, Segment
 
 
@@ -42,12 +44,12 @@ except ImportError:
 
 HEADER_SIZE =80
 COUNT_SIZE =4
+SLICE_BATCH = 64 # heights sliced at once
 
 
 class stlImporter():
 	def __init__(self,filename,scale):
 		self.scale = scale
-		self.triangles = []
 		f=open(filename,"rb")
 		header = f.read(HEADER_SIZE)
 		facet_count = unpack("<I",f.read(COUNT_SIZE))[0]
@@ -62,62 +64,51 @@ class stlImporter():
 		print ("minx,maxx",self.minx,self.maxx)
 		print ("miny,maxy",self.miny,self.maxy)
 		print ("minz,maxz",self.minz,self.maxz)
-		self.nbTriangles = len(self.triangles)
+		self.nbTriangles = len(self.faces)
 		print ("nbTriangles",self.nbTriangles)
 
+	# read the 50 bytes facet records at once, keeping the model as the
+	# float32 arrays of the file for the welded vertices and normals, and
+	# the indices of the triangles. The scale and offset are applied when
+	# the coordinates are requested
 	def parse(self,f,facet_count):
-		self.maxx=self.maxy=self.maxz = -float("inf")
-		self.minx=self.miny=self.minz = float("inf")
-		for i in range(1, facet_count + 1):
-			n1 = unpack("<f", f.read(4))[0]*self.scale
-			n2 = unpack("<f", f.read(4))[0]*self.scale
-			n3 = unpack("<f", f.read(4))[0]*self.scale
-			
-			n = [float(n1), float(n2), float(n3)]
-			
-			v11 = unpack("<f", f.read(4))[0]*self.scale
-			v12 = unpack("<f", f.read(4))[0]*self.scale
-			v13 = unpack("<f", f.read(4))[0]*self.scale
-			self.checkMaxMin(v11,v12,v13)
-			p1 = [float(v11), float(v12), float(v13)]
-			
-			v21 = unpack("<f", f.read(4))[0]*self.scale
-			v22 = unpack("<f", f.read(4))[0]*self.scale
-			v23 = unpack("<f", f.read(4))[0]*self.scale
-			self.checkMaxMin(v21,v22,v23)
-			p2 = [float(v21), float(v22), float(v23)]
-			
-			v31 = unpack("<f", f.read(4))[0]*self.scale
-			v32 = unpack("<f", f.read(4))[0]*self.scale
-			v33 = unpack("<f", f.read(4))[0]*self.scale
-			self.checkMaxMin(v31,v32,v33)
-			p3 = [float(v31), float(v32), float(v33)]
-			
-			f.read(2)
-			self.triangles.append(Triangle3D(Point3D(p1),Point3D(p2),Point3D(p3),Vecteur(n)))
-			
-	def checkMaxMin(self,x,y,z):
-		if x > self.maxx : 
-			self.maxx = x
-		if y > self.maxy :
-			self.maxy = y
-		if z > self.maxz :
-			self.maxz =z 
-		if x < self.minx :
-			self.minx =x
-		if y < self.miny :
-			self.miny = y
-		if z < self.minz :
-			self.minz =z
+		facets = numpy.fromfile(f,STL_FACET,facet_count)
+		self.normals = facets["normal"]
+		vertices = facets["vertex"].reshape(-1,3)
+		# only identical vertices, keeping the coordinates of the file
+		old2new = meshcut.weld_vertices(vertices,0.0)[1]
+		first = numpy.unique(old2new,return_index=True)[1]
+		self.verts = vertices[first]
+		self.faces = old2new.reshape(-1,3).astype(numpy.int32)
+		self.offset = numpy.zeros(3)
+		self._sliceIndex = None
+		self.checkMaxMin()
+
+	# return the (vertices,3) coordinates of the model
+	def coordinates(self):
+		return self.verts*numpy.float64(self.scale)+self.offset
+
+	def checkMaxMin(self):
+		if len(self.verts):
+			coordinates = self.coordinates()
+			self.minx,self.miny,self.minz = coordinates.min(axis=0).tolist()
+			self.maxx,self.maxy,self.maxz = coordinates.max(axis=0).tolist()
+		else:
+			self.maxx=self.maxy=self.maxz = -float("inf")
+			self.minx=self.miny=self.minz = float("inf")
+
+	# object view of the model, built on request
+	@property
+	def triangles(self):
+		points = [Point3D(v) for v in self.coordinates().tolist()]
+		normals = self.normals*numpy.float64(self.scale)
+		return [Triangle3D(points[a],points[b],points[c],Vecteur(n))
+				for (a,b,c),n in zip(self.faces.tolist(),normals.tolist())]
 
 	def Offset(self,xoff,yoff,zoff):
-		self.maxx=self.maxy=self.maxz = -float("inf")
-		self.minx=self.miny=self.minz = float("inf")
-		for triangle in self.triangles:
-			triangle = triangle.offset(xoff,yoff,zoff)
-			self.checkMaxMin(triangle.p1.x, triangle.p1.y, triangle.p1.z)
-			self.checkMaxMin(triangle.p2.x, triangle.p2.y, triangle.p2.z)
-			self.checkMaxMin(triangle.p3.x, triangle.p3.y, triangle.p3.z)
+		self.offset += [xoff,yoff,zoff]
+		self._sliceIndex = None
+		self.checkMaxMin()
 		print ("+++++")
 		print ("model offset :")
 		print ("deltax",self.maxx-self.minx)
@@ -127,69 +118,82 @@ class stlImporter():
 		print ("miny,maxy",self.miny,self.maxy)
 		print ("minz,maxz",self.minz,self.maxz)
 
+	# return the (triangles,3,3) coordinates of the vertices of every
+	# triangle, with the axes in the order of dirIndexes
 	def convertTriangles(self,dirIndexes):
-		newTriangles = []
-		for triangle in self.triangles:
-			points = [triangle.p1,triangle.p2, triangle.p3]
-			newPoints = []
-			for point in points :
-				xyz = [point.x,point.y,point.z]
-				newx = xyz[dirIndexes[0]]
-				newy = xyz[dirIndexes[1]]
-				newz = xyz[dirIndexes[2]]
-				newpoint = Point3D([newx,newy,newz])
-				newPoints.append(newpoint)
-			newtriangle = Triangle3D(newPoints[0],newPoints[1],newPoints[2])
-			newTriangles.append(newtriangle)
-		return newTriangles
+		return self.coordinates()[:,dirIndexes][self.faces]
+
+	# return the converted triangles sorted by their lowest height, with
+	# their lowest and highest heights, their index and the highest
+	# extent of a triangle, kept for the last direction
+	def sliceIndex(self,dirIndexes):
+		key = tuple(dirIndexes)
+		if self._sliceIndex is None or self._sliceIndex[0] != key:
+			triangles = self.convertTriangles(dirIndexes)
+			z = triangles[:,:,2]
+			zmin = z.min(axis=1)
+			zmax = z.max(axis=1)
+			order = numpy.argsort(zmin,kind="stable")
+			extent = float((zmax-zmin).max()) if len(z) else 0.0
+			self._sliceIndex = (key,triangles[order],zmin[order],zmax[order],order,extent)
+		return self._sliceIndex[1:]
 
 	def getSliceAlongDir(self,direction,height):
+		return self.getSlicesAlongDir(direction,[height])[0]
+
+	# slice the model at all heights at once, returning a path per height
+	def getSlicesAlongDir(self,direction,heights):
 		dirDict = {"y":[1,2,0],"x":[0,2,1],"z":[0,1,2]}
 		dirIndexes = dirDict.get(direction,[0,1,2])
-		path = Path("slice "+str(height))
-		def findIndex(p1sign,p2sign,p3sign,signToFind):
-			index = 0
-			for psign in [p1sign,p2sign,p3sign]:
-				if psign == signToFind:
-					return index
-				index +=1
-			return -1
-		def getPointZero(p1,p2,height):
-			x1,y1,z1 = p1.x,p1.y,p1.z
-			x2,y2,z2 = p2.x,p2.y,p2.z
-			if z2==z1 : 
-				return None
-			t = (height-z1)/(z2-z1)
-			x = x1+t*(x2-x1)
-			y = y1+t*(y2-y1)
-			return Vector(x,y)
-		
-		convertedTriangles = self.convertTriangles(dirIndexes)
-		for triangle in convertedTriangles :
-			p1sign = (triangle.p1.z-height)>0
-			p2sign = (triangle.p2.z-height)>0
-			p3sign = (triangle.p3.z-height)>0
-			activeTriangle = (p1sign^p2sign)or (p1sign^p3sign) or (p2sign^p3sign)
-			signToFind = not ((p1sign and p2sign) or (p1sign and p3sign) or (p2sign and p3sign) )
-			isZero = triangle.p1.z-height==0 or triangle.p2.z-height==0 or triangle.p3.z-height==0
-			index = -1
-			if activeTriangle and not isZero:
-				index=findIndex(p1sign,p2sign,p3sign,signToFind)
-			q1q2q3 = None
-			if index>= 0:
-				q1q2q3 = [[triangle.p1,triangle.p2,triangle.p3][index]]
-				for i in range(3):
-					if not i == index:
-						q1q2q3.append([triangle.p1,triangle.p2,triangle.p3][i])
-			if q1q2q3 is not None :
-				[q1,q2,q3]=q1q2q3
-				r1=getPointZero(q1,q2,height)
-				r2=getPointZero(q1,q3,height)
-				if r1 is not None and r2 is not None:
-					segm = Segment(Segment.LINE,r1,r2)
-					if segm.length() > 0 :
-						path.append(segm)
-		return path
+		paths = [Path("slice "+str(height)) for height in heights]
+		if not paths or len(self.faces)==0:
+			return paths
+
+		triangles,zmin,zmax,order,extent = self.sliceIndex(dirIndexes)
+		heights = numpy.asarray(heights,numpy.float64)
+		hsort = numpy.argsort(heights,kind="stable")
+		sortedHeights = heights[hsort]
+		# triangles that may cross one of the heights
+		start = numpy.searchsorted(zmin,sortedHeights[0]-extent)
+		end = numpy.searchsorted(zmin,sortedHeights[-1])
+		zmin = zmin[start:end]
+		zmax = zmax[start:end]
+		# every (triangle,height) with the height between its vertices
+		first = numpy.searchsorted(sortedHeights,zmin,side="right")
+		count = numpy.maximum(numpy.searchsorted(sortedHeights,zmax)-first,0)
+		tid = numpy.repeat(numpy.arange(start,end),count)
+		hid = numpy.repeat(first-numpy.cumsum(count)+count,count)+numpy.arange(len(tid))
+		# in the order of the heights, then of the triangles in the file
+		pairs = numpy.lexsort((order[tid],hid))
+		tid = tid[pairs]
+		hid = hid[pairs]
+		height = sortedHeights[hid][:,None]
+		triangles = triangles[tid]
+		z = triangles[:,:,2]
+		# skip the triangles with a vertex on the height
+		active = ~(z==height).any(axis=1)
+		triangles = triangles[active]
+		height = height[active]
+		hid = hid[active]
+		above = z[active]>height
+		# the vertex alone on its side and the two others in order
+		index = numpy.where(above.sum(axis=1)==1,above.argmax(axis=1),(~above).argmax(axis=1))
+		others = numpy.array([[1,2],[0,2],[0,1]])[index]
+		rows = numpy.arange(len(triangles))[:,None]
+		q1 = triangles[rows[:,0],index]
+		q23 = triangles[rows,others]
+		t = (height-q1[:,None,2])/(q23[:,:,2]-q1[:,None,2])
+		r = q1[:,None,:2]+t[:,:,None]*(q23[:,:,:2]-q1[:,None,:2])
+		for h,((x1,y1),(x2,y2)) in zip(hsort[hid].tolist(),r.tolist()):
+			if x1!=x2 or y1!=y2:
+				paths[h].append(Segment(Segment.LINE,Vector(x1,y1),Vector(x2,y2)))
+		return paths
+
+	# generator of the slices at every height, computed by batches
+	def iterSlicesAlongDir(self,direction,heights):
+		for i in range(0,len(heights),SLICE_BATCH):
+			for path in self.getSlicesAlongDir(direction,heights[i:i+SLICE_BATCH]):
+				yield path
 
 
 class SliceRemoval:
@@ -454,9 +458,13 @@ class Surfacer():
 		allSlices = []
 # 		[dir1start,dir1end] = [self.xstart,self.xend] if self.direction =="x" else [self.ystart,self.yend]
 		[dir2start,dir2end] = [self.ystart,self.yend] if self.direction =="x" else [self.xstart,self.xend]
+		positions = []
 		currentposdir2 = dir2start
 		while dir2end>=currentposdir2:
-			RawSlicePath = self.stlObj.getSliceAlongDir(self.direction,currentposdir2)
+			positions.append(currentposdir2)
+			currentposdir2+=self.toolStep
+		slices = self.stlObj.iterSlicesAlongDir(self.direction,positions)
+		for currentposdir2,RawSlicePath in zip(positions,slices):
 			RawSlicePath =self.getTopSegs2([RawSlicePath])
 			offZ = self.radiusCorrected
 			opath = RawSlicePath.offset(offZ)
@@ -486,11 +494,19 @@ class Surfacer():
 		[dir1start,dir1end] = [self.xstart,self.xend] if self.direction =="x" else [self.ystart,self.yend]
 		[dir2start,dir2end] = [self.ystart,self.yend] if self.direction =="x" else [self.xstart,self.xend]
 		currentposdir2 = dir2start
+		# heights of the initial buffer and of the slice added at every step
+		heights = [currentposdir2+sliceOffset[0] for sliceOffset in self.slicesOffsets]
+		while abs(currentposdir2 - dir2end)>EPSV:
+			currentposdir2 = min(currentposdir2+self.toolStep,dir2end)
+			if abs(currentposdir2 -dir2end)<EPSV:
+				break
+			heights.append(currentposdir2+self.slicesOffsets[-1][0])
+		slices = self.stlObj.iterSlicesAlongDir(self.direction,heights)
+		currentposdir2 = dir2start
 		rotatingBufferSlicesPathList = [] #rotating buffer to avoid computing all slices at each tool step
 		for index,sliceOffset in enumerate(self.slicesOffsets) :
 			app.setStatus(_("initializing %.02f"%(float(index)/float(len(self.slicesOffsets))*100.)),True)
-			sliceToolStep = sliceOffset[0]
-			RawSliceNPath = self.stlObj.getSliceAlongDir(self.direction,currentposdir2+sliceToolStep).arcFit()#.split2contours()
+			RawSliceNPath = next(slices).arcFit()#.split2contours()
 			sliceNmaxPath = self.getTopSegs2([RawSliceNPath])
 			rotatingBufferSlicesPathList.append(sliceNmaxPath)
 		app.setStatus(_("init done"),True)
@@ -521,7 +537,7 @@ class Surfacer():
 			if abs(currentposdir2 -dir2end)<EPSV:
 				break
 			rotatingBufferSlicesPathList = rotatingBufferSlicesPathList[1:] #+ rotatingBufferSlicesPathList[:1]#rotate buffer left
-			newRawSliceNlast = self.stlObj.getSliceAlongDir(self.direction,currentposdir2+self.slicesOffsets[-1][0])#.split2contours()
+			newRawSliceNlast = next(slices)#.split2contours()
 			sliceNmax = self.getTopSegs2([newRawSliceNlast])
 			rotatingBufferSlicesPathList.extend([sliceNmax])
 			app.setStatus("progress %.2f "%(currentposdir2/dir2end*100.)+"%",True)
@@ -0,0 +1,10 @@
+import os
+import sys
+
+# Import the bCNC modules as the program does, see bCNC/__main__.py
+PRGPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       "..", "bCNC")
+for path in ("", "lib", "plugins", "controllers"):
+    path = os.path.normpath(os.path.join(PRGPATH, path))
+    if path not in sys.path:
+        sys.path.append(path)
@@ -0,0 +1,135 @@
+import unittest
+
+import bclip
+
+
+# -----------------------------------------------------------------------------
+def square(x, y, size, ccw=True):
+    points = [(x, y), (x + size, y), (x + size, y + size), (x, y + size)]
+    return points if ccw else points[::-1]
+
+
+# -----------------------------------------------------------------------------
+# Loops as sets of rounded points, independent of start and tags
+# -----------------------------------------------------------------------------
+def shape(loops):
+    return sorted(
+        (round(bclip.area(loop), 6),
+         sorted((round(p[0], 6), round(p[1], 6)) for p in loop))
+        for loop in loops
+    )
+
+
+# =============================================================================
+# Union with the positive winding rule
+# =============================================================================
+class UnionTest(unittest.TestCase):
+    # ----------------------------------------------------------------------
+    def test_single(self):
+        self.assertEqual(shape(bclip.union([square(0, 0, 10)])),
+                         shape([square(0, 0, 10)]))
+
+    # ----------------------------------------------------------------------
+    def test_empty(self):
+        self.assertEqual(bclip.union([]), [])
+        self.assertEqual(bclip.union([[]]), [])
+
+    # ----------------------------------------------------------------------
+    def test_overlap(self):
+        loops = bclip.union([square(0, 0, 10), square(5, 5, 10)])
+        self.assertEqual(len(loops), 1)
+        self.assertAlmostEqual(bclip.area(loops[0]), 175.0)
+        self.assertEqual(len(loops[0]), 8)
+
+    # ----------------------------------------------------------------------
+    def test_disjoint(self):
+        loops = bclip.union([square(0, 0, 10), square(20, 0, 10)])
+        self.assertEqual(len(loops), 2)
+        self.assertEqual([bclip.area(x) for x in loops], [100.0, 100.0])
+
+    # ----------------------------------------------------------------------
+    # A CW polygon inside a CCW one cuts a hole, returned as a CW loop
+    # ----------------------------------------------------------------------
+    def test_hole(self):
+        loops = bclip.union([square(0, 0, 30), square(10, 10, 10, False)])
+        self.assertEqual(sorted(bclip.area(x) for x in loops),
+                         [-100.0, 900.0])
+
+    # ----------------------------------------------------------------------
+    # A hole partly outside the outer polygon only notches it
+    # ----------------------------------------------------------------------
+    def test_hole_crossing(self):
+        loops = bclip.union([square(0, 0, 20), square(15, 5, 10, False)])
+        self.assertEqual(len(loops), 1)
+        self.assertAlmostEqual(bclip.area(loops[0]), 350.0)
+
+    # ----------------------------------------------------------------------
+    # Winding 2 is filled as winding 1, negative winding is empty
+    # ----------------------------------------------------------------------
+    def test_winding(self):
+        self.assertEqual(
+            shape(bclip.union([square(0, 0, 30), square(10, 10, 10)])),
+            shape([square(0, 0, 30)]))
+        self.assertEqual(bclip.union([square(0, 0, 10, False)]), [])
+
+    # ----------------------------------------------------------------------
+    # A self crossing bow tie keeps only its CCW lobe
+    # ----------------------------------------------------------------------
+    def test_bow_tie(self):
+        loops = bclip.union([[(0, 0), (10, 10), (10, 0), (0, 10)]])
+        self.assertEqual(len(loops), 1)
+        self.assertAlmostEqual(bclip.area(loops[0]), 25.0)
+        self.assertEqual(sorted(p[0] for p in loops[0]), [0.0, 0.0, 5.0])
+
+    # ----------------------------------------------------------------------
+    # Edges lying on each other are merged and collinear points removed
+    # ----------------------------------------------------------------------
+    def test_collinear(self):
+        loops = bclip.union([square(0, 0, 10), square(10, 0, 10)])
+        self.assertEqual(shape(loops),
+                         shape([[(0, 0), (20, 0), (20, 10), (0, 10)]]))
+
+        loop = [(0, 0), (5, 0), (10, 0), (10, 10), (10, 10), (0, 10)]
+        self.assertEqual(shape(bclip.union([loop])),
+                         shape([square(0, 0, 10)]))
+
+    # ----------------------------------------------------------------------
+    # Zero area polygons and spikes vanish
+    # ----------------------------------------------------------------------
+    def test_degenerate(self):
+        self.assertEqual(bclip.union([[(0, 0), (10, 0), (5, 0)]]), [])
+        self.assertEqual(bclip.union([[(0, 0), (0, 0), (0, 0)]]), [])
+        spike = [(0, 0), (10, 0), (10, 5), (20, 5), (10, 5), (10, 10),
+                 (0, 10)]
+        self.assertEqual(shape(bclip.union([spike])),
+                         shape([square(0, 0, 10)]))
+
+    # ----------------------------------------------------------------------
+    # Points closer than the snapping tolerance are merged
+    # ----------------------------------------------------------------------
+    def test_snap(self):
+        loops = bclip.union([square(0, 0, 10),
+                             square(10 + 1e-12, 0, 10)])
+        self.assertEqual(len(loops), 1)
+        self.assertEqual(len(loops[0]), 4)
+
+    # ----------------------------------------------------------------------
+    # The tags follow their edges through the splits
+    # ----------------------------------------------------------------------
+    def test_tags(self):
+        a = [(x, y, "a") for x, y in square(0, 0, 10)]
+        b = [(x, y, "b") for x, y in square(5, 5, 10)]
+        loops = bclip.union([a, b])
+        self.assertEqual(len(loops), 1)
+        for i, p in enumerate(loops[0]):
+            q = loops[0][(i + 1) - len(loops[0])]
+            # the edge p-q lies on a side of the square of its tag
+            lo = 0 if p[2] == "a" else 5
+            self.assertTrue(
+                any(abs(p[k] - v) < 1e-9 and abs(q[k] - v) < 1e-9
+                    for k in (0, 1) for v in (lo, lo + 10)),
+                f"{p} {q}")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,226 @@
+import math
+import random
+import unittest
+
+from bmath import Vector
+from bpath import Path, Segment, SegmentGrid
+
+
+# -----------------------------------------------------------------------------
+def randomSegments(rnd, n, size=100.0):
+    segments = []
+    for _ in range(n):
+        A = Vector(rnd.uniform(0, size), rnd.uniform(0, size))
+        if rnd.random() < 0.7:
+            B = A + Vector(rnd.uniform(-10, 10), rnd.uniform(-10, 10))
+            segments.append(Segment(Segment.LINE, A, B))
+        else:
+            r = rnd.uniform(1, 10)
+            a = rnd.uniform(0, 2 * math.pi)
+            b = a + rnd.uniform(0.2, 5.0)
+            C = A
+            A = C + Vector(r * math.cos(a), r * math.sin(a))
+            B = C + Vector(r * math.cos(b), r * math.sin(b))
+            segments.append(Segment(Segment.CCW, A, B, C))
+    return segments
+
+
+# -----------------------------------------------------------------------------
+def overlap(extent, minx, miny, maxx, maxy):
+    sminx, sminy, smaxx, smaxy = extent
+    return (sminx <= maxx and smaxx >= minx
+            and sminy <= maxy and smaxy >= miny)
+
+
+# =============================================================================
+# The grid returns the same candidates as a scan of all the segments
+# =============================================================================
+class SegmentGridTest(unittest.TestCase):
+    def setUp(self):
+        self.rnd = random.Random(7)
+        self.segments = randomSegments(self.rnd, 300)
+        self.grid = SegmentGrid(self.segments)
+
+    # ----------------------------------------------------------------------
+    # All the segments whose extent overlaps, the part swept for arcs, and
+    # none whose bounding box does not
+    # ----------------------------------------------------------------------
+    def test_box(self):
+        for _ in range(200):
+            x, y = self.rnd.uniform(-10, 110), self.rnd.uniform(-10, 110)
+            box = (x, y, x + self.rnd.uniform(0, 30),
+                   y + self.rnd.uniform(0, 30))
+            found = self.grid.box(*box)
+            self.assertEqual(found, sorted(set(found)))
+            for k, s in enumerate(self.segments):
+                if overlap(SegmentGrid._extent(s), *box):
+                    self.assertIn(k, found)
+                elif k in found:
+                    self.assertTrue(
+                        overlap((s.minx, s.miny, s.maxx, s.maxy), *box))
+
+    # ----------------------------------------------------------------------
+    # Every segment intersecting the query one must be a candidate
+    # ----------------------------------------------------------------------
+    def test_query_intersections(self):
+        queries = randomSegments(self.rnd, 300)
+        # vertical and horizontal lines across the whole grid
+        queries.append(Segment(Segment.LINE, Vector(50, -5), Vector(50, 105)))
+        queries.append(Segment(Segment.LINE, Vector(-5, 50), Vector(105, 50)))
+        for query in queries:
+            found = set(self.grid.query(query))
+            for k, s in enumerate(self.segments):
+                P1, P2 = query.intersect(s)
+                if P1 is not None or P2 is not None:
+                    self.assertIn(k, found, f"{query} misses {s}")
+
+    # ----------------------------------------------------------------------
+    # The extent of an arc includes its extreme points, not only A and B
+    # ----------------------------------------------------------------------
+    def test_arc_extent(self):
+        arc = Segment(Segment.CCW, Vector(10, 0), Vector(-10, 0), Vector(0, 0))
+        grid = SegmentGrid([arc, Segment(Segment.LINE, Vector(-20, -20),
+                                         Vector(20, -20))])
+        self.assertEqual(grid.box(-1, 9, 1, 11), [0])
+
+    # ----------------------------------------------------------------------
+    def test_empty(self):
+        grid = SegmentGrid([])
+        self.assertEqual(grid.box(0, 0, 1, 1), [])
+        self.assertEqual(grid.line(Vector(0, 0), Vector(1, 1)), [])
+
+    # ----------------------------------------------------------------------
+    # The index of a path is rebuilt when its segments change
+    # ----------------------------------------------------------------------
+    def test_path_index(self):
+        path = Path("test")
+        path.extend(self.segments[:10])
+        grid = path.spatialIndex()
+        self.assertIs(path.spatialIndex(), grid)
+        path.append(self.segments[10])
+        self.assertIsNot(path.spatialIndex(), grid)
+        self.assertEqual(len(path.spatialIndex().segments), 11)
+
+
+# -----------------------------------------------------------------------------
+# Closed path through the points, an item (x, y, cx, cy) starts a CCW arc
+# -----------------------------------------------------------------------------
+def closedPath(points, cw=False):
+    path = Path("test")
+    for P, Q in zip(points, points[1:] + points[:1]):
+        A = Vector(P[0], P[1])
+        B = Vector(Q[0], Q[1])
+        if len(P) > 2:
+            path.append(Segment(Segment.CCW, A, B, Vector(P[2], P[3])))
+        else:
+            path.append(Segment(Segment.LINE, A, B))
+    if cw:
+        path.invert()
+    return path
+
+
+SHAPES = {
+    "square": [(0, 0), (20, 0), (20, 20), (0, 20)],
+    "slot": [(0, 0), (20, 0, 20, 5), (20, 10), (0, 10)],
+    "L": [(0, 0), (30, 0), (30, 10), (10, 10), (10, 30), (0, 30)],
+    # two squares joined by a neck 2 wide, splits inside
+    "dumbbell": [(0, 0), (20, 0), (20, 9), (30, 9), (30, 0), (50, 0),
+                 (50, 20), (30, 20), (30, 11), (20, 11), (20, 20), (0, 20)],
+}
+
+
+# =============================================================================
+# offsetClip against the chain offset, intersectSelf, removeExcluded
+# =============================================================================
+class OffsetClipTest(unittest.TestCase):
+    ACCURACY = 0.01
+
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def oldOffset(path, offset):
+        opath = path.offset(offset)
+        opath.intersectSelf()
+        opath.removeExcluded(path, offset)
+        opath.removeZeroLength(abs(offset) / 100.0)
+        return opath.split2contours()
+
+    # ----------------------------------------------------------------------
+    # Minimum and maximum distance of the contours from the path
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def wall(path, contours):
+        distances = [
+            path.distance(segment.distPoint(segment.length() * k / 8.0))
+            for contour in contours
+            for segment in contour
+            for k in range(8)
+        ]
+        return min(distances), max(distances)
+
+    # ----------------------------------------------------------------------
+    def check(self, name, offset, cw=False):
+        path = closedPath(SHAPES[name], cw)
+        if cw:
+            offset = -offset
+        new = path.offsetClip(offset, self.ACCURACY)
+        old = self.oldOffset(closedPath(SHAPES[name], cw), offset)
+        self.assertEqual(len(new), len(old), name)
+        for contour in new:
+            self.assertTrue(contour.isClosed(), name)
+        self.assertEqual(
+            [round(x, 1) for x in sorted(c.length() for c in new)],
+            [round(x, 1) for x in sorted(c.length() for c in old)],
+            name,
+        )
+        lo, hi = self.wall(path, new)
+        self.assertGreaterEqual(lo, abs(offset) - self.ACCURACY, name)
+        self.assertLessEqual(hi, abs(offset) + self.ACCURACY, name)
+        return new
+
+    # ----------------------------------------------------------------------
+    def test_inside(self):
+        for name in SHAPES:
+            self.check(name, 1.5)
+            self.check(name, 1.5, True)
+
+    # ----------------------------------------------------------------------
+    def test_outside(self):
+        for name in SHAPES:
+            self.check(name, -1.5)
+            self.check(name, -1.5, True)
+
+    # ----------------------------------------------------------------------
+    def test_split(self):
+        self.assertEqual(len(self.check("dumbbell", 0.5)), 1)
+        self.assertEqual(len(self.check("dumbbell", 1.5)), 2)
+
+    # ----------------------------------------------------------------------
+    def test_vanish(self):
+        path = closedPath(SHAPES["square"])
+        self.assertEqual(path.offsetClip(10.5, self.ACCURACY), [])
+
+    # ----------------------------------------------------------------------
+    # The arcs are rebuilt on the circle of the original offset
+    # ----------------------------------------------------------------------
+    def test_arcs(self):
+        path = closedPath(SHAPES["slot"])
+        for offset in (0.5, 1.0, 2.3):
+            arcs = [s for c in path.offsetClip(offset, self.ACCURACY)
+                    for s in c if s.type != Segment.LINE]
+            self.assertEqual(len(arcs), 1)
+            self.assertAlmostEqual(arcs[0].C[0], 20.0, 9)
+            self.assertAlmostEqual(arcs[0].C[1], 5.0, 9)
+            self.assertAlmostEqual(arcs[0].radius, 5.0 - offset, 9)
+
+        # also on the rings of a pocket, offset again and again
+        radii = sorted(
+            s.radius for c in path.pocket(1.0, 0.4) for s in c
+            if s.type != Segment.LINE and (s.C - Vector(20, 5)).length() < 1e-9
+        )
+        self.assertEqual(len(radii), 12)
+        for k, r in enumerate(radii):
+            self.assertAlmostEqual(r, 0.1 + 0.4 * k, 9)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+import math
+import unittest
+
+import bplanner
+from bplanner import Planner, _trapezoid
+
+
+# -----------------------------------------------------------------------------
+# Time of the move integrating the speed profile in small steps
+# -----------------------------------------------------------------------------
+def integrate(length, v0, v1, nominal, accel, steps=200000):
+    ds = length / steps
+    time = 0.0
+    for i in range(steps):
+        s = (i + 0.5) * ds
+        v = min(nominal,
+                math.sqrt(v0 * v0 + 2.0 * accel * s),
+                math.sqrt(v1 * v1 + 2.0 * accel * (length - s)))
+        time += ds / v
+    return time
+
+
+# =============================================================================
+class TrapezoidTest(unittest.TestCase):
+    # ----------------------------------------------------------------------
+    # From rest to rest: accelerate, cruise, decelerate
+    # ----------------------------------------------------------------------
+    def test_trapezoid(self):
+        # 0.5 long ramps of 0.1s each and 99 at 10/s
+        self.assertAlmostEqual(_trapezoid(100.0, 0.0, 0.0, 10.0, 100.0),
+                               10.1)
+
+    # ----------------------------------------------------------------------
+    # Too short to reach the nominal speed: t = 2*sqrt(L/a)
+    # ----------------------------------------------------------------------
+    def test_triangle(self):
+        self.assertAlmostEqual(_trapezoid(1.0, 0.0, 0.0, 100.0, 100.0), 0.2)
+        self.assertAlmostEqual(_trapezoid(4.0, 0.0, 0.0, 100.0, 25.0),
+                               2.0 * math.sqrt(4.0 / 25.0))
+
+    # ----------------------------------------------------------------------
+    def test_cruise(self):
+        self.assertAlmostEqual(_trapezoid(30.0, 10.0, 10.0, 10.0, 100.0),
+                               3.0)
+
+    # ----------------------------------------------------------------------
+    # Only accelerating, v1^2 = v0^2 + 2*a*L
+    # ----------------------------------------------------------------------
+    def test_ramp(self):
+        v1 = math.sqrt(2.0 * 100.0 * 2.0)
+        self.assertAlmostEqual(_trapezoid(2.0, 0.0, v1, 100.0, 100.0),
+                               v1 / 100.0)
+        self.assertAlmostEqual(_trapezoid(2.0, v1, 0.0, 100.0, 100.0),
+                               v1 / 100.0)
+
+    # ----------------------------------------------------------------------
+    # The two forms agree when the cruise vanishes
+    # ----------------------------------------------------------------------
+    def test_boundary(self):
+        nominal, accel, v0, v1 = 10.0, 50.0, 2.0, 4.0
+        length = ((nominal ** 2 - v0 ** 2) + (nominal ** 2 - v1 ** 2)) \
+            / (2.0 * accel)
+        for delta in (-1e-9, 0.0, 1e-9):
+            self.assertAlmostEqual(
+                _trapezoid(length + delta, v0, v1, nominal, accel),
+                ((nominal - v0) + (nominal - v1)) / accel, 6)
+
+    # ----------------------------------------------------------------------
+    # Moving speeds at both ends, 1/v is singular when starting at rest
+    # ----------------------------------------------------------------------
+    def test_integrate(self):
+        for case in ((10.0, 5.0, 2.0, 20.0, 30.0),
+                     (1.0, 3.0, 1.0, 20.0, 30.0),
+                     (0.2, 3.0, 4.0, 5.0, 100.0)):
+            self.assertAlmostEqual(_trapezoid(*case), integrate(*case), 4,
+                                   case)
+
+
+# =============================================================================
+class PlannerTest(unittest.TestCase):
+    # ----------------------------------------------------------------------
+    def plan(self, *paths, junction=0.01):
+        times = []
+        planner = Planner((6000.0,) * 3, (100.0,) * 3, junction,
+                          lambda tag, seconds: times.append((tag, seconds)))
+        for tag, xyz, feed in paths:
+            planner.add(xyz, feed, tag)
+        planner.stop()
+        return times
+
+    # ----------------------------------------------------------------------
+    def test_single(self):
+        times = self.plan(("a", [(0, 0, 0), (100, 0, 0)], 600.0))
+        self.assertEqual([tag for tag, t in times], ["a"])
+        self.assertAlmostEqual(times[0][1], 10.1)
+
+    # ----------------------------------------------------------------------
+    # A straight line split in many moves takes the same time
+    # ----------------------------------------------------------------------
+    def test_split(self):
+        xyz = [(float(x), 0.0, 0.0) for x in range(101)]
+        times = self.plan(("a", xyz, 600.0))
+        self.assertEqual(len(times), 100)
+        self.assertAlmostEqual(sum(t for tag, t in times), 10.1)
+
+    # ----------------------------------------------------------------------
+    # Without junction deviation the corner is a full stop
+    # ----------------------------------------------------------------------
+    def test_corner(self):
+        times = self.plan(("a", [(0, 0, 0), (1, 0, 0), (1, 1, 0)], 6000.0),
+                          junction=0.0)
+        self.assertAlmostEqual(sum(t for tag, t in times), 0.4)
+        # a junction deviation keeps some speed
+        times = self.plan(("a", [(0, 0, 0), (1, 0, 0), (1, 1, 0)], 6000.0))
+        self.assertLess(sum(t for tag, t in times), 0.4)
+
+    # ----------------------------------------------------------------------
+    # The rates are per minute, the diagonal is limited by the slowest axis
+    # ----------------------------------------------------------------------
+    def test_rates(self):
+        planner = Planner((600.0, 1200.0, 60.0), (100.0,) * 3, 0.01, None)
+        self.assertAlmostEqual(planner._limit(planner.rates, (1, 0, 0)), 10.0)
+        s = math.sqrt(0.5)
+        self.assertAlmostEqual(planner._limit(planner.rates, (s, s, 0)),
+                               10.0 / s)
+
+    # ----------------------------------------------------------------------
+    def test_dwell(self):
+        times = []
+        planner = Planner((6000.0,) * 3, (100.0,) * 3, 0.01,
+                          lambda tag, seconds: times.append((tag, seconds)))
+        planner.add([(0, 0, 0), (1, 0, 0)], None, "a")
+        planner.dwell(2.0, "b")
+        self.assertEqual([tag for tag, t in times], ["a", "b"])
+        self.assertEqual(times[1][1], 2.0)
+
+    # ----------------------------------------------------------------------
+    # The look ahead is limited to the buffer
+    # ----------------------------------------------------------------------
+    def test_buffer(self):
+        xyz = [(float(x), 0.0, 0.0) for x in range(3 * bplanner.BUFFER)]
+        times = []
+        planner = Planner((6000.0,) * 3, (100.0,) * 3, 0.01,
+                          lambda tag, seconds: times.append((tag, seconds)))
+        planner.add(xyz, None, "a")
+        self.assertEqual(len(times), len(xyz) - bplanner.BUFFER)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+import math
+import random
+import unittest
+
+import btour
+
+
+# -----------------------------------------------------------------------------
+def randomNodes(rnd, n, size=100.0, length=10.0):
+    starts = []
+    ends = []
+    for _ in range(n):
+        x, y = rnd.uniform(0, size), rnd.uniform(0, size)
+        starts.append((x, y))
+        if rnd.random() < 0.3:
+            ends.append((x, y))  # closed block
+        else:
+            ends.append((x + rnd.uniform(-length, length),
+                         y + rnd.uniform(-length, length)))
+    return starts, ends
+
+
+# -----------------------------------------------------------------------------
+# Length of the rapid movements of the tour
+# -----------------------------------------------------------------------------
+def tourLength(starts, ends, order, reversed_):
+    flip = set(reversed_)
+    length = 0.0
+    for a, b in zip(order, order[1:]):
+        P = starts[a] if a in flip else ends[a]
+        Q = ends[b] if b in flip else starts[b]
+        length += math.dist(P, Q)
+    return length
+
+
+# -----------------------------------------------------------------------------
+# Brute force nearest neighbour tour from node 0
+# -----------------------------------------------------------------------------
+def nearestNeighbour(starts, ends, reverse):
+    order = [0]
+    flip = []
+    left = set(range(1, len(starts)))
+    P = ends[0]
+    while left:
+        best = None
+        for k in left:
+            entries = [(starts[k], False)]
+            if reverse:
+                entries.append((ends[k], True))
+            for Q, rev in entries:
+                d = math.dist(P, Q)
+                if best is None or d < best[0]:
+                    best = (d, k, rev)
+        d, k, rev = best
+        left.remove(k)
+        order.append(k)
+        if rev:
+            flip.append(k)
+        P = starts[k] if rev else ends[k]
+    return order, flip
+
+
+# =============================================================================
+class TourTest(unittest.TestCase):
+    # ----------------------------------------------------------------------
+    def check(self, starts, ends, reverse):
+        order, reversed_ = btour.tour(starts, ends, reverse, 0.5)
+        n = len(starts)
+        self.assertEqual(sorted(order), list(range(n)))
+        if not n:
+            self.assertEqual(reversed_, [])
+            return 0.0
+        self.assertEqual(order[0], 0)
+        if reverse:
+            # only blocks with distinct end points are reported
+            for k in reversed_:
+                self.assertNotEqual(starts[k], ends[k])
+        else:
+            self.assertEqual(reversed_, [])
+        length = tourLength(starts, ends, order, reversed_)
+        nn = nearestNeighbour(starts, ends, reverse)
+        self.assertLessEqual(length, tourLength(starts, ends, *nn) + 1e-9)
+        return length
+
+    # ----------------------------------------------------------------------
+    def test_small(self):
+        for n in range(5):
+            starts, ends = randomNodes(random.Random(n), n)
+            self.check(starts, ends, False)
+            self.check(starts, ends, True)
+
+    # ----------------------------------------------------------------------
+    def test_random(self):
+        rnd = random.Random(11)
+        for n in (10, 50, 200):
+            starts, ends = randomNodes(rnd, n)
+            self.check(starts, ends, False)
+            self.check(starts, ends, True)
+
+    # ----------------------------------------------------------------------
+    # Reversing the blocks can only shorten the tour
+    # ----------------------------------------------------------------------
+    def test_reverse(self):
+        rnd = random.Random(5)
+        starts, ends = randomNodes(rnd, 100, length=30.0)
+        self.assertLessEqual(self.check(starts, ends, True),
+                             self.check(starts, ends, False) + 1e-9)
+
+    # ----------------------------------------------------------------------
+    # Coincident points
+    # ----------------------------------------------------------------------
+    def test_duplicates(self):
+        starts = [(0, 0), (5, 5), (5, 5), (0, 0), (5, 5), (10, 0)]
+        ends = [(5, 5), (0, 0), (5, 5), (0, 0), (10, 0), (10, 0)]
+        self.check(starts, ends, False)
+        self.check(starts, ends, True)
+
+
+# =============================================================================
+class KDTreeTest(unittest.TestCase):
+    # ----------------------------------------------------------------------
+    def test_nearest(self):
+        rnd = random.Random(3)
+        points = [(rnd.uniform(0, 100), rnd.uniform(0, 100))
+                  for _ in range(300)]
+        tree = btour.KDTree(points)
+        removed = set(rnd.sample(range(len(points)), 100))
+        for i in removed:
+            tree.remove(i)
+        tree.remove(next(iter(removed)))  # twice is harmless
+        for _ in range(100):
+            x, y = rnd.uniform(-10, 110), rnd.uniform(-10, 110)
+            found = tree.nearest(x, y, 5)
+            expect = sorted(
+                (i for i in range(len(points)) if i not in removed),
+                key=lambda i: math.dist(points[i], (x, y)),
+            )[:5]
+            self.assertEqual(found, expect)
+
+
+if __name__ == "__main__":
+    unittest.main()
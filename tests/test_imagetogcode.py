@@ -0,0 +1,58 @@
+import unittest
+
+import numpy
+
+import imageToGcode
+from imageToGcode import (
+    Image_Matrix_Numpy,
+    ball_tool,
+    endmill,
+    make_tool_shape,
+    vee_common,
+)
+
+
+# -----------------------------------------------------------------------------
+# Random image of w rows and h columns padded for the tool
+# -----------------------------------------------------------------------------
+def randomImage(rnd, w, h, tool):
+    image = Image_Matrix_Numpy(w, h)
+    image.matrix = rnd.uniform(-1.0, 0.0, (w, h)).astype("float32")
+    image.pad_w_zeros(tool)
+    return image
+
+
+# =============================================================================
+# The height field of the whole image gives height_calc() at every pixel
+# =============================================================================
+class HeightFieldTest(unittest.TestCase):
+    # ----------------------------------------------------------------------
+    def check(self, image, tool):
+        field = image.height_field(tool)
+        w, h = image.shape
+        self.assertEqual(field.shape, (w, h))
+        expect = numpy.array([[image.height_calc(x, y, tool)
+                               for x in range(h)] for y in range(w)])
+        numpy.testing.assert_array_equal(field, expect)
+
+    # ----------------------------------------------------------------------
+    def test_tools(self):
+        rnd = numpy.random.RandomState(8)
+        for shape, wdia in ((ball_tool, 0.3), (endmill, 0.25),
+                            (vee_common(60.0), 0.3), (ball_tool, 0.05)):
+            tool = make_tool_shape(True, shape, wdia, 0.02)
+            # more rows than a block of HEIGHT_ROWS
+            image = randomImage(rnd, imageToGcode.HEIGHT_ROWS + 9, 23, tool)
+            self.check(image, tool)
+
+    # ----------------------------------------------------------------------
+    # A roughing offset widens the tool
+    # ----------------------------------------------------------------------
+    def test_rough_offset(self):
+        rnd = numpy.random.RandomState(9)
+        tool = make_tool_shape(True, ball_tool, 0.2, 0.02, 0.05)
+        self.check(randomImage(rnd, 17, 31, tool), tool)
+
+
+if __name__ == "__main__":
+    unittest.main()
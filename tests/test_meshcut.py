@@ -0,0 +1,272 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import meshcut
+
+
+# -----------------------------------------------------------------------------
+# Closed UV sphere of radius 10 with rings of vertices at the heights
+# 10*cos(k*pi/lat), and the vertices of every ring rotated by half a step
+# -----------------------------------------------------------------------------
+def sphere(lat=8, lon=12):
+    verts = [(0.0, 0.0, 10.0)]
+    for k in range(1, lat):
+        theta = np.pi * k / lat
+        for m in range(lon):
+            phi = 2.0 * np.pi * (m + 0.5 * (k & 1)) / lon
+            verts.append((10.0 * np.sin(theta) * np.cos(phi),
+                          10.0 * np.sin(theta) * np.sin(phi),
+                          10.0 * np.cos(theta)))
+    verts.append((0.0, 0.0, -10.0))
+    tris = []
+    bottom = len(verts) - 1
+    for m in range(lon):
+        n = (m + 1) % lon
+        tris.append((0, 1 + m, 1 + n))
+        tris.append((bottom, 1 + (lat - 2) * lon + n,
+                     1 + (lat - 2) * lon + m))
+    for k in range(lat - 2):
+        a = 1 + k * lon
+        b = a + lon
+        for m in range(lon):
+            n = (m + 1) % lon
+            tris.append((a + m, b + m, a + n))
+            tris.append((a + n, b + m, b + n))
+    return np.array(verts), np.array(tris)
+
+
+# -----------------------------------------------------------------------------
+# Cross section of a closed mesh as the set of the rounded undirected
+# segments of its loops, independent of the order and start of the loops
+# -----------------------------------------------------------------------------
+def segments(polylines):
+    found = set()
+    for p in polylines:
+        p = np.round(p, 6) + 0.0
+        for a, b in zip(p.tolist(), np.roll(p, -1, axis=0).tolist()):
+            if a != b:
+                found.add(tuple(sorted((tuple(a), tuple(b)))))
+    return found
+
+
+# -----------------------------------------------------------------------------
+# Brute force groups of the vertices chained closer than epsilon, as the
+# set of the input indices of every group
+# -----------------------------------------------------------------------------
+def bruteGroups(verts, epsilon):
+    verts = np.asarray(verts, dtype=np.float64)
+    n = len(verts)
+    parent = list(range(n))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i in range(n):
+        d = verts[i + 1:] - verts[i]
+        for j in np.flatnonzero(np.einsum("ij,ij->i", d, d)
+                                < epsilon * epsilon):
+            parent[find(i + 1 + j)] = find(i)
+    groups = {}
+    for i in range(n):
+        groups.setdefault(find(i), set()).add(i)
+    return sorted(map(sorted, groups.values()))
+
+
+# -----------------------------------------------------------------------------
+def weldGroups(old2new):
+    groups = {}
+    for i, k in enumerate(old2new):
+        groups.setdefault(int(k), []).append(i)
+    return sorted(groups.values())
+
+
+# =============================================================================
+class WeldTest(unittest.TestCase):
+    # ----------------------------------------------------------------------
+    def check(self, verts, epsilon):
+        verts = np.asarray(verts, dtype=np.float64)
+        new_verts, old2new = meshcut.weld_vertices(verts, epsilon)
+        self.assertEqual(weldGroups(old2new), bruteGroups(verts, epsilon))
+        # every group is numbered in input order and keeps its first vertex
+        firsts = [g[0] for g in sorted(weldGroups(old2new))]
+        self.assertEqual(list(old2new[firsts]), list(range(len(firsts))))
+        np.testing.assert_array_equal(new_verts, verts[firsts])
+        return old2new
+
+    # ----------------------------------------------------------------------
+    # Pairs just closer than epsilon across every face, edge and corner
+    # of the grid cells are welded, pairs just further are not
+    # ----------------------------------------------------------------------
+    def test_cell_boundaries(self):
+        epsilon = 0.1
+        verts = [(0.0, 0.0, 0.0), (1.0, 1.0, 1.0)]  # fix the grid origin
+        expect = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    if dx == dy == dz == 0:
+                        continue
+                    step = np.array((dx, dy, dz), dtype=np.float64)
+                    step /= np.linalg.norm(step)
+                    for k, scale in enumerate((0.999, 1.001)):
+                        # the pair straddles the boundary at 0.5
+                        P = np.full(3, 0.5) - step * epsilon * scale / 2.0
+                        P[2] += 0.3 * len(expect)  # apart from the others
+                        verts.append(P)
+                        verts.append(P + step * epsilon * scale)
+                        expect.append(k == 0)
+        old2new = self.check(verts, epsilon)
+        for k, welded in enumerate(expect):
+            i = 2 + 2 * k
+            self.assertEqual(old2new[i] == old2new[i + 1], welded, k)
+
+    # ----------------------------------------------------------------------
+    # Vertices in the cells at the lower and upper limits of the grid
+    # ----------------------------------------------------------------------
+    def test_grid_limits(self):
+        epsilon = 0.1
+        verts = [(0.0, 0.0, 0.0), (0.05, 0.0, 0.0),
+                 (1.0, 1.0, 1.0), (1.0, 1.0, 0.95),
+                 (0.0, 1.0, 0.0), (0.0, 0.95, 0.0)]
+        self.assertEqual(len(meshcut.weld_vertices(verts, epsilon)[0]), 3)
+        self.check(verts, epsilon)
+
+    # ----------------------------------------------------------------------
+    # Chains of close vertices weld even when their ends are far apart
+    # ----------------------------------------------------------------------
+    def test_chain(self):
+        verts = [(0.09 * k, 0.0, 0.0) for k in range(20)]
+        new_verts, old2new = meshcut.weld_vertices(verts, 0.1)
+        self.assertEqual(len(new_verts), 1)
+        self.assertEqual(list(old2new), [0] * 20)
+
+    # ----------------------------------------------------------------------
+    def test_random(self):
+        rnd = np.random.RandomState(5)
+        for epsilon in (0.05, 0.2):
+            centers = rnd.uniform(0.0, 2.0, (40, 3))
+            verts = centers[rnd.randint(0, 40, 400)] \
+                + rnd.normal(0.0, epsilon, (400, 3))
+            # and exact duplicates
+            verts = np.concatenate((verts, verts[rnd.randint(0, 400, 50)]))
+            self.check(verts, epsilon)
+
+    # ----------------------------------------------------------------------
+    # A large extent makes the cells larger than epsilon
+    # ----------------------------------------------------------------------
+    def test_large_extent(self):
+        epsilon = 1e-5
+        verts = [(0.0, 0.0, 0.0), (1e7, 0.0, 0.0),
+                 (5e6, 5e6, 5e6), (5e6 + 0.9e-5, 5e6, 5e6),
+                 (5e6 + 1.1e-5, 5e6, 5e6 + 1.5e-5)]
+        old2new = self.check(verts, epsilon)
+        self.assertEqual(list(old2new), [0, 1, 2, 2, 3])
+
+    # ----------------------------------------------------------------------
+    # Cells grown beyond epsilon to fit the index of the grid
+    # ----------------------------------------------------------------------
+    def test_few_cells(self):
+        rnd = np.random.RandomState(9)
+        verts = rnd.uniform(0.0, 1.0, (300, 3))
+        verts = np.concatenate((verts, verts + rnd.normal(0.0, 0.03,
+                                                          (300, 3))))
+        with mock.patch.object(meshcut, "WELD_CELLS", 4):
+            self.check(verts, 0.05)
+
+    # ----------------------------------------------------------------------
+    # Without epsilon only the identical rows are welded, as the STL slicer
+    # does with the float32 vertices of the file
+    # ----------------------------------------------------------------------
+    def test_exact(self):
+        a = np.float32(1.0)
+        b = np.nextafter(a, np.float32(2.0))
+        verts = np.array([(a, 0, 0), (b, 0, 0), (a, 0, 0), (0, a, 0)],
+                         dtype=np.float32)
+        new_verts, old2new = meshcut.weld_vertices(verts, 0.0)
+        self.assertEqual(list(old2new), [0, 1, 0, 2])
+        np.testing.assert_array_equal(new_verts, verts[[0, 1, 3]])
+
+    # ----------------------------------------------------------------------
+    def test_degenerate(self):
+        new_verts, old2new = meshcut.weld_vertices(np.zeros((0, 3)))
+        self.assertEqual(new_verts.shape, (0, 3))
+        self.assertEqual(len(old2new), 0)
+
+        # -0.0 is the same vertex as 0.0
+        verts = [(0.0, 0.0, 0.0), (-0.0, 0.0, -0.0), (1.0, 0.0, 0.0)]
+        self.assertEqual(list(meshcut.weld_vertices(verts, 0.0)[1]),
+                         [0, 0, 1])
+        self.check([(1.0, 2.0, 3.0)] * 5, 0.1)
+
+    # ----------------------------------------------------------------------
+    def test_faces(self):
+        verts = [(0, 0, 0), (1, 0, 0), (0, 1, 0), (1e-7, 0, 0), (1, 1, 0)]
+        faces = [(0, 1, 2), (3, 4, 2)]
+        new_verts, new_faces = meshcut.merge_close_vertices(verts, faces)
+        self.assertEqual(len(new_verts), 4)
+        self.assertEqual(new_faces.tolist(), [[0, 1, 2], [0, 3, 2]])
+
+
+# =============================================================================
+# Slicing many planes at once gives the same sections as one at a time
+# =============================================================================
+class CrossSectionsTest(unittest.TestCase):
+    # ----------------------------------------------------------------------
+    def check(self, verts, tris, normal, heights, **kwargs):
+        normal = np.asarray(normal, dtype=np.float64)
+        unit = normal / np.linalg.norm(normal)
+        sections = meshcut.cross_sections(verts, tris, normal, heights,
+                                          **kwargs)
+        self.assertEqual(len(sections), len(heights))
+        for h, section in zip(heights, sections):
+            expect = meshcut.cross_section(verts, tris, unit * h, normal)
+            self.assertEqual(segments(section), segments(expect), h)
+        return sections
+
+    # ----------------------------------------------------------------------
+    def test_heights(self):
+        verts, tris = sphere()
+        heights = list(np.linspace(-11.0, 11.0, 45))
+        sections = self.check(verts, tris, (0, 0, 1), heights, workers=1)
+        for h, section in zip(heights, sections):
+            self.assertEqual(len(section), int(abs(h) < 10.0), h)
+
+    # ----------------------------------------------------------------------
+    # Planes through the rings of vertices and the poles
+    # ----------------------------------------------------------------------
+    def test_vertices(self):
+        verts, tris = sphere()
+        heights = sorted(set(np.round(verts[:, 2], 12).tolist()))
+        self.assertEqual(len(heights), 9)
+        sections = self.check(verts, tris, (0, 0, 1), heights, workers=1)
+        for h, section in zip(heights[1:-1], sections[1:-1]):
+            # the section passes through the 12 vertices of the ring
+            ring = {tuple(v) for v in np.round(verts[np.isclose(
+                verts[:, 2], h)], 6).tolist()}
+            self.assertEqual(len(ring), 12)
+            points = {a for seg in segments(section) for a in seg}
+            self.assertTrue(ring <= points, h)
+
+    # ----------------------------------------------------------------------
+    def test_tilted(self):
+        verts, tris = sphere()
+        self.check(verts, tris, (1, 2, 3), list(np.linspace(-9.5, 9.5, 20)),
+                   workers=1)
+
+    # ----------------------------------------------------------------------
+    # The pool of spawned processes gives the same result
+    # ----------------------------------------------------------------------
+    def test_pool(self):
+        verts, tris = sphere()
+        heights = list(np.linspace(-9.9, 9.9, 16))
+        with mock.patch.object(meshcut, "SLICE_POOL", 0):
+            self.check(verts, tris, (0, 0, 1), heights, workers=2)
+
+
+if __name__ == "__main__":
+    unittest.main()
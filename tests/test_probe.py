@@ -0,0 +1,361 @@
+import os
+import re
+import tempfile
+import unittest
+
+import numpy
+
+import Helpers  # noqa: F401, installs _()
+from CNC import (BICUBIC, CNC, THINPLATE, THINPLATE_POINTS, GCode,
+                 Probe)
+
+MOVE = re.compile(r"G0X(-?[\d.]+)Y(-?[\d.]+)")
+LINE = re.compile(r"G1X(-?[\d.]+)Y(-?[\d.]+)Z(-?[\d.]+)")
+
+
+# -----------------------------------------------------------------------------
+def surface(x, y):
+    return 0.3 * numpy.sin(x / 7.0) + 0.2 * numpy.cos(y / 5.0)
+
+
+# -----------------------------------------------------------------------------
+def makeProbe(xn=9, yn=9, size=40.0):
+    probe = Probe()
+    probe.xmin, probe.xmax, probe.xn = 0.0, size, xn
+    probe.ymin, probe.ymax, probe.yn = 0.0, size, yn
+    probe.xstep()
+    probe.ystep()
+    return probe
+
+
+# -----------------------------------------------------------------------------
+# Run the scan lines against the surface z(x, y), probing at most limit
+# points. Return the number of points probed
+# -----------------------------------------------------------------------------
+def runScan(probe, lines, z=surface, limit=None):
+    count = 0
+    x = y = None
+    for line in lines:
+        move = MOVE.match(line)
+        if move:
+            x, y = float(move.group(1)), float(move.group(2))
+        elif line.startswith(CNC.vars["prbcmd"]):
+            if limit is not None and count >= limit:
+                break
+            probe.add(x, y, float(z(x, y)))
+            count += 1
+    return count
+
+
+# -----------------------------------------------------------------------------
+def plane(x, y):
+    return 0.01 * x - 0.02 * y + 0.5
+
+
+# -----------------------------------------------------------------------------
+# Probe with every node of the grid probed on the surface z(x, y)
+# -----------------------------------------------------------------------------
+def probedGrid(z=surface, xn=9, yn=7, size=40.0):
+    probe = makeProbe(xn, yn, size)
+    probe.makeMatrix()
+    x, y = probe.grid()
+    probe.matrix = z(x, y)
+    probe.points = numpy.stack(
+        (x.ravel(), y.ravel(), probe.matrix.ravel()), axis=1).tolist()
+    return probe
+
+
+# =============================================================================
+class BilinearTest(unittest.TestCase):
+    # ----------------------------------------------------------------------
+    # The nodes are reproduced and a plane is exact everywhere
+    # ----------------------------------------------------------------------
+    def test_nodes_plane(self):
+        probe = probedGrid()
+        for x, y, z in probe.points:
+            self.assertAlmostEqual(probe.interpolate(x, y), z, 12)
+        probe = probedGrid(plane)
+        rnd = numpy.random.RandomState(1)
+        xs, ys = rnd.uniform(0.0, 40.0, (2, 200))
+        numpy.testing.assert_allclose(probe.interpolate_many(xs, ys),
+                                      plane(xs, ys), atol=1e-12)
+
+    # ----------------------------------------------------------------------
+    # The arrays give the values of one point at a time, also outside
+    # ----------------------------------------------------------------------
+    def test_many(self):
+        probe = probedGrid()
+        rnd = numpy.random.RandomState(2)
+        xs, ys = rnd.uniform(-10.0, 50.0, (2, 200))
+        numpy.testing.assert_allclose(
+            probe.interpolate_many(xs, ys),
+            [probe.interpolate(x, y) for x, y in zip(xs, ys)], atol=1e-12)
+
+
+# =============================================================================
+class BicubicTest(unittest.TestCase):
+    # ----------------------------------------------------------------------
+    # The nodes are reproduced and a plane is exact everywhere
+    # ----------------------------------------------------------------------
+    def test_nodes_plane(self):
+        probe = probedGrid()
+        probe.setInterpolation(BICUBIC)
+        for x, y, z in probe.points:
+            self.assertAlmostEqual(probe.interpolate(x, y), z, 12)
+        probe = probedGrid(plane)
+        probe.setInterpolation(BICUBIC)
+        rnd = numpy.random.RandomState(4)
+        xs, ys = rnd.uniform(0.0, 40.0, (2, 200))
+        numpy.testing.assert_allclose(probe.interpolate_many(xs, ys),
+                                      plane(xs, ys), atol=1e-12)
+
+    # ----------------------------------------------------------------------
+    # Smoother than bilinear between the nodes of a smooth surface
+    # ----------------------------------------------------------------------
+    def test_smooth(self):
+        probe = probedGrid(xn=11, yn=11)
+        rnd = numpy.random.RandomState(5)
+        xs, ys = rnd.uniform(0.0, 40.0, (2, 500))
+        linear = abs(probe.interpolate_many(xs, ys) - surface(xs, ys)).max()
+        probe.setInterpolation(BICUBIC)
+        cubic = abs(probe.interpolate_many(xs, ys) - surface(xs, ys)).max()
+        self.assertLess(cubic, linear)
+
+
+# =============================================================================
+class ThinPlateTest(unittest.TestCase):
+    # ----------------------------------------------------------------------
+    # The spline passes through scattered probe points and a plane is exact
+    # ----------------------------------------------------------------------
+    def test_points_plane(self):
+        rnd = numpy.random.RandomState(6)
+        xs, ys = rnd.uniform(0.0, 40.0, (2, 60))
+        for z in (surface, plane):
+            probe = makeProbe()
+            probe.makeMatrix()
+            probe.points = [[x, y, float(z(x, y))] for x, y in zip(xs, ys)]
+            probe.setInterpolation(THINPLATE)
+            numpy.testing.assert_allclose(probe.interpolate_many(xs, ys),
+                                          z(xs, ys), atol=1e-9)
+            self.assertIsNone(probe.warning)
+        px, py = rnd.uniform(0.0, 40.0, (2, 100))
+        numpy.testing.assert_allclose(probe.interpolate_many(px, py),
+                                      plane(px, py), atol=1e-9)
+
+    # ----------------------------------------------------------------------
+    # More points than a fit are still exact at the nodes
+    # ----------------------------------------------------------------------
+    def test_subset(self):
+        probe = probedGrid(xn=25, yn=21)
+        self.assertGreater(len(probe.points), THINPLATE_POINTS)
+        probe.setInterpolation(THINPLATE)
+        for x, y, z in probe.points[::7]:
+            self.assertAlmostEqual(probe.interpolate(x, y), z, 9)
+
+    # ----------------------------------------------------------------------
+    # Collinear points are approximated and reported
+    # ----------------------------------------------------------------------
+    def test_collinear(self):
+        probe = makeProbe()
+        probe.makeMatrix()
+        probe.points = [[x, x, 0.1 * x] for x in range(5)]
+        probe.setInterpolation(THINPLATE)
+        self.assertAlmostEqual(probe.interpolate(1.5, 1.5), 0.15)
+        self.assertIsNotNone(probe.warning)
+        # without a tilt across the line
+        self.assertAlmostEqual(probe.interpolate(0.0, 3.0),
+                               probe.interpolate(3.0, 0.0))
+
+
+# =============================================================================
+# The segments split at once give the points of splitLine
+# =============================================================================
+class SplitTest(unittest.TestCase):
+    # ----------------------------------------------------------------------
+    def test_segments(self):
+        probe = probedGrid()
+        rnd = numpy.random.RandomState(3)
+        start = rnd.uniform(-5.0, 45.0, (50, 3))
+        end = rnd.uniform(-5.0, 45.0, (50, 3))
+        end[:5, :2] = start[:5, :2]  # vertical moves
+        end[5:10, 1] = start[5:10, 1]  # along x
+        points, seg = probe.splitSegments(start, end)
+        self.assertEqual(list(seg), sorted(seg))
+        for k, (a, b) in enumerate(zip(start, end)):
+            expect = probe.splitLine(*a, *b)
+            numpy.testing.assert_allclose(points[seg == k], expect,
+                                          atol=1e-9, err_msg=str(k))
+
+    # ----------------------------------------------------------------------
+    # Every motion of the block gets its own autolevelled lines
+    # ----------------------------------------------------------------------
+    def test_motions(self):
+        gcode = GCode()
+        gcode.probe = probedGrid(plane)
+        motions = [
+            ([(0.0, 0.0, 0.0), (20.0, 0.0, -1.0)], 1, "F100", 1.0),
+            ([(20.0, 0.0, -1.0), (20.0, 0.0, -2.0)], 1, "", 1.0),
+            ([(20.0, 0.0, -2.0), (10.0, 12.0, -2.0),
+              (12.0, 12.0, -2.0)], 1, "", 1.0),
+        ]
+        result = gcode.autolevelMotions(motions)
+        self.assertEqual(len(result), 3)
+        self.assertTrue(result[0][0].endswith("F100"))
+        self.assertEqual(len(result[1]), 1)
+        for (xyz, g, extra, unit), lines in zip(motions, result):
+            expect = []
+            for a, b in zip(xyz, xyz[1:]):
+                expect.extend(gcode.probe.splitLine(*a, *b))
+            found = [[float(v) for v in LINE.match(line).groups()]
+                     for line in lines]
+            numpy.testing.assert_allclose(found, expect, atol=1e-4)
+
+
+# =============================================================================
+# A binary probe map loads back the grid and the margins
+# =============================================================================
+class ProbeMapTest(unittest.TestCase):
+    # ----------------------------------------------------------------------
+    def test_round_trip(self):
+        probe = probedGrid(xn=9, yn=7)
+        probe.xmin, probe.xmax = -12.5, 27.25
+        probe.ymin, probe.ymax = 3.1, 41.7
+        probe.zmin, probe.zmax = -4.2, 2.5
+        probe.xstep()
+        probe.ystep()
+        x, y = probe.grid()
+        probe.points = numpy.stack(
+            (x.ravel(), y.ravel(), probe.matrix.ravel()), axis=1).tolist()
+        feed = CNC.vars["prbfeed"]
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "map.pmap")
+            probe.save(filename)
+            CNC.vars["prbfeed"] = 0.0
+            loaded = Probe()
+            loaded.load(filename)
+            self.assertEqual(CNC.vars["prbfeed"], feed)
+        for name in ("xmin", "xmax", "xn", "ymin", "ymax", "yn",
+                     "zmin", "zmax", "_xstep", "_ystep"):
+            self.assertEqual(getattr(loaded, name), getattr(probe, name),
+                             name)
+        # the grid is stored in float32
+        numpy.testing.assert_allclose(loaded.matrix, probe.matrix,
+                                      rtol=1e-6, atol=1e-7)
+        numpy.testing.assert_allclose(loaded.points, probe.points,
+                                      rtol=1e-6, atol=1e-7)
+        self.assertTrue(loaded.saved)
+
+    # ----------------------------------------------------------------------
+    def test_not_a_map(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "map.pmap")
+            with open(filename, "wb") as f:
+                f.write(b"0 10 5\n" * 20)
+            with self.assertRaises(ValueError):
+                Probe().load(filename)
+
+
+# =============================================================================
+class AdaptiveScanTest(unittest.TestCase):
+    # ----------------------------------------------------------------------
+    # The passes end, every node is known and the probed ones are exact
+    # ----------------------------------------------------------------------
+    def test_terminates(self):
+        for tolerance in (1.0, 0.01, 0.0):
+            probe = makeProbe(17, 17)
+            lines = probe.scanAdaptive(tolerance)
+            passes = 0
+            while lines:
+                passes += 1
+                self.assertLess(passes, 20)
+                runScan(probe, lines)
+                lines = probe.scanNext()
+            self.assertFalse(probe.start)
+            self.assertIsNone(probe._probed)
+            for x, y, z in probe.points:
+                self.assertAlmostEqual(probe.interpolate(x, y), z)
+            x, y = probe.grid()
+            error = abs(probe.matrix - surface(x, y)).max()
+            self.assertLess(error, max(tolerance, 1e-9) * 5.0 + 0.05)
+            if tolerance == 0.0:
+                # every node is probed
+                self.assertEqual(len(probe.points), 17 * 17)
+                self.assertLess(error, 1e-9)
+
+    # ----------------------------------------------------------------------
+    # A plane is fitted by the coarse pass, no refinement is needed
+    # ----------------------------------------------------------------------
+    def test_plane(self):
+        probe = makeProbe(17, 17)
+        runScan(probe, probe.scanAdaptive(0.001),
+                lambda x, y: 0.01 * x - 0.02 * y)
+        self.assertEqual(probe.scanNext(), [])
+        self.assertFalse(probe.start)
+        x, y = probe.grid()
+        self.assertLess(abs(probe.matrix - (0.01 * x - 0.02 * y)).max(),
+                        1e-6)
+
+    # ----------------------------------------------------------------------
+    # A pass interrupted after some probes cancels the scan
+    # ----------------------------------------------------------------------
+    def test_interrupted(self):
+        probe = makeProbe(17, 17)
+        lines = probe.scanAdaptive(0.0)
+        runScan(probe, lines)
+        lines = probe.scanNext()
+        self.assertTrue(lines)
+        self.assertEqual(runScan(probe, lines, limit=2), 2)
+        probed = len(probe.points)
+        self.assertEqual(probe.scanNext(), [])
+        self.assertIsNotNone(probe.warning)
+        self.assertFalse(probe.start)
+        self.assertIsNone(probe._probed)
+        # later probes are ignored
+        probe.add(0.0, 0.0, 1.0)
+        self.assertEqual(len(probe.points), probed)
+
+    # ----------------------------------------------------------------------
+    # Stopping the run cancels the scan, even with every node probed
+    # ----------------------------------------------------------------------
+    def test_cancel(self):
+        probe = makeProbe()
+        runScan(probe, probe.scanAdaptive(0.0))
+        probe.scanCancel()
+        self.assertFalse(probe.start)
+        self.assertEqual(probe.scanNext(), [])
+        probe.scanCancel()  # twice is harmless
+
+
+# =============================================================================
+class FootprintTest(unittest.TestCase):
+    # ----------------------------------------------------------------------
+    # Only the nodes of the cells crossed by the toolpath are probed
+    # ----------------------------------------------------------------------
+    def test_scan(self):
+        probe = makeProbe(9, 9)
+        probe.setFootprint(probe.footprintCells(
+            numpy.array([[1.0, 1.0, 0.0]]), numpy.array([[9.0, 1.0, 0.0]])))
+        self.assertEqual(probe.footprint.sum(), 2)
+        self.assertEqual(runScan(probe, probe.scan()), 6)
+        self.assertFalse(probe.start)
+
+    # ----------------------------------------------------------------------
+    # A footprint of another grid is forgotten, even with the same shape
+    # ----------------------------------------------------------------------
+    def test_grid_change(self):
+        probe = makeProbe(9, 9)
+        probe.setFootprint(numpy.ones((8, 8), dtype=bool))
+        probe.xmin = 10.0
+        probe.xstep()
+        lines = probe.scan()
+        self.assertIsNone(probe.footprint)
+        self.assertEqual(runScan(probe, lines), 81)
+
+        probe = makeProbe(9, 9)
+        probe.setFootprint(numpy.ones((8, 8), dtype=bool))
+        probe.scan()
+        self.assertIsNotNone(probe.footprint)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,297 @@
+import os
+import pickle
+import selectors
+import statistics
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+try:
+    import pty
+    import tty
+except ImportError:
+    pty = None
+
+try:
+    import serial
+except ImportError:
+    serial = None
+
+import Helpers  # noqa: F401, installs _()
+import Utils
+from CNC import CNC, Block, GCode
+from Sender import (
+    SERIAL_POLL,
+    SERIAL_TIMEOUT,
+    CommandQueue,
+    LogBuffer,
+    Sender,
+)
+
+STATUS = b"<Idle|MPos:0.000,0.000,0.000|FS:0,0>\r\n"
+
+
+# =============================================================================
+# Fake Grbl on a pseudo terminal, like fake-grbl.sh, answering ok to every
+# line and a status report to every ?, recording when each happened
+# =============================================================================
+class FakeGrbl:
+    def __init__(self):
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.lines = []  # (time received, line)
+        self.oks = []  # time of every ok sent
+        self.polls = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # ----------------------------------------------------------------------
+    def run(self):
+        line = b""
+        while True:
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                return
+            for c in data:
+                if c == ord("?"):
+                    self.polls += 1
+                    os.write(self.master, STATUS)
+                elif c == ord("\n"):
+                    self.lines.append((time.time(), line.decode()))
+                    line = b""
+                    self.oks.append(time.time())
+                    os.write(self.master, b"ok\r\n")
+                else:
+                    line += bytes([c])
+
+    # ----------------------------------------------------------------------
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+
+# -----------------------------------------------------------------------------
+def waitFor(condition, timeout=5.0):
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            raise AssertionError("timeout")
+        time.sleep(0.001)
+
+
+# =============================================================================
+@unittest.skipIf(pty is None or serial is None, "needs pty and pyserial")
+class SerialIOTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        Utils.loadConfiguration(True)
+
+    # ----------------------------------------------------------------------
+    def setUp(self):
+        self.grbl = FakeGrbl()
+        self.sender = Sender()
+        self.sender.serial = serial.serial_for_url(
+            self.grbl.port, 115200, timeout=SERIAL_TIMEOUT)
+        self.sender._gcount = 0
+        self.selects = 0
+        ioSelect = self.sender._ioSelect
+
+        def countSelect(sel, timeout):
+            self.selects += 1
+            return ioSelect(sel, timeout)
+
+        self.sender._ioSelect = countSelect
+        self.sender.thread = threading.Thread(target=self.sender.serialIO)
+        self.sender.thread.start()
+
+    # ----------------------------------------------------------------------
+    def tearDown(self):
+        thread = self.sender.thread
+        self.sender.thread = None
+        self.sender.queue.wakeup()
+        thread.join(5.0)
+        self.sender.serial.close()
+        self.grbl.close()
+
+    # ----------------------------------------------------------------------
+    # With room for a single line in the controller, every line is sent
+    # as soon as the ok of the previous one arrives
+    # ----------------------------------------------------------------------
+    def test_ok_to_next_send_latency(self):
+        self.sender.rxBufferSize = 16
+        n = 50
+        for i in range(n):
+            self.sender.queue.put(f"G1X{i:05d}\n")
+        waitFor(lambda: len(self.grbl.lines) >= n)
+        lines = self.grbl.lines
+        self.assertEqual([line for t, line in lines],
+                         [f"G1X{i:05d}" for i in range(n)])
+        latency = [lines[k][0] - self.grbl.oks[k - 1] for k in range(1, n)]
+        self.assertLess(statistics.median(latency), SERIAL_POLL / 10)
+
+    # ----------------------------------------------------------------------
+    # While idle the thread sleeps until the next status report is due
+    # ----------------------------------------------------------------------
+    def test_idle_wakeups(self):
+        time.sleep(0.2)
+        selects = self.selects
+        polls = self.grbl.polls
+        time.sleep(1.0)
+        polls = self.grbl.polls - polls
+        # one wakeup for the timeout and one for the status report
+        self.assertLessEqual(self.selects - selects, 2 * polls + 4)
+        self.assertLess(polls, 1.5 / SERIAL_POLL)
+        self.assertGreater(polls, 0.5 / SERIAL_POLL)
+
+    # ----------------------------------------------------------------------
+    # A command put in the queue wakes up the sleeping thread
+    # ----------------------------------------------------------------------
+    def test_queue_wakeup(self):
+        delays = []
+        for i in range(10):
+            time.sleep(SERIAL_POLL * (i + 1) / 11.0)
+            n = len(self.grbl.lines)
+            t = time.time()
+            self.sender.queue.put(f"G0X{i}\n")
+            waitFor(lambda: len(self.grbl.lines) > n)
+            delays.append(self.grbl.lines[n][0] - t)
+        self.assertLess(max(delays), SERIAL_POLL / 2)
+
+
+# =============================================================================
+class CommandQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.queue = CommandQueue()
+        self.sel = selectors.DefaultSelector()
+        self.sel.register(self.queue, selectors.EVENT_READ)
+
+    # ----------------------------------------------------------------------
+    def tearDown(self):
+        self.sel.close()
+
+    # ----------------------------------------------------------------------
+    def test_wakeup(self):
+        self.assertEqual(self.sel.select(0), [])
+        self.queue.wakeup()
+        self.queue.wakeup()
+        self.assertEqual(len(self.sel.select(0)), 1)
+        self.queue.drain()
+        self.assertEqual(self.sel.select(0), [])
+        self.queue.put("G0\n")
+        self.assertEqual(len(self.sel.select(0)), 1)
+        self.assertEqual(self.queue.get_nowait(), "G0\n")
+
+    # ----------------------------------------------------------------------
+    def test_wait_below(self):
+        for i in range(3):
+            self.queue.put(i)
+        stop = threading.Event()
+        waiter = threading.Thread(target=self.queue.waitBelow,
+                                  args=(2, stop.is_set))
+        waiter.start()
+        waiter.join(0.05)
+        self.assertTrue(waiter.is_alive())
+        self.queue.get()
+        waiter.join(0.05)
+        self.assertTrue(waiter.is_alive())
+        self.queue.get()
+        waiter.join(1.0)
+        self.assertFalse(waiter.is_alive())
+
+        waiter = threading.Thread(target=self.queue.waitBelow,
+                                  args=(1, stop.is_set))
+        waiter.start()
+        stop.set()
+        self.queue.release()
+        waiter.join(1.0)
+        self.assertFalse(waiter.is_alive())
+
+
+# =============================================================================
+# The stream compiles the same program without filling the block cache
+# =============================================================================
+class StreamCompileTest(unittest.TestCase):
+    # ----------------------------------------------------------------------
+    def test_no_cache(self):
+        gcode = GCode()
+        for k in range(3):
+            block = Block(f"block{k}")
+            block.extend(["G21", f"G0 X{k} Y0", "G1 X10 Y5 F100",
+                          "G2 X20 Y5 I5 J0"])
+            gcode.blocks.append(block)
+
+        streamed = list(gcode.compileIter(cnc=CNC(), cache=False))
+        self.assertEqual([b._compiled for b in gcode.blocks], [None] * 3)
+
+        compiled = list(gcode.compileIter())
+        self.assertEqual(streamed, compiled)
+        self.assertTrue(all(b._compiled is not None for b in gcode.blocks))
+        # a valid cache is still reused by the stream
+        self.assertEqual(list(gcode.compileIter(cnc=CNC(), cache=False)),
+                         compiled)
+
+
+# =============================================================================
+# The GUI and the path evaluator thread may save the cache at once
+# =============================================================================
+class SaveCacheTest(unittest.TestCase):
+    # ----------------------------------------------------------------------
+    def test_concurrent(self):
+        gcode = GCode()
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch("CNC.CACHE_DIR", tmp):
+            def save(k):
+                for n in range(50):
+                    gcode.saveCache({"key": (k, "/a.ngc"), "n": n})
+
+            threads = [threading.Thread(target=save, args=(k,))
+                       for k in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            files = os.listdir(tmp)
+            self.assertEqual(files, [os.path.basename(
+                gcode._cacheFile("/a.ngc"))])
+            with open(os.path.join(tmp, files[0]), "rb") as f:
+                self.assertEqual(pickle.load(f)["n"], 49)
+
+
+# =============================================================================
+class LogBufferTest(unittest.TestCase):
+    # ----------------------------------------------------------------------
+    # Only the display records are dropped when the GUI falls behind
+    # ----------------------------------------------------------------------
+    def test_keep_control_records(self):
+        log = LogBuffer(10, (Sender.MSG_RECEIVE,))
+        expected = []
+        for i in range(1000):
+            log.put((Sender.MSG_RECEIVE, f"<{i}>"))
+            log.put((Sender.MSG_BUFFER, f"G0X{i}"))
+            log.put((Sender.MSG_OK, "ok"))
+            expected.append((Sender.MSG_BUFFER, f"G0X{i}"))
+            expected.append((Sender.MSG_OK, "ok"))
+        log.put((Sender.MSG_RUNEND, "Run ended"))
+        expected.append((Sender.MSG_RUNEND, "Run ended"))
+        self.assertLess(log.qsize(), len(expected) + 20)
+
+        records = list(log.getAll())
+        self.assertEqual(log.qsize(), 0)
+        control = [r for r in records if r[0] != Sender.MSG_RECEIVE]
+        self.assertEqual(control, expected)
+        display = [r[1] for r in records if r[0] == Sender.MSG_RECEIVE]
+        self.assertGreaterEqual(len(display), 10)
+        self.assertLess(len(display), 20)
+        self.assertEqual(display[-10:], [f"<{i}>" for i in range(990, 1000)])
+        # the records are still in order
+        self.assertEqual(records[-3:], [(Sender.MSG_BUFFER, "G0X999"),
+                                        (Sender.MSG_OK, "ok"),
+                                        (Sender.MSG_RUNEND, "Run ended")])
+
+
+if __name__ == "__main__":
+    unittest.main()
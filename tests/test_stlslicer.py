@@ -0,0 +1,70 @@
+import os
+import struct
+import tempfile
+import unittest
+
+import numpy
+
+import Helpers  # noqa: F401, installs _()
+import Utils  # noqa: F401, imports the GUI modules in order
+import stlSlicer
+from CNC import STL_FACET
+
+
+# -----------------------------------------------------------------------------
+# Write the (facets,3,3) float32 vertices as a binary STL file
+# -----------------------------------------------------------------------------
+def writeSTL(filename, vertices):
+    facets = numpy.zeros(len(vertices), STL_FACET)
+    facets["normal"] = (0.0, 0.0, 1.0)
+    facets["vertex"] = vertices
+    with open(filename, "wb") as f:
+        f.write(b"\0" * stlSlicer.HEADER_SIZE)
+        f.write(struct.pack("<I", len(facets)))
+        facets.tofile(f)
+
+
+# =============================================================================
+# The importer computes the coordinates of the original one, the float32
+# of the file scaled and offset in double precision
+# =============================================================================
+class ImporterTest(unittest.TestCase):
+    # ----------------------------------------------------------------------
+    def load(self, vertices, scale):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "model.stl")
+            writeSTL(filename, vertices)
+            return stlSlicer.stlImporter(filename, scale)
+
+    # ----------------------------------------------------------------------
+    def test_coordinates(self):
+        rnd = numpy.random.RandomState(7)
+        vertices = rnd.uniform(-50.0, 50.0, (20, 3, 3)).astype(numpy.float32)
+        stl = self.load(vertices, 25.4)
+        stl.Offset(0.1, -3.7, 12.3)
+        expect = [[[float(v) * 25.4 + off
+                    for v, off in zip(vertex, (0.1, -3.7, 12.3))]
+                   for vertex in facet] for facet in vertices.tolist()]
+        self.assertEqual(stl.convertTriangles([0, 1, 2]).tolist(), expect)
+        self.assertEqual(stl.minz, min(v[2] for f in expect for v in f))
+
+    # ----------------------------------------------------------------------
+    # Only identical vertices are welded, near duplicates are kept
+    # ----------------------------------------------------------------------
+    def test_weld(self):
+        a = numpy.float32(1.0)
+        b = numpy.nextafter(a, numpy.float32(2.0))
+        vertices = numpy.array([
+            [(0, 0, 0), (a, 0, 0), (0, 1, 0)],
+            [(a, 0, 0), (0, 1, 0), (1, 1, 0)],
+            [(b, 0, 0), (0, 1, 0), (-0.0, 0, 0)],
+        ], dtype=numpy.float32)
+        stl = self.load(vertices, 1.0)
+        self.assertEqual(len(stl.verts), 5)
+        self.assertEqual(stl.faces.tolist(),
+                         [[0, 1, 2], [1, 2, 3], [4, 2, 0]])
+        self.assertEqual(stl.convertTriangles([0, 1, 2])[2, 0, 0], float(b))
+
+
+if __name__ == "__main__":
+    unittest.main()